@@ -1,5 +1,7 @@
 import os
 import re
+import time
+import multiprocessing
 import matplotlib
 import warnings
 warnings.simplefilter('ignore')
@@ -17,7 +19,7 @@ ETSConfig.toolkit = 'qt4'
 
 from enable.api import ComponentEditor
 from traits.api import List, Str, Float, HasTraits, Instance, Button, Enum, Bool, \
-    DelegatesTo, Range, HTML
+    DelegatesTo, Range, HTML, on_trait_change
 from traitsui.api import Item, UItem, HGroup, VGroup, View, spring, Label, HSplit, Group, VGrid, \
     CheckListEditor, Tabbed, DefaultOverride, EnumEditor, HTMLEditor, InstanceEditor
 
@@ -25,7 +27,12 @@ from pyface.api import DirectoryDialog, OK, ImageResource, ProgressDialog
 from chaco.api import OverlayPlotContainer
 
 import csv
+import logger
+import settings
 from xye import XYEDataset
+from dataset_storage import MemmapStorage
+from dataset_collection import DatasetCollection
+from undo_history import UndoHistory
 from chaco_output import PlotOutput
 from raw_data_plot import RawDataPlot
 from dataset_editor import DatasetEditor, DatasetUI
@@ -39,11 +46,14 @@ from processing import DatasetProcessor
 from plot_generator import PlotGenerator
 from peak_fit_window import PeakFitWindow
 from processing_background_removal import subtract_background_from_all_datasets, \
-                                            get_subtracted_datasets, CurveFitter
+                                            get_subtracted_datasets, CurveFitter, \
+                                            BACKGROUND_ESTIMATORS, estimate_backgrounds
 from define_background import empty_xye_dataset, min_max_x
 from xyzoutput import write_to_file, XYZGenerator
+from xye_writer import save_datasets
+from batch_container import save_batch, BatchContainer, is_batch_container, batch_filename
 from transform_data import apply_transform, find_datasets_with_descriptor, dataset_already_transformed
-from peak_fitting import autosearch_peaks, fit_peaks_background, createPeakRows
+from peak_fitting import autosearch_peaks, fit_peaks_background, createPeakRows, fit_backgrounds
 from peak_editor import PeakFittingEditor
 from traitsui.message import message
 from traitsui.editors.button_editor import ButtonEditor
@@ -120,6 +130,7 @@ class ControlPanel(HasTraits):
     load_partners = Button
     splice = Bool(True)
     merge = Bool(False)
+    merge_binned = Bool(False)
     merge_regrid = Bool(False)
     normalise = Bool(True)
     # See comment in class Global() for an explanation of the following traits
@@ -133,6 +144,7 @@ class ControlPanel(HasTraits):
 
     correction = Float(0.0)
     align_positions = Bool(False)
+    alignment_method = Enum(processing.ALIGNMENT_METHODS)
     bt_start_peak_select = Button
     bt_end_peak_select = Button
     peak_selecting = Bool(False)
@@ -141,6 +153,7 @@ class ControlPanel(HasTraits):
 
     bt_process = Button("Apply")
     bt_undo_processing = Button("Undo")
+    bt_redo_processing = Button("Redo")
     bt_save = Button("Save...")
     most_recent_path = Str('')
 
@@ -152,8 +165,10 @@ class ControlPanel(HasTraits):
     background_selected = Bool(False)
     curve_order = Range(1, 1000)(3)
 
-    curve_type = Enum('Linear Interpolation', 'Chebyschev Polynomial', 'Cosine Fourier Series')('Chebyschev Polynomial')
+    curve_type = Enum('Linear Interpolation', 'Chebyschev Polynomial', 'Cosine Fourier Series',
+                      *BACKGROUND_ESTIMATORS)('Chebyschev Polynomial')
     bt_fit = Button("Curve fit")
+    bt_fit_all = Button("Fit all")
     bt_save_curve = Button("Save fit params")
     bt_clear_fit = Button("Clear fit")
     bt_load_background = Button("Load...")
@@ -254,6 +269,11 @@ class ControlPanel(HasTraits):
         ),
         VGroup(
             Item('align_positions', enabled_when='object._has_data() and (object.merge_positions != "all")'),
+            Item('alignment_method', label='Align by:', editor=EnumEditor(values={
+                    'fit': '1: Peak fit',
+                    'xcorr': '2: Cross-correlation',
+                }),
+                enabled_when='object.align_positions and not object.peak_selecting'),
             HGroup(
                 UItem('bt_start_peak_select', label='Select peak',
                       enabled_when='object.align_positions and not object.peak_selecting and (object.merge_positions != "all")'),
@@ -268,6 +288,8 @@ class ControlPanel(HasTraits):
             HGroup(
                 Item('splice'),
                 Item('merge', enabled_when='object.merge_positions != "p12+p34"'),
+                Item('merge_binned', label='Weighted merge',
+                     enabled_when='object.merge_positions != "p12+p34"'),
                 enabled_when='object._has_data() and (object.merge_positions != "all")'
             ),
             HGroup(
@@ -286,7 +308,10 @@ class ControlPanel(HasTraits):
         spring,
         spring,
         UItem('bt_process', resizable=True,enabled_when='object._has_data()'),
-        UItem('bt_undo_processing', resizable=True,enabled_when='object.undo_state is not None'),
+        HGroup(
+            UItem('bt_undo_processing', resizable=True,enabled_when='object.history.can_undo()'),
+            UItem('bt_redo_processing', resizable=True,enabled_when='object.history.can_redo()'),
+        ),
         UItem('bt_save', resizable=True,enabled_when='object._has_data()'),
         label='Process',
         springy=False,
@@ -306,10 +331,11 @@ class ControlPanel(HasTraits):
         VGroup(
             UItem('selection_dataset_names', resizable=True, enabled_when='object._has_data()'),
             UItem('curve_type', resizable=True, enabled_when='object._has_data()'),
-            Label('Number of Fit Parameters:'),
+            Label('Number of Fit Parameters (SNIP/opening: width in points):'),
             UItem('curve_order', resizable=True, enabled_when='object._has_data()'),
             HGroup(
                 UItem('bt_fit',  enabled_when='object._has_data()'),
+                UItem('bt_fit_all',  enabled_when='object._has_data()'),
                 UItem('bt_save_curve', enabled_when='object._has_data()'),
                 UItem('bt_clear_fit', enabled_when='object._has_data()'),
             ),
@@ -412,9 +438,10 @@ class ControlPanel(HasTraits):
         self.container = container
         self.raw_data_plot = raw_data_plot
         self.plot = plot
-        self.datasets = []
+        self.datasets = DatasetCollection()
+        self.storage = None
         self.dataset_pairs = set()
-        self.undo_state = None
+        self.history = UndoHistory()
         self.peak_list=[]
         self.peak_labels=[]
         self.file_paths=[]
@@ -424,7 +451,7 @@ class ControlPanel(HasTraits):
         self._legend = 'Overlay'
         self.options = self._options
         self.legend = self.legend
-        self.processed_datasets = []
+        self.processed_datasets = DatasetCollection()
         self.background_datasets = set()
         self.bg_removed_datasets = set()  # keep track of datasets where we have removed the background so we don't do it twice
 
@@ -448,11 +475,11 @@ class ControlPanel(HasTraits):
             self.file_paths = file_list
 
     def _reset_all(self):
-        self.datasets = []
+        self.datasets = DatasetCollection()
         self.dataset_pairs = set()
-        self.undo_state = None
+        self.history.clear()
         self.file_paths = []
-        self.processed_datasets = []
+        self.processed_datasets = DatasetCollection()
         self.background_file = None
         self.background_manual = None
         self.background_fit = None
@@ -553,9 +580,17 @@ class ControlPanel(HasTraits):
         range_low, range_high = selection_range
         # fit the peak in all loaded dataseries
         self._get_partners()
-        for datapair in self._get_dataset_pairs():
-            processing.fit_peaks_for_a_dataset_pair(
-                range_low, range_high, datapair, self.normalise)
+        if self.alignment_method == 'xcorr':
+            try:
+                processing.align_pairs_by_cross_correlation(
+                    range_low, range_high, self._get_dataset_pairs())
+            except ValueError as e:
+                message(message='Unable to align the datasets: {},\n try selecting a wider range'.format(e),
+                        title='Alignment Error', buttons=[ 'OK' ], parent=None)
+                return
+        else:
+            processing.fit_peaks_for_dataset_pairs(
+                range_low, range_high, self._get_dataset_pairs(), self.normalise)
         editor = PeakFitWindow(dataset_pairs=self._get_dataset_pairs(),
                                range=selection_range)
         editor.edit_traits()
@@ -565,97 +600,116 @@ class ControlPanel(HasTraits):
         return [ (datasets_dict[file1], datasets_dict[file2]) \
                     for file1, file2 in self.dataset_pairs ]
 
+    def _create_processor(self):
+        return DatasetProcessor(self.normalise, self.correction,
+                                self.align_positions,
+                                self.splice, self.merge, self.merge_regrid,
+                                self.normalisation_source_filenames,
+                                self.datasets, merge_by_binning=self.merge_binned)
+
     def _bt_process_changed(self):
         '''
         Button click event handler for processing.
         '''
-        # Save the unprocessed data series at this point for later undoing
-        processed_datasets = []
-        processor = DatasetProcessor(self.normalise, self.correction,
-                                     self.align_positions,
-                                     self.splice, self.merge, self.merge_regrid,
-                                     self.normalisation_source_filenames,
-                                     self.datasets)
-        # Processing at this point depends on the "Positions to process:" radiobutton
-        # selection:
-        # If Splice==True, get all pairs and splice them
-        # If Merge==True, get all pairs and merge them
-        # If Normalise==True, always normalise
-        # If Grid===True, output gridded and ungridded
-        # The following processing code sould really be placed into a processor.process()
-        # method, but I only worked out how to pass required stuff late in the day, so
-        # I do this stuff here.
-        if self.merge_positions == 'p12+p34':
-            self._get_partners()  # pair up datasets corresponding to the radiobutton selection
-            for dataset_pair in self._get_dataset_pairs():
-                datasets = processor.splice_overlapping_datasets(dataset_pair)
-                for dataset in datasets:
-                    dataset.metadata['ui'].name = dataset.name + ' (processed)'
-                    dataset.metadata['ui'].color = None
-                processed_datasets.extend(datasets)
-        elif self.merge_positions == 'all':
-            # Handle "all" selection for regrid and normalise
-            for d in self.datasets:
-                dataset = processor.normalise_me(d)
-                if dataset is not None:
-                    processed_datasets.append(dataset)
-                    dataset.metadata['ui'].name = dataset.name + ' (processed)'
-                    dataset.metadata['ui'].color = None
-                    d = dataset
-
-                dataset = processor.regrid_me(d)
-                if dataset is not None:
-                    processed_datasets.append(dataset)
-                    dataset.metadata['ui'].name = dataset.name + ' (processed)'
-                    dataset.metadata['ui'].color = None
-        else:
+        processor = self._create_processor()
+        # Processing depends on the "Positions to process:" radiobutton selection,
+        # see DatasetProcessor.process()
+        dataset_pairs = None
+        if self.merge_positions != 'all':
             self._get_partners()  # pair up datasets corresponding to the radiobutton selection
-            for dataset_pair in self._get_dataset_pairs():
-                datasets = processor.process_dataset_pair(dataset_pair)
-                for dataset in datasets:
-                    dataset.metadata['ui'].name = dataset.name + ' (processed)'
-                    dataset.metadata['ui'].color = None
-                processed_datasets.extend(datasets)
-
-        self.processed_datasets = processed_datasets
+            dataset_pairs = self._get_dataset_pairs()
+        # Pairs are processed in parallel, and new datasets come back without their 'ui'
+        # metadata. Datasets from pairs that haven't changed since the last Process are
+        # reused as they are.
+        processed_datasets = processor.process(self.merge_positions, dataset_pairs,
+                                               workers=multiprocessing.cpu_count(),
+                                               previous=self.processed_datasets)
+        for dataset in processed_datasets:
+            if 'ui' not in dataset.metadata:
+                create_datasetui(dataset)
+                dataset.metadata['ui'].name = dataset.name + ' (processed)'
+
+        self.processed_datasets = DatasetCollection(processed_datasets)
+        self._update_processing_status()
         self._refresh_dataset_name_list()
         self._plot_processed_datasets()
 
+    @on_trait_change('normalise, correction, align_positions, splice, merge, merge_binned, '
+                     'merge_regrid, merge_positions, normalisation_source_filenames')
+    def _update_processing_status(self):
+        """
+        Marks each loaded and processed dataset as up to date if its processed datasets
+        are those the current options would give, i.e. if pressing Process would reuse
+        them rather than process its pair again.
+        """
+        if self.merge_positions == 'all' or not self.datasets:
+            signatures = {}
+        else:
+            processor = self._create_processor()
+            datasets_dict = dict([ (d.name, d) for d in self.datasets ])
+            pairs = [ (datasets_dict[f1], datasets_dict[f2]) for f1, f2 in
+                      processing.find_dataset_pairs(datasets_dict.keys(), self.merge_positions) ]
+            signatures = dict((processor.pair_signature(pair, self.merge_positions), pair)
+                              for pair in pairs)
+        current = set()
+        for dataset in self.processed_datasets:
+            pair = signatures.get(dataset.metadata.get('processing_signature'))
+            if pair is not None:
+                current.update(d.name for d in pair)
+            if 'ui' in dataset.metadata:
+                dataset.metadata['ui'].up_to_date = pair is not None
+        for dataset in self.datasets:
+            if 'ui' in dataset.metadata:
+                dataset.metadata['ui'].up_to_date = dataset.name in current
+
     def _plot_processed_datasets(self):
         self._save_state()
-        if 'old' in self.what_to_plot:
-            datasets_to_plot = self.datasets + self.processed_datasets
-        else:
-            datasets_to_plot = self.processed_datasets
-        self._plot_datasets(datasets_to_plot)
+        self._plot_datasets(self._datasets_to_plot())
+
+    def _datasets_to_plot(self):
+        if 'old' in self.what_to_plot or not self.processed_datasets:
+            return self.datasets + self.processed_datasets
+        return self.processed_datasets
 
     def _save_state(self):
-        self.undo_state = (self.datasets[:], self.dataset_pairs.copy())
+        """
+        Records the datasets in the undo history, see undo_history.py.
+        """
+        self.history.push(self.datasets, self.processed_datasets, self.dataset_pairs)
 
-    def _restore_state(self):
-        if self.undo_state is not None:
-            self.datasets, self.dataset_pairs = self.undo_state
-            self.undo_state = None
+    def _restore_state(self, snapshot):
+        if snapshot is None:
+            return
+        self.datasets = DatasetCollection(snapshot.datasets)
+        self.processed_datasets = DatasetCollection(snapshot.processed_datasets)
+        self.dataset_pairs = set(snapshot.dataset_pairs)
+        self._update_processing_status()
+        self._refresh_dataset_name_list()
+        self._plot_datasets(self._datasets_to_plot())
 
     def _bt_undo_processing_changed(self):
-        self._restore_state()
-        self._refresh_dataset_name_list()
-        self._plot_datasets(self.datasets)
+        self._restore_state(self.history.undo())
+
+    def _bt_redo_processing_changed(self):
+        self._restore_state(self.history.redo())
 
     def _bt_save_changed(self):
         wildcard = 'GSAS file (.fxye)|*.fxye|XYE file (.xye)|*.xye'
         result,path,extension = get_save_processed_dir(self.most_recent_path,wildcard)
         if result:
             print path,extension
+            if extension=='pdvz':
+                filename = os.path.join(path, batch_filename(self.processed_datasets[0].name))
+                save_batch(filename, self.processed_datasets)
+                open_file_dir_with_default_handler(filename)
+                return
             if extension=='fxye':
-                for dataset in self.processed_datasets:
-                    tmpname=dataset.name.split('.')[0]+".fxye"
-                    filename= os.path.join(path, tmpname)
-                    dataset.save_fxye(filename)
+                filenames = [ os.path.join(path, dataset.name.split('.')[0]+".fxye")
+                              for dataset in self.processed_datasets ]
             else:
-                for dataset in self.processed_datasets:
-                    filename= os.path.join(path, dataset.name)
-                    dataset.save(filename)
+                filenames = [ os.path.join(path, dataset.name)
+                              for dataset in self.processed_datasets ]
+            save_datasets(zip(self.processed_datasets, filenames), fxye=(extension=='fxye'))
             open_file_with_default_handler(path)
     #dlg = DirectoryDialog(title='Save results', action='save as', wildcard=wildcard, default_path=self.most_recent_path)
           # if dlg.open() == OK:
@@ -700,26 +754,10 @@ class ControlPanel(HasTraits):
 
     def _get_partner(self, position_index):
         # return index of partner; i.e., 2=>1, 1=>2, 3=>4, 4=>3, 12=>34, 34=>12
-        if position_index in [1, 2, 3, 4]:
-            partner = ((position_index - 1) ^ 1) + 1
-        elif position_index == 12:
-            partner = 34
-        elif position_index == 34:
-            partner = 12
-        else:
-            raise 'unparsable position'
-        return partner
+        return processing.get_partner(position_index)
 
     def _get_position(self, filename):
-        m = re.search('_[pP]([0-9]+)_', filename)
-        try:
-            return int(m.group(1))
-        except (AttributeError, ValueError):
-            return None
-
-    def _repl(self, m):
-            newindex = self._get_partner(int(m.group(2)))
-            return m.group(1) + str(newindex) + m.group(3)
+        return processing.get_position(filename)
 
     def _add_dataset_pair(self, filename):
         current_directory, filebase = os.path.split(filename)
@@ -731,8 +769,7 @@ class ControlPanel(HasTraits):
       #  other_filebase = re.sub(r"_[pP]{}_".format(position_index),
       #                          r"_[pP]{}_".format(self._get_partner(position_index)),
       #                          filebase)
-        other_filebase = re.sub(r"(_[pP])(\d+)(_)", self._repl, filename)
-        other_filename = os.path.join(current_directory, other_filebase)
+        other_filename = processing.partner_filename(filename)
         if not os.path.exists(other_filename):
             return
 
@@ -760,15 +797,16 @@ class ControlPanel(HasTraits):
         positions with the selected order of the curve to get an expression for the background. Background is then evaluated at the same x points
         as the dataset and a new xyedataset created for the background. Background dataset is then added to the datasets (so that it is plotted)
         and also added as an attribute to the original dataset for later use subtracting the background
+        SNIP and morphological opening backgrounds are estimated directly from the data instead, with curve_order the
+        width in points of the largest peaks to remove.
         """
+        if self.curve_type in BACKGROUND_ESTIMATORS:
+            self._estimate_background()
+            return
         # varyList=[r'Back'] #we only want to fit the background parameters here
         varyList = []  # we only want to fit the background parameters here but that is included directly in the fitting routine
-        fit_params = {'U':1, 'V':-1, 'W':0.3, 'X':0, 'Y':0, 'backType':self.curve_type, 'Back:0':1.0, 'Zero':0}  # these are currently needed in the version of the routine we've modified from gsas
-        # need to further think on how to get rid of them, they are just the parameters for the gaussian and lorentzian that would be used
-        # to define an overall broadening of the curves due to the instrument. Qinfen says they don't want to have the overall broadening
-        for i in range(1, self.curve_order):
-            fit_params.update({'Back:' + str(i):0.0})
-        dataset_to_fit = self._find_dataset_by_name(self.selection_dataset_names, self.datasets + self.processed_datasets)
+        fit_params = self._background_fit_params()
+        dataset_to_fit = self._find_dataset_by_name(self.selection_dataset_names, self.datasets, self.processed_datasets)
         if dataset_to_fit is not None:
             dataset_to_fit.fit_params = fit_params
             dataset_to_fit.fit_params.update({'datasetName':dataset_to_fit.name})
@@ -781,29 +819,106 @@ class ControlPanel(HasTraits):
                 return
             background, peak_profile, new_fit_params = fit_peaks_background(peak_list, varyList, dataset_to_fit, self.background_fit, dataset_to_fit.fit_params)
             dataset_to_fit.fit_params.update(new_fit_params)
-            if hasattr(dataset_to_fit, 'background'):
-                background_fit = dataset_to_fit.background
-            else:
-                background_fit = dataset_to_fit.copy()
-                background_fit.metadata['ui'].name = dataset_to_fit.name + ' fit (background)'
-                background_fit.metadata['ui'].color = None
-            background_fit.data[:, 1] = background
-
-            dataset_to_fit.background = background_fit
-            existing_fit = self._find_dataset_by_uiname(dataset_to_fit.name + ' fit (background)', self.datasets)
-            if existing_fit is not None:
-                self.datasets.remove(existing_fit)
-            self.datasets.append(background_fit)
-            self.background_fits.append(background_fit)
-            self.background_datasets.add(background_fit)
-            self.backgrounds_fitted = True
+            self._add_background_fit(dataset_to_fit, background)
+            self._plot_processed_datasets()
+
+    def _background_fit_params(self):
+        """
+        Returns the starting parameters for fitting a background curve of the selected type and order.
+        """
+        fit_params = {'U':1, 'V':-1, 'W':0.3, 'X':0, 'Y':0, 'backType':self.curve_type, 'Back:0':1.0, 'Zero':0}  # these are currently needed in the version of the routine we've modified from gsas
+        # need to further think on how to get rid of them, they are just the parameters for the gaussian and lorentzian that would be used
+        # to define an overall broadening of the curves due to the instrument. Qinfen says they don't want to have the overall broadening
+        for i in range(1, self.curve_order):
+            fit_params.update({'Back:' + str(i):0.0})
+        return fit_params
+
+    def _bt_fit_all_changed(self):
+        """
+        Fits a background curve to every active dataset as the Curve fit button does for the selected one. The datasets
+        are fitted in name order in parallel runs, each fit starting from the background of the one before, see
+        peak_fitting.fit_backgrounds(). The Rwp, number of function evaluations and time of each fit are reported.
+        """
+        datasets = [ d for d in set(self.datasets + self.processed_datasets) - self.background_datasets
+                     if 'ui' not in d.metadata or d.metadata['ui'].active ]
+        datasets.sort(key=lambda d: d.name)
+        if not datasets:
+            return
+        if self.curve_type in BACKGROUND_ESTIMATORS:
+            backgrounds = estimate_backgrounds([ d.data for d in datasets ], self.curve_type, self.curve_order)
+            for dataset, background in zip(datasets, backgrounds):
+                dataset.fit_params = {'backType':self.curve_type, 'datasetName':dataset.name, 'width':self.curve_order}
+                self._add_background_fit(dataset, background)
             self._plot_processed_datasets()
+            return
+        start = time.time()
+        results = fit_backgrounds(datasets, self._background_fit_params(), workers=multiprocessing.cpu_count())
+        failed = []
+        rwps = []
+        table = []
+        for dataset, (background, fit_params, stats) in zip(datasets, results):
+            dataset.fit_stats = stats
+            if background is None:
+                failed.append(dataset.name)
+                table.append('{}: not fitted'.format(dataset.name))
+                logger.logger.info(table[-1])
+                continue
+            table.append('{}: Rwp {:.2f}%, {} function evaluations, {:.2f} s'.format(
+                dataset.name, stats['Rwp'], stats['nfev'], stats['time']))
+            logger.logger.info(table[-1])
+            rwps.append(stats['Rwp'])
+            dataset.fit_params = fit_params
+            self._add_background_fit(dataset, background)
+        self._plot_processed_datasets()
+        summary = 'Fitted backgrounds to {} of {} datasets in {:.1f} s.'.format(len(rwps), len(datasets), time.time() - start)
+        if rwps:
+            summary += '\nRwp: mean {:.2f}%, worst {:.2f}%'.format(numpy.mean(rwps), max(rwps))
+        if failed:
+            summary += '\nNot fitted (too many peaks or no convergence): ' + ', '.join(failed)
+        summary += '\n\n' + '\n'.join(table)
+        message(message=summary, title='Background Fit', buttons=[ 'OK' ], parent=None)
+
+    def _estimate_background(self):
+        """
+        Estimates the background of the selected dataset by one of the BACKGROUND_ESTIMATORS, see
+        processing_background_removal.estimate_backgrounds().
+        """
+        dataset = self._find_dataset_by_name(self.selection_dataset_names, self.datasets, self.processed_datasets)
+        if dataset is None:
+            return
+        fitter = CurveFitter(self.curve_type, self.curve_order)
+        fitter.fit_curve(dataset)
+        dataset.fit_params = {'backType':self.curve_type, 'datasetName':dataset.name, 'width':self.curve_order}
+        self._add_background_fit(dataset, fitter.eval_curve(dataset.data[:, 0]))
+        self._plot_processed_datasets()
+
+    def _add_background_fit(self, dataset, background):
+        """
+        Attaches the background y values to the dataset as its 'fit (background)' dataset, and adds that to
+        the plotted datasets in place of any previous one.
+        """
+        if hasattr(dataset, 'background'):
+            background_fit = dataset.background
+        else:
+            background_fit = dataset.copy()
+            background_fit.metadata['ui'].name = dataset.name + ' fit (background)'
+            background_fit.metadata['ui'].color = None
+        background_fit.writable_data()[:, 1] = background
+
+        dataset.background = background_fit
+        existing_fit = self._find_dataset_by_uiname(dataset.name + ' fit (background)', self.datasets)
+        if existing_fit is not None:
+            self.datasets.remove(existing_fit)
+        self.datasets.append(background_fit)
+        self.background_fits.append(background_fit)
+        self.background_datasets.add(background_fit)
+        self.backgrounds_fitted = True
 
     def _bt_clear_fit_changed(self):
         """
         Removes the fitted background from the selected dataset and from the plot window
         """
-        d = self._find_dataset_by_name(self.selection_dataset_names, self.datasets + self.processed_datasets)
+        d = self._find_dataset_by_name(self.selection_dataset_names, self.datasets, self.processed_datasets)
         if hasattr(d, 'background') and re.search(r'fit \(background\)$', d.background.metadata['ui'].name) is not None:
             self.datasets.remove(d.background)
             self.background_datasets.remove(d.background)
@@ -815,13 +930,15 @@ class ControlPanel(HasTraits):
         """
         Exports the fitted background parameters for the currently selected dataset to a text file.
         """
-        dataset = self._find_dataset_by_name(self.selection_dataset_names, self.datasets + self.processed_datasets)
+        dataset = self._find_dataset_by_name(self.selection_dataset_names, self.datasets, self.processed_datasets)
         name = dataset.name.split(".")[0] + "_background_params.txt"
         filename = str(get_txt_filename(os.path.join(self.most_recent_path, name)))
         with file(filename, 'w') as outfile:
             outfile.write("Background Parameters\n")  # filename.write()
             outfile.write("Dataset name: " + dataset.fit_params['datasetName'] + "\n")
             outfile.write("Fit type: " + dataset.fit_params['backType'] + "\n")
+            if 'width' in dataset.fit_params:
+                outfile.write("Width: " + str(dataset.fit_params['width']) + "\n")
             nBak = 0
             while True:
                 key = 'Back:' + str(nBak)
@@ -923,25 +1040,7 @@ class ControlPanel(HasTraits):
         Populates the self.dataset_pairs list with all dataset partners in
         self.file_paths corresponding to the merge_positions radiobutton selection.
         """
-        matching_re = {'all':    ''            ,
-                       'p1+p2':  '_[pP][12]_'     ,
-                       'p3+p4':  '_[pP][34]_'     ,
-                       'p12+p34':'_[pP](?:12|34)_',
-                      }
-        basenames = [os.path.basename(f) for f in self.file_paths]
-        filtered_paths = [f for f in basenames if re.search(matching_re[self.merge_positions], f) is not None]
-        self.dataset_pairs = set()
-        for filebase in filtered_paths:
-            # base filename for the first position.
-            position_index = self._get_position(filebase)
-            if position_index is None:
-                return
-            other_filebase = re.sub(r"(_[pP])(\d+)(_)", self._repl, filebase)
-            if filebase in basenames and other_filebase in basenames:
-                if position_index != 12 and (position_index & 1) == 0:
-                    self.dataset_pairs.add((other_filebase, filebase))
-                else:
-                    self.dataset_pairs.add((filebase, other_filebase))
+        self.dataset_pairs = processing.find_dataset_pairs(self.file_paths, self.merge_positions)
         return self.dataset_pairs
 
     def _refresh_dataset_name_list(self):
@@ -957,32 +1056,79 @@ class ControlPanel(HasTraits):
         When the file dialog box is closed with a selection of filenames,
         just generate a list of all the filenames
         """
-        self.datasets = []
-        numfiles=len(self.file_paths[:])
+        self.datasets = DatasetCollection()
+        self._new_storage()
+        # self.file_paths is modified by _add_dataset_pair() so load from a copy of it.
+        numfiles = self._count_datasets(self.file_paths[:])
+        loaded_datasets = self._iter_datasets(self.file_paths[:])
         if numfiles>20:
             progress = ProgressDialog(title="progress", message="loading %d files."%numfiles, max=numfiles )
             progress.open()
-        # self.file_paths is modified by _add_dataset_pair() so iterate over a copy of it.
-            for i,filename in enumerate(self.file_paths[:]):
-                self._add_xye_dataset(filename)
-                (cont,skip)=progress.update(i)
+            for i,dataset in enumerate(loaded_datasets):
+                self._add_dataset(dataset)
+                (cont,skip)=progress.update(i+1)
                 if not cont or skip:
+                    # stops the remaining loads
+                    loaded_datasets.close()
                     break
             progress.update(numfiles)
         else:
-            for filename in self.file_paths[:]:
-                self._add_xye_dataset(filename)
+            for dataset in loaded_datasets:
+                self._add_dataset(dataset)
+        self._finish_loading()
         self._plot_datasets(self.datasets)
         self.datasets.sort(key=lambda d: d.name)
         self._refresh_normalise_to_list()
         self._refresh_dataset_name_list()
+        self._save_state()
+
+    def _count_datasets(self, file_paths):
+        """
+        Returns the number of datasets in the files, counting every dataset in a batch container.
+        """
+        count = 0
+        for file_path in file_paths:
+            if is_batch_container(file_path):
+                try:
+                    with BatchContainer(file_path) as container:
+                        count += len(container)
+                except IOError:
+                    pass
+            else:
+                count += 1
+        return count
+
+    def _iter_datasets(self, file_paths):
+        """
+        Yields the datasets loaded from the files, with the contents of any batch containers last.
+        The data files are parsed in parallel and the datasets arrive in file_paths order.
+        """
+        data_file_paths = [ p for p in file_paths if not is_batch_container(p) ]
+        loaded_datasets = XYEDataset.iter_from_files(data_file_paths)
+        try:
+            for dataset in loaded_datasets:
+                yield dataset
+        finally:
+            loaded_datasets.close()
+        for file_path in file_paths:
+            if is_batch_container(file_path):
+                try:
+                    container = BatchContainer(file_path)
+                except IOError:
+                    continue
+                with container:
+                    for dataset in container:
+                        yield dataset
 
     def _load_partners_changed(self):
         for filename in self.file_paths[:]:
             self._add_dataset_pair(filename)
+        self._finish_loading()
         self._plot_datasets(self.datasets)
         self.datasets.sort(key=lambda d: d.name)
         self._refresh_dataset_name_list()
+        self._update_processing_status()
+        self._save_state()
 
     def _plot_datasets(self, datasets, reset_view=True):
         datasets_to_plot = datasets[:]
@@ -1018,8 +1164,33 @@ class ControlPanel(HasTraits):
             dataset = XYEDataset.from_file(file_path)
         except IOError:
             return
+        return self._add_dataset(dataset, container)
+
+    def _finish_loading(self):
+        """
+        Maps the loaded datasets from memory-mapped storage or, if they share a grid,
+        packs them into a single block in name order (see dataset_collection.py).
+        """
+        if self.storage is not None:
+            self.storage.finish()
+        else:
+            DatasetCollection(sorted(self.datasets, key=lambda d: d.name)).pack()
+
+    def _new_storage(self):
+        """
+        Replaces the memory-mapped storage for loaded datasets, if enabled in settings.
+        """
+        if self.storage is not None:
+            self.storage.close()
+        self.storage = MemmapStorage() if settings.memmap_datasets else None
+
+    def _add_dataset(self, dataset, container=True):
+        if dataset is None:
+            return
         if container:
             self.datasets.append(dataset)
+            if self.storage is not None:
+                self.storage.append(dataset)
         create_datasetui(dataset)
         return dataset
 
@@ -1044,28 +1215,37 @@ class ControlPanel(HasTraits):
         xyzgen = XYZGenerator()
         datasets = list(set(self.datasets) - self.background_datasets)
         datasets.sort(key=lambda d: d.name)
-        xyzdata = xyzgen.process_data(datasets=datasets)
         defaultfilename = os.path.basename(self.file_paths[0]) # TODO stuff for fxye file option
-        defaultfilename = re.sub(r"_[pP][0-9]*[_nsmbgt]*_\d{4}.xye?", ".xyz", defaultfilename)
+        defaultfilename = re.sub(r"_[pP][0-9]*[_nsmwbgt]*_\d{4}.xye?", ".xyz", defaultfilename)
         filename = get_save_as_xyz_filename(directory=self.most_recent_path, filename=defaultfilename)
         if filename is not None:
-            write_to_file(filename, xyzdata)
+            # Stream the rows to the file rather than building the whole export in memory
+            write_to_file(filename, xyzgen.iter_chunks(datasets))
             # for i in range(len(xyzdata)):
             #    f.write('{0:f}\t{1:f}\t{2:f}\n'.format(xyzdata[i,0], xyzdata[i,1], xyzdata[i,2]))
 
-    def _find_dataset_by_name(self, name, datasets):
-            xs = [x for x in datasets if name == x.name]
-            return xs[0] if len(xs) > 0 else None
-
-    def _find_dataset_by_uiname(self, name, datasets):
-            xs = [x for x in datasets if name == x.metadata['ui'].name]
-            return xs[0] if len(xs) > 0 else None
+    def _find_dataset_by_name(self, name, *collections):
+        """
+        Returns the first dataset named <name> in the given DatasetCollections, or None.
+        """
+        for datasets in collections:
+            dataset = datasets.find_by_name(name)
+            if dataset is not None:
+                return dataset
+        return None
+
+    def _find_dataset_by_uiname(self, name, *collections):
+        for datasets in collections:
+            dataset = datasets.find_by_uiname(name)
+            if dataset is not None:
+                return dataset
+        return None
 
     def _bt_apply_transform_changed(self):
         """
         Applies a transform to all the selected dataset.
         """
-        dataset = self._find_dataset_by_name(self.transform_selected_dataset, self.datasets + self.processed_datasets)
+        dataset = self._find_dataset_by_name(self.transform_selected_dataset, self.datasets, self.processed_datasets)
         scaled_datasets = apply_transform(datasets=[dataset], x=self.x_offset, y=self.y_offset,
                                         x_multiplier=self.x_multiplier, y_multiplier=self.y_multiplier)
         for d in scaled_datasets:
@@ -1082,7 +1262,7 @@ class ControlPanel(HasTraits):
         """
         Crops dataset to within the range specified.
         """
-        dataset = self._find_dataset_by_name(self.transform_selected_dataset, self.datasets + self.processed_datasets)
+        dataset = self._find_dataset_by_name(self.transform_selected_dataset, self.datasets, self.processed_datasets)
         tdataset = dataset_already_transformed(dataset, self.processed_datasets)
         if tdataset is None:
             cropped_dataset = dataset.copy()
@@ -1138,7 +1318,7 @@ class ControlPanel(HasTraits):
         """
         varyList = []
         # varyList=[r'Back']
-        dataset = self._find_dataset_by_name(self.peak_select_dataset, self.datasets + self.processed_datasets)
+        dataset = self._find_dataset_by_name(self.peak_select_dataset, self.datasets, self.processed_datasets)
         self._set_basic_fit_params(dataset, 'select_peaks_params')
         # for d in datasets:
         limits = (dataset.data[0, 0], dataset.data[-1, 0])
@@ -1199,7 +1379,7 @@ class ControlPanel(HasTraits):
         This button allows for peaks to be selected at the positions given by the user, and fits the height, sigma etc.
         Operates only on the one dataset which is currently selected.
         """
-        dataset = self._find_dataset_by_name(self.peak_select_dataset, self.datasets + self.processed_datasets)
+        dataset = self._find_dataset_by_name(self.peak_select_dataset, self.datasets, self.processed_datasets)
 
         if self.select_peaks_button_label == "Select peaks":
             if not hasattr(dataset, 'select_peaks_params'):
@@ -1217,7 +1397,7 @@ class ControlPanel(HasTraits):
         """
         Clears all peaks for the dataset
         """
-        dataset = self._find_dataset_by_name(self.peak_select_dataset, self.datasets + self.processed_datasets)
+        dataset = self._find_dataset_by_name(self.peak_select_dataset, self.datasets, self.processed_datasets)
         if hasattr(dataset, 'select_peaks_params'):
             delattr(dataset, 'select_peaks_params')
             # dataset.select_peaks_params=None
@@ -1225,7 +1405,7 @@ class ControlPanel(HasTraits):
             self.raw_data_plot.remove_peak_labels(self.peak_labels)
             self.peak_labels = []
             self.peak_editor = None
-            peakfitdataset = self._find_dataset_by_uiname(dataset.metadata['ui'].name + ' (fitted peak profile)', self.datasets + self.processed_datasets)
+            peakfitdataset = self._find_dataset_by_uiname(dataset.metadata['ui'].name + ' (fitted peak profile)', self.datasets, self.processed_datasets)
             if peakfitdataset:
                 self.processed_datasets.remove(peakfitdataset)
             # remove peak fit dataset
@@ -1267,14 +1447,12 @@ class MainApp(HasTraits):
                                    (<XYEDataset-p1>, <XYEDataset-p2>) ])
         """
         super(MainApp, self).__init__(*args, **kws)
-        self.undo_state = None
         self.raw_data_plot = RawDataPlot()
         self.plot = self.raw_data_plot.get_plot()
         self.container = OverlayPlotContainer(self.plot,
                                               bgcolor="white", use_backbuffer=True,
                                               border_visible=False)
         self.panel = ControlPanel(self.container, self.raw_data_plot, self.plot)
-        self.panel.undo_state=self.undo_state
 
 
 
@@ -1342,4 +1520,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Needed for the process pool used to load files in frozen Windows builds
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,102 @@
+import heapq
+
+import numpy as np
+
+__doc__ = \
+"""
+Baselines over a selected window of a pattern.
+running_median() gives the same values as scipy.ndimage.median_filter(mode='nearest')
+but only for a range of output samples, reading just that range plus the filter's
+half-width on either side. It slides a pair of heaps along the data, so the cost is
+O((m + size) log size) for m outputs rather than the O(n size) of filtering the whole
+pattern, which for a 30000-point pattern and a filter length of 10000 is the
+difference between milliseconds and tens of seconds.
+"""
+
+MIN_FILTER_LENGTH = 20
+MAX_FILTER_LENGTH = 10000
+
+
+def baseline_filter_length(x, range_low, range_high):
+    """
+    Returns the median filter length used for the baseline under a peak between
+    range_low and range_high: 3x as many samples as the selection, limited to a sane
+    value.
+    """
+    filter_length = 3*int(len(x)*(range_high-range_low)/(x[-1]-x[0]))
+    filter_length = min(max(filter_length, MIN_FILTER_LENGTH), MAX_FILTER_LENGTH)
+    return max(1, min(filter_length, len(x)/2))
+
+
+def running_median(y, size, start=0, stop=None):
+    """
+    Returns scipy.ndimage.median_filter(y, size, mode='nearest')[start:stop], i.e. for
+    each sample i the element of rank size//2 among y[i-size//2 : i-size//2+size],
+    with the ends of y repeated beyond its ends.
+    """
+    y = np.asarray(y, dtype=np.double)
+    n = len(y)
+    start, stop, _ = slice(start, stop).indices(n)
+    m = stop - start
+    if m <= 0 or size < 1:
+        return np.empty(0)
+    # the samples under the filter for outputs start..stop-1
+    first = start - size//2
+    values = y[np.clip(np.arange(first, first + m + size - 1), 0, n - 1)].tolist()
+
+    # low is a max-heap of the size//2 smallest (value, index) entries in the window,
+    # high a min-heap of the rest; high[0] is then the median. Entries are unique, so
+    # those that have left the window are simply skipped when they reach the top.
+    rank = size//2
+    window = sorted((values[j], j) for j in xrange(size))
+    low = [ (-v, -j) for v, j in window[:rank] ]
+    heapq.heapify(low)
+    high = window[rank:]
+    n_low = rank
+    medians = np.empty(m)
+    medians[0] = high[0][0]
+    for t in xrange(1, m):
+        # remove sample t-1, add sample t+size-1
+        leaving = (values[t-1], t-1)
+        if leaving < high[0]:
+            n_low -= 1
+        entering = (values[t+size-1], t+size-1)
+        if high and entering >= high[0]:
+            heapq.heappush(high, entering)
+        else:
+            heapq.heappush(low, (-entering[0], -entering[1]))
+            n_low += 1
+        # rebalance, skipping entries that have left the window
+        while n_low > rank:
+            while -low[0][1] < t:
+                heapq.heappop(low)
+            v, j = heapq.heappop(low)
+            heapq.heappush(high, (-v, -j))
+            n_low -= 1
+        while n_low < rank:
+            while high[0][1] < t:
+                heapq.heappop(high)
+            heapq.heappush(low, tuple(-c for c in heapq.heappop(high)))
+            n_low += 1
+        while high[0][1] < t:
+            heapq.heappop(high)
+        while low and -low[0][1] < t:
+            heapq.heappop(low)
+        medians[t] = high[0][0]
+    return medians
+
+
+def window_baseline(x, y, range_low, range_high, filter_length=None):
+    """
+    Returns (x_range, baseline): the boolean mask of the samples of a pattern between
+    range_low and range_high, and the running median of y at those samples.
+    filter_length defaults to baseline_filter_length().
+    """
+    x_range = (x >= range_low) & (x <= range_high)
+    indices = np.flatnonzero(x_range)
+    if len(indices) == 0:
+        return x_range, np.empty(0)
+    if filter_length is None:
+        filter_length = baseline_filter_length(x, range_low, range_high)
+    medians = running_median(y, filter_length, indices[0], indices[-1] + 1)
+    return x_range, medians[indices - indices[0]]
@@ -0,0 +1,166 @@
+import re
+import json
+import zipfile
+from StringIO import StringIO
+from os.path import splitext
+
+import numpy as np
+
+from xye import XYEDataset
+from processing import get_descriptor
+
+__doc__ = \
+"""
+A single-file container for a whole batch of datasets, e.g. the processed results of a
+beamtime, as an alternative to hundreds of separate .xye and .parab files.
+The container is an uncompressed zip archive (readable by numpy.load() like an .npz
+file) holding each dataset's Nx3 array as a .npy member, plus an index.json member
+describing every dataset: its name, source, processing descriptor (see
+processing.insert_descriptor()) and its .parab metadata.
+Individual datasets are read without reading the rest of the file, using the zip
+archive's central directory.
+"""
+
+CONTAINER_EXTENSION = '.pdvz'
+FORMAT_NAME = 'pdviper-batch'
+FORMAT_VERSION = 1
+INDEX_MEMBER = 'index.json'
+
+# Metadata that belongs to the running application rather than the data
+_EXCLUDED_METADATA = ['ui', 'ui_w']
+
+
+def is_batch_container(filename):
+    return splitext(filename)[1].lower() == CONTAINER_EXTENSION
+
+
+def batch_filename(dataset_name):
+    """
+    Returns a container filename for a batch including the named dataset, with the
+    position, descriptor and sequence number removed, e.g. foo.pdvz for foo_p1_n_0001.xye.
+    """
+    filename = re.sub(r"_[pP][0-9]*[_nsmwbgt]*_\d{4}.xye?", CONTAINER_EXTENSION, dataset_name)
+    if filename == dataset_name:
+        filename = splitext(dataset_name)[0] + CONTAINER_EXTENSION
+    return filename
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _storable_metadata(metadata):
+    """
+    Returns the items of metadata that can be stored in the index as JSON.
+    """
+    stored = {}
+    for key, value in metadata.iteritems():
+        if key in _EXCLUDED_METADATA:
+            continue
+        try:
+            json.dumps(value, default=_json_default)
+        except (TypeError, ValueError):
+            continue
+        stored[key] = value
+    return stored
+
+
+def save_batch(filename, datasets):
+    """
+    Writes the datasets to a single batch container file.
+    """
+    entries = []
+    archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    try:
+        for i, dataset in enumerate(datasets):
+            member = 'data_{:05d}.npy'.format(i)
+            data = np.ascontiguousarray(dataset.data[:, :3], dtype=np.float64)
+            archive.writestr(member, _npy_bytes(data))
+            entries.append({
+                'name': dataset.name,
+                'source': dataset.source,
+                'descriptor': get_descriptor(dataset.name),
+                'member': member,
+                'points': data.shape[0],
+                'metadata': _storable_metadata(dataset.metadata),
+            })
+        index = {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'datasets': entries}
+        archive.writestr(INDEX_MEMBER, json.dumps(index, default=_json_default, indent=1))
+    finally:
+        archive.close()
+
+
+def _npy_bytes(data):
+    f = StringIO()
+    np.lib.format.write_array(f, data)
+    return f.getvalue()
+
+
+class BatchContainer(object):
+    """
+    Read access to a batch container. Only the index is read on opening; datasets are
+    read individually by position or name.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.archive = zipfile.ZipFile(filename, 'r')
+        except zipfile.BadZipfile:
+            raise IOError('{} is not a batch container'.format(filename))
+        try:
+            index = json.loads(self.archive.read(INDEX_MEMBER))
+        except (KeyError, ValueError):
+            self.archive.close()
+            raise IOError('{} is not a batch container'.format(filename))
+        if index.get('format') != FORMAT_NAME or index.get('version', 0) > FORMAT_VERSION:
+            self.archive.close()
+            raise IOError('Unsupported batch container format in {}'.format(filename))
+        self.entries = index['datasets']
+        self._positions = dict((e['name'], i) for i, e in reversed(list(enumerate(self.entries))))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def names(self):
+        return [ e['name'] for e in self.entries ]
+
+    def load(self, key):
+        """
+        Returns the dataset at position <key>, or named <key> if it is a string.
+        """
+        if isinstance(key, basestring):
+            key = self._positions[key]
+        entry = self.entries[key]
+        f = self.archive.open(entry['member'])
+        try:
+            data = np.lib.format.read_array(f)
+        finally:
+            f.close()
+        metadata = dict((str(k), v) for k, v in entry['metadata'].iteritems())
+        return XYEDataset(data, name=str(entry['name']), source=entry['source'],
+                          metadata=metadata)
+
+    def __iter__(self):
+        for i in xrange(len(self.entries)):
+            yield self.load(i)
+
+    def close(self):
+        self.archive.close()
+
+
+def load_batch(filename):
+    """
+    Returns a list of all the datasets in a batch container file.
+    """
+    with BatchContainer(filename) as container:
+        return list(container)
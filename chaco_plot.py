@@ -13,7 +13,7 @@ from chaco.function_image_data import FunctionImageData
 
 from chaco_output import PlotOutput
 from tools import ClickUndoZoomTool, PanToolWithHistory
-from processing import bin_data, regrid_data
+from processing import bin_data, regrid_arrays, regular_grid
 from base_plot import BasePlot
 from labels import get_value_scale_label
 import settings
@@ -347,16 +347,11 @@ class Surface2DPlot(ChacoPlot):
         stack = stack[:,column_mask][np.newaxis].reshape(xs.shape[0],-1,3)
 
         # regrid all rows - use an interval half that of the original interval to minimise interpolation errors
-        first_row = regrid_data(stack[0], start=xlow_expanded, end=xhigh_expanded, interval=interval/2)
-        new_stack = np.empty((xs.shape[0], first_row.shape[0], 3))
-        new_stack[0] = first_row
-        for i, stack_row in enumerate(stack[1:]):
-            new_stack[i+1] = regrid_data(stack_row, start=xlow_expanded, end=xhigh_expanded, interval=interval/2)
-
-        # new_stack is the regridded version so window it properly
-        xs = new_stack[:,:,0]
-        zs = new_stack[:,:,1]
-        mask = (xs[0]>=xlow) & (xs[0]<=xhigh)
+        new_xs = regular_grid(xlow_expanded, xhigh_expanded, interval/2)
+        zs, _ = regrid_arrays(stack, new_xs, workers=settings.regrid_threads)
+
+        # zs is the regridded version so window it properly
+        mask = (new_xs>=xlow) & (new_xs<=xhigh)
         zs = zs[:,mask].reshape(zs.shape[0],-1)
 
         YBINS = zs.shape[0]*10
@@ -1,12 +1,12 @@
 __author__ = 'jongl'
 # this file contains some rudimentary attempts at reading alternative data formats from other
-# detectors. The first attempt is the Bruker/Siemens V3 RAW format with others to come
+# detectors. The first attempt is the Bruker/Siemens RAW format (versions 1-3) with others to come
 
 # much of this code would be better served by using xylib which it is derived from.
 # However I didn't want to include too many other dependencies since it is written in c++
 # but has python wrappers.
 
-# currently does no error checking and will probably fail ungracefully
+# currently does little error checking and will probably fail ungracefully on corrupt files
 
 import struct
 import numpy
@@ -15,7 +15,7 @@ def read_header(f):
     head_string = f.read(4)
     if head_string == 'RAW1' and f.read(3) == '.01':
         return 'ver3'
-    elif head_string =='RAW':
+    elif head_string =='RAW ':
         return 'ver1'
     elif head_string =='RAW2':
         return 'ver2'
@@ -23,8 +23,42 @@ def read_header(f):
         return
 
 
-meta_tags_v3 = [
+# Version 1 files have no file header, just a sequence of ranges each with a 152 byte
+# header. The last field of each range header is non-zero if another range follows.
+# Ranges after the first may start with a repeat of the 'RAW ' marker.
+block_meta_tags_v1 = [
         # tag, num_bytes, seek offset,stuct_unpackformat
+        ('STEPS',4,0,'I'),
+        ('TIME_PER_STEP',4,0,'f'),
+        ('STEP_SIZE',4,0,'f'),
+        ('SCAN_MODE',4,0,'I'),
+        ('START_2THETA',4,4,'f'),
+        ('START_THETA',4,0,'f'),
+        ('KHI_START',4,0,'f'),
+        ('PHI_START',4,0,'f'),
+        ('SAMPLE_NAME',32,0,'s'),
+        ('ALPHA1',4,0,'f'),
+        ('ALPHA2',4,0,'f'),
+        ('following_range',4,72,'I')]
+
+meta_tags_v2 = [
+        ('range_cnt',2,0,'H'),
+        ('MEASURE_DATE_TIME',20,162,'s'),
+        ('ANODE_MATERIAL',2,0,'s'),
+        ('ALPHA1',4,0,'f'),
+        ('ALPHA2',4,0,'f'),
+        ('ALPHA_RATIO',4,0,'f'),
+        ('measurement time',4,8,'f')]
+
+block_meta_tags_v2 = [
+        ('header_len',2,0,'H'),
+        ('STEPS',2,0,'H'),
+        ('TIME_PER_STEP',4,4,'f'),
+        ('STEP_SIZE',4,0,'f'),
+        ('START_2THETA',4,0,'f'),
+        ('TEMP_IN_K',2,26,'H')]
+
+meta_tags_v3 = [
         ('file status', 4, 1, 'I'),
         ('range_cnt', 4,0,'I'),
         ('MEASURE_DATE', 10, 0,'s'),
@@ -64,51 +98,115 @@ def read_meta(tag_set, f):
         if seek_offset!=0:
             f.seek(seek_offset,1)# go seek_offset number of bytes forward from current position
         data = f.read(num_bytes)
+        # RAW files are little-endian regardless of the platform
         if unpack_format=='s':
-            data = struct.unpack(str(num_bytes)+unpack_format,data)
+            data = struct.unpack('<'+str(num_bytes)+unpack_format,data)
             meta[name]=data[0].strip('\x00')
         else:
-            data = struct.unpack(unpack_format,data)
+            data = struct.unpack('<'+unpack_format,data)
             meta[name]=data[0]
     return meta
 
 def read_block_data(start_theta,steps, step_size,f):
-    pairs=[]
-    end_theta=start_theta+steps*step_size
-    theta=start_theta
-    theta_range=numpy.arange(start_theta,end_theta,step_size)
-    data_range=numpy.empty_like(theta_range)
-    for i, theta in numpy.ndenumerate(theta_range):
-        tmp_data=f.read(4)
-        data_range[i] = struct.unpack('f',tmp_data)[0]
-    stack= numpy.vstack((theta_range,data_range))
-    stack = numpy.swapaxes(stack,0,1)
-    return numpy.hstack((stack,numpy.zeros((theta_range.shape[0],1))))
+    """
+    Reads a block of <steps> little-endian float32 intensities from the current
+    position of f in a single read and returns them as an Nx3 xye array with the
+    2theta values generated from the start and step size. A truncated block is
+    returned with as many steps as the file contains.
+    """
+    intensities = numpy.frombuffer(f.read(4*steps), dtype='<f4')
+    data = numpy.zeros((intensities.shape[0], 3))
+    data[:,0] = start_theta + step_size*numpy.arange(intensities.shape[0])
+    data[:,1] = intensities
+    return data
+
+def combine_blocks(blocks, meta):
+    """
+    Concatenates the per-range data blocks into a single Nx3 array. The index of the
+    first sample of each range, followed by the total number of samples, is recorded
+    in meta['range_boundaries'] so the ranges can be recovered with split_ranges().
+    """
+    boundaries = numpy.cumsum([0] + [len(b) for b in blocks])
+    meta['range_boundaries'] = boundaries.tolist()
+    if not blocks:
+        return numpy.zeros((0, 3)), meta
+    return numpy.vstack(blocks), meta
+
+def split_ranges(data, meta):
+    """
+    Returns a list containing a separate Nx3 array for each range in a RAW file.
+    """
+    boundaries = meta.get('range_boundaries', [0, len(data)])
+    return [data[start:stop] for start, stop in zip(boundaries[:-1], boundaries[1:])]
 
 def read_data_ver1(f):
-    pass
+    meta = {}
+    blocks = []
+    following_range = 1
+    r = 0
+    while following_range:
+        if len(f.read(1)) == 0:
+            break
+        f.seek(-1, 1)
+        # early DIFFRAC-AT versions didn't repeat the marker on the following ranges
+        if r > 0 and f.read(4) != 'RAW ':
+            f.seek(-4, 1)
+        block_meta = read_meta(block_meta_tags_v1, f)
+        meta["block{}".format(r)] = block_meta
+        blocks.append(read_block_data(block_meta['START_2THETA'], block_meta['STEPS'],
+                                      block_meta['STEP_SIZE'], f))
+        following_range = block_meta['following_range']
+        r += 1
+    meta['range_cnt'] = r
+    return combine_blocks(blocks, meta)
 
 def read_data_ver2(f):
-    pass
+    meta = read_meta(meta_tags_v2, f)
+    blocks = []
+    block_start = 256
+    for r in range(meta['range_cnt']):
+        f.seek(block_start)
+        block_meta = read_meta(block_meta_tags_v2, f)
+        meta["block{}".format(r)] = block_meta
+        f.seek(block_start + block_meta['header_len'])
+        blocks.append(read_block_data(block_meta['START_2THETA'], block_meta['STEPS'],
+                                      block_meta['STEP_SIZE'], f))
+        block_start += block_meta['header_len'] + 4*block_meta['STEPS']
+    return combine_blocks(blocks, meta)
 
 
 def read_data_ver3(f):
     meta=read_meta(meta_tags_v3,f)
     range_cnt=meta['range_cnt']
-    f.seek(712)
+    blocks = []
+    block_start = 712
     for r in range(range_cnt):
+        f.seek(block_start)
         block_meta=read_meta(block_meta_tags_v3,f)
         meta["block{}".format(r)]=block_meta
-        f.seek(712+304*(1+r))
+        # the data follows the block header and any supplementary headers
+        data_start = block_start + block_meta['header_len'] + block_meta['supplementary_headers_size']
+        f.seek(data_start)
         start2T=block_meta['START_2THETA']
         steps=block_meta['STEPS']
         stepsize=block_meta['STEP_SIZE']
-        block_data=read_block_data(start2T,steps,stepsize,f)
-    return block_data,meta
+        blocks.append(read_block_data(start2T,steps,stepsize,f))
+        block_start = data_start + 4*steps
+    return combine_blocks(blocks, meta)
 
 
 def read_raw(filename):
-    f=open(filename, 'rb')
-    file_format=read_header(f)
-    xy_data,meta_data=read_data_ver3(f)
-    return xy_data,meta_data
\ No newline at end of file
+    """
+    Reads a Bruker/Siemens RAW file (versions 1, 2 and 3) and returns a tuple of the
+    Nx3 xye data of all ranges concatenated and the metadata dict.
+    Raises IOError if the file isn't a recognised RAW file.
+    """
+    readers = {'ver1': read_data_ver1,
+               'ver2': read_data_ver2,
+               'ver3': read_data_ver3}
+    with open(filename, 'rb') as f:
+        file_format=read_header(f)
+        if file_format not in readers:
+            raise IOError('{} is not a recognised Bruker RAW file'.format(filename))
+        xy_data,meta_data=readers[file_format](f)
+    return xy_data,meta_data
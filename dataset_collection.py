@@ -0,0 +1,144 @@
+import numpy as np
+
+__doc__ = \
+"""
+A list of XYEDatasets with constant time lookup by name and by UI name, and columnar
+storage for datasets measured on a common 2theta grid.
+When every dataset in a collection shares the same x values, pack() copies their data
+into a single contiguous MxNx3 block and rebinds each XYEDataset.data to a view of its
+row. The existing x()/y()/e() accessors keep working, while stacking, normalisation and
+other whole-collection operations become single array operations on the block.
+Datasets on differing grids are left as independent (ragged) arrays.
+"""
+
+
+class DatasetCollection(list):
+    """
+    Behaves as a list of XYEDatasets. The name indexes are rebuilt lazily after the
+    list is modified or when a dataset has been renamed since the last lookup.
+    """
+    def __init__(self, datasets=()):
+        super(DatasetCollection, self).__init__(datasets)
+        self._names = None
+        self._uinames = None
+
+    def _invalidate(self):
+        self._names = None
+        self._uinames = None
+
+    def _mutator(name):
+        method = getattr(list, name)
+        def mutate(self, *args):
+            self._invalidate()
+            return method(self, *args)
+        mutate.__name__ = name
+        return mutate
+
+    for _name in ['append', 'extend', 'insert', 'remove', 'pop', 'sort', 'reverse',
+                  '__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__']:
+        locals()[_name] = _mutator(_name)
+    del _name, _mutator
+
+    def __getslice__(self, i, j):
+        return DatasetCollection(list.__getslice__(self, i, j))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DatasetCollection(list.__getitem__(self, index))
+        return list.__getitem__(self, index)
+
+    def __add__(self, other):
+        return DatasetCollection(list.__add__(self, list(other)))
+
+    def __reduce__(self):
+        return (DatasetCollection, (list(self),))
+
+    def find_by_name(self, name):
+        """
+        Returns the dataset with the given name, or None.
+        """
+        dataset = self._names.get(name) if self._names is not None else None
+        if dataset is None or dataset.name != name:
+            self._names = {}
+            for d in reversed(self):
+                self._names[d.name] = d
+            dataset = self._names.get(name)
+        return dataset
+
+    def find_by_uiname(self, name):
+        """
+        Returns the dataset whose dataset editor name is <name>, or None.
+        """
+        dataset = self._uinames.get(name) if self._uinames is not None else None
+        if dataset is None or _uiname(dataset) != name:
+            self._uinames = {}
+            for d in reversed(self):
+                self._uinames[_uiname(d)] = d
+            dataset = self._uinames.get(name)
+        return dataset
+
+    def shared_grid(self):
+        """
+        Returns the x values common to all datasets, or None if they differ.
+        """
+        if not self:
+            return None
+        x = self[0].data[:,0]
+        for dataset in self[1:]:
+            if not np.array_equal(dataset.data[:,0], x):
+                return None
+        return x
+
+    def pack(self):
+        """
+        If all datasets share a grid, copies their data into one contiguous MxNx3 block
+        and makes each dataset's data a view of its row. Returns the block, or None if
+        the datasets are ragged and were left untouched.
+        """
+        if self.shared_grid() is None:
+            return None
+        block = np.empty((len(self),) + self[0].data[:,:3].shape)
+        for i, dataset in enumerate(self):
+            block[i] = dataset.data[:,:3]
+            dataset.data = block[i]
+        return block
+
+    def stack(self, active_only=True):
+        """
+        Returns an MxNx3 array of the datasets' data, see processing.stack_datasets().
+        """
+        from processing import stack_datasets
+        return stack_datasets(self, active_only)
+
+
+def _uiname(dataset):
+    ui = dataset.metadata.get('ui')
+    return ui.name if ui is not None else None
+
+
+def packed_stack(arrays):
+    """
+    Returns an MxNx3 array of the Nx3 arrays if they are all rows of the same packed
+    block (see DatasetCollection.pack()), otherwise None. The result is a view of the
+    block when the arrays are consecutive rows in order and a single fancy-indexed copy
+    otherwise.
+    """
+    if not arrays:
+        return None
+    block = arrays[0].base
+    if not isinstance(block, np.ndarray) or block.ndim != 3 or not block.flags.c_contiguous:
+        return None
+    row_bytes = block.strides[0]
+    rows = np.empty(len(arrays), dtype=int)
+    for i, a in enumerate(arrays):
+        if a.base is not block or a.shape != block.shape[1:]:
+            return None
+        offset, remainder = divmod(a.ctypes.data - block.ctypes.data, row_bytes)
+        if remainder:
+            return None
+        rows[i] = offset
+    if np.all(np.diff(rows) == 1):
+        view = block[rows[0]:rows[-1] + 1]
+        view.flags.writeable = False
+        return view
+    return block[rows]
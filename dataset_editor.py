@@ -21,6 +21,9 @@ class DatasetUI(HasTraits):
     marker_size = Float(1.0)
     line_width = Float(1.0)
     dataset = Instance(object)
+    # whether the processed datasets made from this one are current, see
+    # DatasetProcessor.pair_signature()
+    up_to_date = Bool(False)
 
     traits_view = View(
         Item('name'),
@@ -72,6 +75,7 @@ class DatasetEditor(HasTraits):
             CheckboxColumn(name='markers'),
             DatasetColumn(name='marker_size'),
             DatasetColumn(name='line_width'),
+            CheckboxColumn(name='up_to_date', label='Up to date', editable=False),
         ]
                                  
     )
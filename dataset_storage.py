@@ -0,0 +1,133 @@
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+import settings
+
+__doc__ = \
+"""
+Memory-mapped storage for the data arrays of large numbers of datasets.
+The Nx3 arrays of all datasets added to a MemmapStorage are written one after another
+into a single file on disk, after which each XYEDataset.data becomes a view into the
+memory-mapped file. The operating system then pages data in as processing and plotting
+touch it, rather than every pattern being held in RAM.
+Datasets that are added consecutively and have equal lengths can be stacked into a
+3D array for plotting without copying, see stacked_view().
+"""
+
+# All live storages, used by stacked_view() to recognise views into a storage
+_storages = weakref.WeakValueDictionary()
+
+
+class MemmapStorage(object):
+    def __init__(self, filename=None, flush_size=64*1024*1024):
+        """
+        <filename> is the backing file, which is overwritten. If None, a temporary file
+        is created in settings.memmap_directory and removed by close().
+        Datasets are written out and remapped once <flush_size> bytes of them are
+        pending, bounding the memory held while loading.
+        """
+        self.temporary = filename is None
+        if self.temporary:
+            fd, filename = tempfile.mkstemp(suffix='.xyedata', prefix='pdviper_',
+                                            dir=settings.memmap_directory)
+            os.close(fd)
+        self.filename = filename
+        self.file = open(filename, 'w+b')
+        self.flush_size = flush_size
+        self.rows = 0
+        self.array = None
+        self.extents = []           # (dataset, start row, stop row) for each dataset
+        self._pending = []
+        self._pending_size = 0
+        _storages[id(self)] = self
+
+    def append(self, dataset):
+        """
+        Writes the dataset's data to the storage file. dataset.data is replaced by a
+        view into the file once the storage is next mapped.
+        """
+        data = np.ascontiguousarray(dataset.data[:, :3], dtype=np.float64)
+        self.file.seek(0, os.SEEK_END)
+        data.tofile(self.file)
+        extent = (dataset, self.rows, self.rows + data.shape[0])
+        self.rows += data.shape[0]
+        self.extents.append(extent)
+        self._pending.append(extent)
+        self._pending_size += data.nbytes
+        if self._pending_size >= self.flush_size:
+            self._map(self._pending)
+        return dataset
+
+    def extend(self, datasets):
+        for dataset in datasets:
+            self.append(dataset)
+
+    def finish(self):
+        """
+        Maps the whole file and rebinds every dataset's data to a view of it.
+        Call this once all datasets have been appended.
+        """
+        self._map(self.extents)
+
+    def _map(self, extents):
+        self.file.flush()
+        if self.rows > 0:
+            self.array = np.memmap(self.filename, dtype=np.float64, mode='r+',
+                                   shape=(self.rows, 3))
+            for dataset, start, stop in extents:
+                dataset.data = self.array[start:stop]
+        self._pending = []
+        self._pending_size = 0
+
+    def stack(self, arrays):
+        """
+        Returns a read-only MxNx3 view of the arrays if they are views of this storage's
+        mapped array covering consecutive rows with equal lengths, otherwise None.
+        """
+        if self.array is None or not arrays:
+            return None
+        length = arrays[0].shape[0]
+        if length == 0:
+            return None
+        row_bytes = self.array.strides[0]
+        base_address = self.array.ctypes.data
+        start = None
+        for i, a in enumerate(arrays):
+            if a.base is not self.array or a.shape != (length, 3):
+                return None
+            offset = (a.ctypes.data - base_address)/row_bytes
+            if start is None:
+                start = offset
+            elif offset != start + i*length:
+                return None
+        view = self.array[start:start + len(arrays)*length].reshape(len(arrays), length, 3)
+        view.flags.writeable = False
+        return view
+
+    def close(self):
+        """
+        Closes the storage file and, for a temporary storage, tries to remove it.
+        On Windows the file can't be removed while datasets still reference it.
+        """
+        _storages.pop(id(self), None)
+        self.file.close()
+        if self.temporary:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+
+
+def stacked_view(arrays):
+    """
+    Returns a zero-copy MxNx3 stack of the Nx3 arrays if they are consecutive, equal
+    length views into a MemmapStorage, otherwise None.
+    """
+    for storage in _storages.values():
+        view = storage.stack(arrays)
+        if view is not None:
+            return view
+    return None
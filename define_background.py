@@ -50,7 +50,7 @@ class MyLineDrawer(LineSegmentTool):
         # now evaluate the spline at each of the x points for the data
         # this dataset is merely for display, for subtracting we use the fitter and evaluate for each dataset for subtraction again
         self.background_manual.metadata=deepcopy(self.datasets[0].metadata)
-        self.background_manual.data[:,1] = self.curve_fitter.eval_curve(self.background_manual.data[:,0])
+        self.background_manual.writable_data()[:,1] = self.curve_fitter.eval_curve(self.background_manual.data[:,0])
         self.background_manual.metadata['ui'].name = 'fit (manual background)'   
         self.background_manual.metadata['ui'].color=None   
         self.background_manual.fitted=True 
@@ -48,20 +48,23 @@ def get_filelist(base_dir):
         files.extend(wanted_files)
     return files
 
-def load_all_params():
-    files = get_filelist('.')
+def load_all_params(base_dir='.'):
+    """
+    Returns a (keys, params_list) tuple for all the .parab files under base_dir, where
+    keys is the sorted union of their parameter names and params_list has a row for
+    each file, in get_filelist() order, of the file's value for each key or None.
+    For repeated queries over large directories use parab_catalogue.ParabCatalogue,
+    which only reparses changed files.
+    """
+    files = get_filelist(base_dir)
     params_per_file = [ load_params(fn) for fn in files ]
-    print params_per_file
-
-    for p in params_per_file:
-        print p
 
     keys = set()
     for params in params_per_file:
         keys = keys.union(set(params.keys()))
+    keys = sorted(keys)
 
     params_list = []
-    for key in keys:
-        for params in params_per_file:
-            params.get(key, None)
-
+    for params in params_per_file:
+        params_list.append([ params.get(key, None) for key in keys ])
+    return keys, params_list
@@ -0,0 +1,192 @@
+import os
+import re
+import sqlite3
+
+import logger
+from parab import load_params
+
+__doc__ = \
+"""
+A persistent, indexed catalogue of the metadata in .parab files.
+scan() walks a data directory and parses only the .parab files that are new or whose
+size or modification time has changed since the last scan, storing the key/value pairs
+in an SQLite database. query() then selects files by metadata value without opening
+any of them, e.g. all p1 files with more than 30000 ion chamber counts, sorted by
+temperature:
+
+    catalogue = ParabCatalogue()
+    catalogue.scan('/beamline/data/user')
+    catalogue.query(position='p1', where=[('Ion_Chamber_Raw_Counts', '>', 30000)],
+                    order_by='Cryo_Temperature_(K)')
+
+Keys may be given as they appear in the .parab file or as returned by
+parab.load_params(), i.e. with underscores or spaces.
+"""
+
+CATALOGUE_FILENAME = os.path.join(logger.LOG_DIRECTORY, 'parab_catalogue.sqlite')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    position TEXT
+);
+CREATE TABLE IF NOT EXISTS params (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    num REAL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS params_by_number ON params (key, num);
+CREATE INDEX IF NOT EXISTS params_by_text ON params (key, text);
+CREATE INDEX IF NOT EXISTS params_by_file ON params (file_id, key);
+CREATE INDEX IF NOT EXISTS files_by_position ON files (position);
+"""
+
+_OPERATORS = ['<', '<=', '=', '!=', '>', '>=', 'like']
+
+
+def _key(name):
+    return name.replace('_', ' ')
+
+
+def _position(path):
+    """
+    Returns the detector position of a filename, e.g. 'p1' for foo_p1_0001.parab.
+    """
+    m = re.search(r'_[pP](\d+)_', os.path.basename(path))
+    return 'p' + m.group(1) if m else None
+
+
+class ParabCatalogue(object):
+    def __init__(self, filename=CATALOGUE_FILENAME):
+        """
+        <filename> is the SQLite database, created if necessary. Use ':memory:' for a
+        catalogue that isn't kept between sessions.
+        """
+        if filename != ':memory:':
+            directory = os.path.dirname(filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def scan(self, base_dir):
+        """
+        Brings the catalogue up to date with the .parab files under base_dir.
+        Returns a (parsed, removed) tuple of the numbers of files (re)parsed and of
+        catalogued files that no longer exist.
+        """
+        base_dir = os.path.abspath(base_dir)
+        db = self.connection
+        known = {}
+        prefix = os.path.join(base_dir, '')
+        for file_id, path, size, mtime in db.execute(
+                'SELECT id, path, size, mtime FROM files WHERE substr(path, 1, ?) = ?',
+                (len(prefix), prefix)):
+            known[path] = (file_id, size, mtime)
+        parsed = 0
+        with db:
+            for dirpath, dirnames, filenames in os.walk(base_dir):
+                for fn in filenames:
+                    if not fn.endswith('.parab'):
+                        continue
+                    path = os.path.join(dirpath, fn)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entry = known.pop(path, None)
+                    if entry is not None and entry[1:] == (st.st_size, st.st_mtime):
+                        continue
+                    try:
+                        params = load_params(path)
+                    except IOError:
+                        continue
+                    if entry is not None:
+                        db.execute('DELETE FROM files WHERE id = ?', (entry[0],))
+                    self._insert(path, st.st_size, st.st_mtime, params)
+                    parsed += 1
+            # Whatever wasn't seen has been deleted or moved
+            for file_id, _, _ in known.itervalues():
+                db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+        return parsed, len(known)
+
+    def _insert(self, path, size, mtime, params):
+        cursor = self.connection.execute(
+            'INSERT INTO files (path, size, mtime, position) VALUES (?, ?, ?, ?)',
+            (path, size, mtime, _position(path)))
+        file_id = cursor.lastrowid
+        rows = []
+        for key, value in params.iteritems():
+            if isinstance(value, (int, long, float)):
+                rows.append((file_id, _key(key), value, None))
+                continue
+            text = str(value).strip()
+            # values of 'key = value' lines are strings, but may well be numbers
+            try:
+                num = float(text)
+            except ValueError:
+                num = None
+            rows.append((file_id, _key(key), num, text))
+        self.connection.executemany(
+            'INSERT INTO params (file_id, key, num, text) VALUES (?, ?, ?, ?)', rows)
+
+    def query(self, position=None, where=(), order_by=None, descending=False, limit=None):
+        """
+        Returns the paths of the catalogued .parab files matching all the conditions.
+        <position> selects files by detector position, e.g. 'p1'.
+        <where> is a list of (key, operator, value) conditions, where operator is one of
+        <, <=, =, !=, >, >= or like. Numeric values are compared with numeric parameters
+        and strings with text parameters.
+        <order_by> is a key to sort by; files without that key sort first.
+        """
+        joins = []
+        conditions = []
+        args = []
+        for i, (key, op, value) in enumerate(where):
+            if op not in _OPERATORS:
+                raise ValueError('Unknown operator {}'.format(op))
+            column = 'num' if isinstance(value, (int, long, float)) else 'text'
+            joins.append('JOIN params w{0} ON w{0}.file_id = f.id AND w{0}.key = ? '
+                         'AND w{0}.{1} {2} ?'.format(i, column, op))
+            args.extend([_key(key), value])
+        if order_by is not None:
+            joins.append('LEFT JOIN params o ON o.file_id = f.id AND o.key = ?')
+            args.append(_key(order_by))
+        if position is not None:
+            conditions.append('f.position = ?')
+            args.append(position)
+        sql = 'SELECT f.path FROM files f ' + ' '.join(joins)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        direction = ' DESC' if descending else ''
+        if order_by is not None:
+            sql += ' ORDER BY o.num{0}, o.text{0}, f.path'.format(direction)
+        else:
+            sql += ' ORDER BY f.path'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        return [ row[0] for row in self.connection.execute(sql, args) ]
+
+    def params(self, path):
+        """
+        Returns the catalogued parameters of a .parab file as a dictionary, as
+        parab.load_params() would except that all numbers are floats and keys have
+        spaces in place of underscores.
+        """
+        rows = self.connection.execute(
+            'SELECT p.key, p.num, p.text FROM params p JOIN files f ON p.file_id = f.id '
+            'WHERE f.path = ?', (os.path.abspath(path),))
+        return dict((str(key), num if text is None else str(text)) for key, num, text in rows)
+
+    def keys(self):
+        return [ str(row[0]) for row in self.connection.execute(
+            'SELECT DISTINCT key FROM params ORDER BY key') ]
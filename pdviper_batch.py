@@ -0,0 +1,164 @@
+import os
+import re
+import sys
+import glob
+import argparse
+import multiprocessing
+
+import processing
+from processing import DatasetProcessor, MERGE_POSITIONS, DEFAULT_REGRID_INTERVAL
+from xye import XYEDataset
+from xye_writer import save_datasets
+from batch_container import save_batch, batch_filename
+
+__doc__ = \
+"""
+Headless batch processing of .xye data series, for running the merge pipeline unattended,
+e.g. over a whole beamtime on a compute node:
+
+    python pdviper_batch.py /data/beamtime/ --positions p1+p2 --merge --regrid -o merged/
+
+The options mirror those of the Process tab in the GUI. This module must not import
+chaco, enable, pyface, traitsui or PySide, so it runs without a display.
+Pairs of positions are processed in parallel by a pool of processes.
+"""
+
+DATA_EXTENSIONS = ['.xye', '.xy', '.raw']
+
+
+def find_input_files(inputs):
+    """
+    Returns the sorted data files given by a list of filenames, directories and glob
+    patterns. Directories contribute the data files directly inside them.
+    """
+    filenames = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths = [ os.path.join(pattern, fn) for fn in os.listdir(pattern) ]
+        else:
+            paths = glob.glob(pattern)
+        filenames.update(os.path.abspath(p) for p in paths
+                         if os.path.isfile(p) and os.path.splitext(p)[1].lower() in DATA_EXTENSIONS)
+    return sorted(filenames)
+
+
+def default_normalisation_reference(filenames):
+    """
+    Returns the first entry of the GUI's "Normalise to" list: the lowest position found
+    in the filenames, or else the first file.
+    """
+    positions = set()
+    for f in filenames:
+        m = re.search('_(p[1-4])_', os.path.basename(f))
+        if m:
+            positions.add(m.group(1))
+    if positions:
+        return sorted(positions)[0]
+    return os.path.basename(filenames[0]) if filenames else None
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description='Batch process powder diffraction data series without the GUI.')
+    parser.add_argument('inputs', nargs='+',
+                        help='data files, directories or glob patterns (quote them)')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='directory for the processed files (default: current directory)')
+    parser.add_argument('-p', '--positions', choices=MERGE_POSITIONS, default='p1+p2',
+                        help='detector positions to pair up and process (default: p1+p2)')
+    parser.add_argument('--no-splice', dest='splice', action='store_false',
+                        help="don't splice pairs")
+    parser.add_argument('--merge', action='store_true', help='merge pairs')
+    parser.add_argument('--weighted-merge', action='store_true',
+                        help='merge pairs by binning onto the regrid interval with '
+                             'inverse-variance weights')
+    parser.add_argument('--no-normalise', dest='normalise', action='store_false',
+                        help="don't normalise to the beam intensity")
+    parser.add_argument('--normalise-to', metavar='REFERENCE',
+                        help='position (p1-p4) or file to normalise to '
+                             '(default: the lowest position present)')
+    parser.add_argument('--correction', type=float, default=0.0,
+                        help='zero correction added to 2theta (degrees)')
+    parser.add_argument('--align', nargs=2, type=float, metavar=('LOW', 'HIGH'),
+                        help='align each pair on the peak fitted between these 2theta values')
+    parser.add_argument('--align-method', choices=processing.ALIGNMENT_METHODS, default='fit',
+                        help='align by fitting the peak, or by cross-correlating the range '
+                             '(much faster for many files) (default: fit)')
+    parser.add_argument('--regrid', action='store_true',
+                        help='also output the processed data on a regular grid')
+    parser.add_argument('--regrid-interval', type=float, default=DEFAULT_REGRID_INTERVAL,
+                        help='2theta interval of the regular grid (default: %(default)s)')
+    parser.add_argument('-f', '--format', choices=['xye', 'fxye', 'pdvz'], default='xye',
+                        help='output format; pdvz writes one batch container (default: xye)')
+    parser.add_argument('-j', '--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the cache of parsed data files")
+    return parser
+
+
+def run(options):
+    """
+    Loads, processes and saves the datasets as described by the parsed command line
+    options. Returns the list of files written.
+    """
+    if options.no_cache:
+        # Seen by the loading worker processes too, see xye_cache.default_cache()
+        os.environ['PDVIPER_NO_CACHE'] = '1'
+    filenames = find_input_files(options.inputs)
+    if not filenames:
+        raise IOError('No data files found')
+    datasets = XYEDataset.from_files(filenames, options.workers)
+    datasets.sort(key=lambda d: d.name)
+
+    reference = options.normalise_to or default_normalisation_reference(filenames)
+    processor = DatasetProcessor(options.normalise, options.correction,
+                                 options.align is not None,
+                                 options.splice, options.merge, options.regrid,
+                                 reference, datasets,
+                                 regrid_interval=options.regrid_interval,
+                                 merge_by_binning=options.weighted_merge)
+    if options.positions == 'all':
+        processed = processor.process('all')
+    else:
+        datasets_dict = dict([ (d.name, d) for d in datasets ])
+        pairs = sorted(processing.find_dataset_pairs(datasets_dict.keys(), options.positions))
+        dataset_pairs = [ (datasets_dict[f1], datasets_dict[f2]) for f1, f2 in pairs ]
+        if options.align is not None:
+            low, high = options.align
+            if options.align_method == 'xcorr':
+                processing.align_pairs_by_cross_correlation(low, high, dataset_pairs)
+            else:
+                processing.fit_peaks_for_dataset_pairs(low, high, dataset_pairs, options.normalise)
+        processed = processor.process(options.positions, dataset_pairs, options.workers)
+
+    if not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+    if not processed:
+        return []
+    if options.format == 'pdvz':
+        filename = os.path.join(options.output_dir, batch_filename(processed[0].name))
+        save_batch(filename, processed)
+        return [filename]
+    if options.format == 'fxye':
+        names = [ d.name.split('.')[0] + '.fxye' for d in processed ]
+    else:
+        names = [ d.name for d in processed ]
+    filenames = [ os.path.join(options.output_dir, name) for name in names ]
+    return save_datasets(zip(processed, filenames), fxye=(options.format == 'fxye'))
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    try:
+        written = run(options)
+    except IOError as e:
+        print >> sys.stderr, 'pdviper_batch: {}'.format(e)
+        return 1
+    print 'Wrote {} file(s) to {}'.format(len(written), os.path.abspath(options.output_dir))
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -115,13 +115,13 @@ class PeakFitEditorHandler(Handler):
             background_fit.metadata['ui'].name = dataset.name+' fit (background)'
             background_fit.metadata['ui'].color=None  
             dataset.background=background_fit
-        dataset.background.data[:,1]=background  
+        dataset.background.writable_data()[:,1]=background  
         dataset.select_peaks_params.update(new_params)
         # update the peaks list
         newPeaks=updatePeakRows(new_params,info.object.selected.peaks)
         #newPeaks=createPeakRows(new_params)
         info.object.selected.peaks=newPeaks
-        info.object.peak_profile.data[:,1]=peak_profile
+        info.object.peak_profile.writable_data()[:,1]=peak_profile
       
       
     def do_save(self,info):
@@ -4,10 +4,14 @@ import numpy as np
 
 import scipy.interpolate as si
 import scipy.optimize as so
+import scipy.sparse as sp
 
 import copy
+import time
+from multiprocessing import Pool, cpu_count
 import numpy.ma as ma
 import gsas_routines as gsas
+from processing import strip_dataset
 from traits.api import HasTraits, Int, Float, Bool
 from traitsui.api import View,Group,Item
 import itertools                  
@@ -133,9 +137,11 @@ def autosearch_peaks(dataset,limits,params):
             iPeak+=1
         return createPeakRows(params)
     
-def fit_peaks_background(peaksList,varyListRegx,dataset,background_file,params):  
+def fit_peaks_background(peaksList,varyListRegx,dataset,background_file,params,stats=None):  
     """
     Performs a fit on the y axis of the dataset, varying the peak parameters given by varyListRegx
+    If given, the dictionary stats is updated with the fit's Rwp, chisq, GOF and nfev, and
+    the esds of the varied parameters by name, which are NaN if the matrix was singular.
     """
     bakType=params['backType']
     varyList=[]# get the list of parameters to vary   
@@ -161,47 +167,124 @@ def fit_peaks_background(peaksList,varyListRegx,dataset,background_file,params):
     varyList=back_keys+param_list
     
     while True:
-        values =  np.array(Dict2Values(params, varyList))
-        try:
-            result = so.leastsq(errPeakProfile,values,Dfun=devPeakProfile,full_output=True,col_deriv=True,\
-                args=(x[xBeg:xFin],y[xBeg:xFin],w[xBeg:xFin],params,varyList,bakType))
-         #   result = so.leastsq(errPeakProfile,values,full_output=True,\
-         #       args=(x[xBeg:xFin],y[xBeg:xFin],w[xBeg:xFin],params,varyList,bakType))
-            ncyc = int(result[2]['nfev']/2) 
-        finally:
-            pass                 
-        chisq = np.sum(result[2]['fvec']**2)
-        Values2Dict(params, varyList, result[0])
+        layout = ParameterLayout(params, varyList, bakType, x[xBeg:xFin])
+        p = layout.values(params)
+        values = p[layout.vary]
+        # the Jacobian is sparse, each peak only covering a window of the pattern. lsmr's
+        # regularization stops fits of many peaks short of the minimum leastsq finds
+        result = so.least_squares(errPeakValues,values,jac=devPeakValues,method='trf',tr_solver='lsmr',\
+            tr_options={'regularize':False},x_scale='jac',args=(layout,p,y[xBeg:xFin],np.sqrt(w[xBeg:xFin])))
+        chisq = np.sum(result.fun**2)
+        Values2Dict(params, varyList, result.x)
         Rwp = np.sqrt(chisq/np.sum(w[xBeg:xFin]*y[xBeg:xFin]**2))*100.      #to %
         GOF = chisq/(xFin-xBeg-len(varyList))
-        print 'Number of function calls:',result[2]['nfev'],' Number of observations: ',xFin-xBeg,' Number of parameters: ',len(varyList)
+        print 'Number of function calls:',result.nfev,' Number of observations: ',xFin-xBeg,' Number of parameters: ',len(varyList)
         #print 'fitpeak time = %8.3fs, %8.3fs/cycle'%(runtime,runtime/ncyc)
         print 'Rwp = %7.2f%%, chi**2 = %12.6g, reduced chi**2 = %6.2f'%(Rwp,chisq,GOF)
-        try:
-            sig = np.sqrt(np.diag(result[1])*GOF)
+        if stats is not None:
+            stats.update({'Rwp':Rwp, 'chisq':chisq, 'GOF':GOF, 'nfev':result.nfev})
+        JTJ = (result.jac.T*result.jac).toarray()
+        unused = np.flatnonzero(np.diag(JTJ) == 0)      #parameters that don't change the profile
+        if not len(unused):
+            try:
+                sig = np.sqrt(np.diag(np.linalg.inv(JTJ))*GOF)
+            except np.linalg.LinAlgError:
+                sig = np.nan*np.ones(len(varyList))
             if np.any(np.isnan(sig)):
                 print '*** Least squares aborted - some invalid esds possible ***'
             break                   #refinement succeeded - finish up!
-        except ValueError:          #result[1] is None on singular matrix
-            print '**** Refinement failed - singular matrix ****'
-            Ipvt = result[2]['ipvt']
-            for i,ipvt in enumerate(Ipvt):
-                if not np.sum(result[2]['fjac'],axis=1)[i]:
-                    print 'Removing parameter: ',varyList[ipvt-1]
-                    del(varyList[ipvt-1])
-                    break  
+        print '**** Refinement failed - singular matrix ****'
+        print 'Removing parameter: ',varyList[unused[0]]
+        del(varyList[unused[0]])
 
     sigDict = dict(zip(varyList,sig))
+    if stats is not None:
+        stats['esds'] = sigDict
     yb[xBeg:xFin] = getBackground('',params,bakType,x[xBeg:xFin])
-    yc[xBeg:xFin]= getPeakProfile(params,x[xBeg:xFin],varyList,bakType)
+    yc[xBeg:xFin]= getPeakProfileValues(layout,layout.values(params))
     yd[xBeg:xFin] = y[xBeg:xFin]-yc[xBeg:xFin]
     #getBackgroundParms(params,Background)
     #BackgroundPrint(Background,sigDict)
     #GetInstParms(parmDict,Inst,varyList,Peaks)
     #GetPeaksParms(Inst,parmDict,Peaks,varyList)    
     #PeaksPrint(dataType,parmDict,sigDict,varyList)       
-    Values2Dict(params,varyList,result[0]) 
+    Values2Dict(params,varyList,result.x) 
     return yb,yc,params
+
+def fit_background(dataset, params, stats=None):
+    """
+    Fits the background of a dataset as the Background tab's "Curve fit" does: finds its
+    peaks with autosearch_peaks() and refines them with the background parameters in
+    params (backType, U, V, W, X, Y, Back:n) by fit_peaks_background().
+    Returns (background, params) with the background's y values and the refined
+    parameters, or (None, params) if there were too many peaks or the refinement
+    failed. params isn't modified.
+    If given, stats is updated with the fit's statistics, its number of peaks, whether
+    it succeeded and the wall time taken.
+    """
+    start = time.time()
+    params = dict(params)
+    params['datasetName'] = dataset.name
+    limits = (dataset.data[0, 0], dataset.data[-1, 0])
+    background = None
+    peak_list = autosearch_peaks(dataset, limits, params)
+    if stats is not None:
+        stats.update({'peaks':len(peak_list) if peak_list is not None else None,
+                      'success':peak_list is not None})
+    if peak_list is not None:
+        try:
+            background, _, params = fit_peaks_background(peak_list, [], dataset, None, params, stats)
+        except Exception:
+            # a fit of a whole series shouldn't stop at one bad pattern
+            if stats is not None:
+                stats['success'] = False
+    if stats is not None:
+        stats['time'] = time.time() - start
+    return background, params
+
+def _fit_backgrounds_worker(job):
+    """
+    Process pool worker for fit_backgrounds(). Fits a run of datasets in order, starting
+    each from the Back:n parameters of the last one that converged.
+    """
+    datasets, params = job
+    results = []
+    for dataset in datasets:
+        stats = {}
+        background, fitted = fit_background(dataset, params, stats)
+        if background is not None:
+            params = dict(params)
+            params.update((key, value) for key, value in fitted.iteritems() if key.startswith('Back:'))
+        results.append((background, fitted, stats))
+    return results
+
+def fit_backgrounds(datasets, params, workers=None):
+    """
+    Fits the background of every dataset by fit_background(), starting from params.
+    The datasets, e.g. an in-situ series, are split into <workers> runs of consecutive
+    datasets (one per CPU by default) that are fitted in parallel processes. Within a
+    run each fit starts from the converged background of the one before, so neighbouring
+    patterns get consistent backgrounds and converge in fewer iterations.
+    Returns a list of (background, params, stats) tuples in the order of datasets, as
+    given by fit_background().
+    """
+    datasets = [ strip_dataset(d) for d in datasets ]
+    if workers is None:
+        workers = cpu_count()
+    workers = max(1, min(workers, len(datasets)))
+    size = int(math.ceil(len(datasets)/float(workers))) if datasets else 1
+    jobs = [ (datasets[i:i + size], params) for i in xrange(0, len(datasets), size) ]
+    if workers == 1:
+        outputs = map(_fit_backgrounds_worker, jobs)
+    else:
+        pool = Pool(workers)
+        try:
+            outputs = pool.map(_fit_backgrounds_worker, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    return [ result for results in outputs for result in results ]
+
 # all this stuff is from GSAS-II with modifications to remove peaks and debye scattering from the background and intrument parameters
 
 def setPeakparms(pos,mag,Parms,iPeak,ifQ=False,useFit=False):
@@ -223,20 +306,22 @@ def setPeakparms(pos,mag,Parms,iPeak,ifQ=False,useFit=False):
     XY={'pos'+str(iPeak):pos,'int'+str(iPeak):mag,'sig'+str(iPeak):sig,'gam'+str(iPeak):gam}
     return XY
 
-def devPeakProfile(values,xdata,ydata, weights,parmdict,varylist,bakType):
-        parmdict.update(zip(varylist,values))
-        return np.sqrt(weights)*getPeakProfileDerv(parmdict,xdata,varylist,bakType)
+def devPeakValues(values,layout,p,ydata,sqrtWeights):
+    """
+    least_squares() Jacobian of errPeakValues(), a sparse matrix with a column for each
+    parameter of the layout's varyList.
+    """
+    p[layout.vary] = values
+    return sp.diags(sqrtWeights).dot(getPeakProfileDervValues(layout,p))
 
 
-def errPeakProfile(values,xdata,ydata, weights,parmdict,varylist,bakType):        
-        parmdict.update(zip(varylist,values))
-        M = np.sqrt(weights)*(getPeakProfile(parmdict,xdata,varylist,bakType)-ydata)
-        Rwp = min(100.,np.sqrt(np.sum(M**2)/np.sum(weights*ydata**2))*100.)
-        #if dlg:
-         #   GoOn = dlg.Update(Rwp,newmsg='%s%8.3f%s'%('Peak fit Rwp =',Rwp,'%'))[0]
-        #    if not GoOn:
-        #        return -M           #abort!!
-        return M
+def errPeakValues(values,layout,p,ydata,sqrtWeights):
+    """
+    least_squares() residuals of the peak model. values are those of the layout's varyList,
+    p the vector of all the parameters, which is updated with them.
+    """
+    p[layout.vary] = values
+    return sqrtWeights*(getPeakProfileValues(layout,p)-ydata)
 
 
 def getBackground(pfx,parmDict,bakType,xdata):
@@ -326,143 +411,199 @@ def getBackgroundDerv(pfx,parmDict,bakType,xdata):
     return dydb
      
    
-def getPeakProfile(parmDict,xdata,varyList,bakType):
-    yb = getBackground('',parmDict,bakType,xdata)
-    yc = np.zeros_like(yb)
-    cw = np.diff(xdata)
-    cw = np.append(cw,cw[-1])
-    #if 'C' in dataType:
-    U = parmDict['U']
-    V = parmDict['V']
-    W = parmDict['W']
-    X = parmDict['X']
-    Y = parmDict['Y']
-    #shl = max(parmDict['SH/L'],0.002)
-    shl=0.002
-    Ka2 = False
-    if 'Lam1' in parmDict.keys():
-        Ka2 = True
-        lamRatio = 360*(parmDict['Lam2']-parmDict['Lam1'])/(np.pi*parmDict['Lam1'])
-        kRatio = parmDict['I(L2)/I(L1)']
-    iPeak = 0
-    while True:
-        try:
-            pos = parmDict['pos'+str(iPeak)]
-            theta = (pos-parmDict['Zero'])/2.0
-            intens = parmDict['int'+str(iPeak)]
-            sigName = 'sig'+str(iPeak)
-            if sigName in varyList:
-                sig = parmDict[sigName]
-            else:
-                sig = U*tand(theta)**2+V*tand(theta)+W
-            sig = max(sig,0.001)          #avoid neg sigma
-            gamName = 'gam'+str(iPeak)
-            if gamName in varyList:
-                gam = parmDict[gamName]
-            else:
-                gam = X/cosd(theta)+Y*tand(theta)
-            gam = max(gam,0.001)             #avoid neg gamma
-            Wd,fmin,fmax = gsas.getWidthsCW(pos,sig,gam,shl)
-            iBeg = np.searchsorted(xdata,pos-fmin)
-            iFin = np.searchsorted(xdata,pos+fmin)
-            if not iBeg+iFin:       #peak below low limit
-                iPeak += 1
-                continue
-            elif not iBeg-iFin:     #peak above high limit
-                return yb+yc
-            yc[iBeg:iFin] += intens*gsas.getFCJVoigt3(pos,sig,gam,shl,xdata[iBeg:iFin])
-            if Ka2:
-                pos2 = pos+lamRatio*tand(pos/2.0)       # + 360/pi * Dlam/lam * tan(th)
-                iBeg = np.searchsorted(xdata,pos2-fmin)
-                iFin = np.searchsorted(xdata,pos2+fmin)
-                if iBeg-iFin:
-                    yc[iBeg:iFin] += intens*kRatio*gsas.getFCJVoigt3(pos2,sig,gam,shl,xdata[iBeg:iFin])
+class ParameterLayout(object):
+    """
+    The positions of the parameters of the peak model in a vector of values, worked out
+    once per fit from the parameter dictionary, so that the model and its derivatives
+    read the parameters by index rather than looking up 'pos'+str(iPeak) etc. in the
+    dictionary and varyList on every evaluation.
+    vary holds the indices of the parameters of varyList, in its order, and rows the row
+    of each parameter in the derivative matrix, or -1 if it isn't varied.
+    The background is linear in the Back:n parameters, so its basis functions over
+    xdata are computed here once.
+    """
+    def __init__(self, parmDict, varyList, bakType, xdata):
+        self.xdata = xdata
+        cw = np.diff(xdata)
+        self.cw = np.append(cw,cw[-1])
+        self.nBak = 0
+        while 'Back:'+str(self.nBak) in parmDict:
+            self.nBak += 1
+        names = ['Back:'+str(i) for i in range(self.nBak)] + ['U','V','W','X','Y','Zero']
+        # (pos, int, sig, gam, sig varied, gam varied) for each peak, -1 if absent
+        self.peaks = []
+        iPeak = 0
+        while 'pos'+str(iPeak) in parmDict and 'int'+str(iPeak) in parmDict:
+            peak = []
+            for parmName in ['pos','int','sig','gam']:
+                name = parmName+str(iPeak)
+                if name in parmDict:
+                    peak.append(len(names))
+                    names.append(name)
+                else:
+                    peak.append(-1)
+            peak += ['sig'+str(iPeak) in varyList, 'gam'+str(iPeak) in varyList]
+            self.peaks.append(tuple(peak))
             iPeak += 1
-        except KeyError:        #no more peaks to process
-            return yb+yc
-    
-            
+        self.Ka2 = 'Lam1' in parmDict
+        if self.Ka2:
+            names += ['Lam1','Lam2','I(L2)/I(L1)']
+        if 'SH/L' in parmDict:
+            names.append('SH/L')
+        names += [varied for varied in varyList if varied not in names]
+        self.names = names
+        self.index = dict((name,i) for i,name in enumerate(names))
+        self.vary = np.array([self.index[name] for name in varyList], dtype=int)
+        self.rows = [-1]*len(names)
+        for row,i in enumerate(self.vary):
+            self.rows[i] = row
+        self.background_basis = np.zeros(shape=(self.nBak,len(xdata)))
+        for iBak in range(self.nBak):
+            unit = dict(('Back:'+str(i),float(i == iBak)) for i in range(self.nBak))
+            self.background_basis[iBak] = getBackground('',unit,bakType,xdata)
+
+    def values(self, parmDict):
+        """
+        Returns the vector of the parameters' values in parmDict.
+        """
+        return np.array([parmDict[name] for name in self.names], dtype=float)
+
+
+def getPeakProfile(parmDict,xdata,varyList,bakType):
+    layout = ParameterLayout(parmDict,varyList,bakType,xdata)
+    return getPeakProfileValues(layout,layout.values(parmDict))
+
+
 def getPeakProfileDerv(parmDict,xdata,varyList,bakType):
 # needs to return np.array([dMdx1,dMdx2,...]) in same order as varylist = backVary,insVary,peakVary order
-    dMdv = np.zeros(shape=(len(varyList),len(xdata)))
-    dMdb = getBackgroundDerv('',parmDict,bakType,xdata)
-    if 'Back:0' in varyList:            #background derivs are in front if present
-        dMdv[0:len(dMdb)] = dMdb
-    
-    cw = np.diff(xdata)
-    cw = np.append(cw,cw[-1])
-    U = parmDict['U']
-    V = parmDict['V']
-    W = parmDict['W']
-    X = parmDict['X']
-    Y = parmDict['Y']
-   # shl = max(parmDict['SH/L'], 0.002)
+    layout = ParameterLayout(parmDict,varyList,bakType,xdata)
+    return getPeakProfileDervValues(layout,layout.values(parmDict)).T.toarray()
+
+
+def getPeakProfileValues(layout,p):
+    """
+    Returns the background and peaks over the layout's xdata for the parameter vector p.
+    """
+    xdata = layout.xdata
+    yb = np.dot(p[:layout.nBak],layout.background_basis)
+    yc = np.zeros_like(xdata)
+    v = p.tolist()
+    index = layout.index
+    U,V,W,X,Y,Zero = [v[index[name]] for name in ['U','V','W','X','Y','Zero']]
+    #shl = max(v[index['SH/L']],0.002)
     shl=0.002
-    Ka2 = False
-    
-    iPeak = 0
-    while True:
-        try:
-            pos = parmDict['pos' + str(iPeak)]
-            theta = (pos - parmDict['Zero']) / 2.0
-            intens = parmDict['int' + str(iPeak)]
-            sigName = 'sig' + str(iPeak)
-            tanth = tand(theta)
-            costh = cosd(theta)
-            if sigName in varyList:
-                sig = parmDict[sigName]
-            else:
-                sig = U * tanth ** 2 + V * tanth + W
-                dsdU = tanth ** 2
-                dsdV = tanth
-                dsdW = 1.0
-            sig = max(sig, 0.001)  # avoid neg sigma
-            gamName = 'gam' + str(iPeak)
-            if gamName in varyList:
-                gam = parmDict[gamName]
-            else:
-                gam = X / costh + Y * tanth
-                dgdX = 1.0 / costh
-                dgdY = tanth
-            gam = max(gam, 0.001)  # avoid neg gamma
-            Wd, fmin, fmax = gsas.getWidthsCW(pos, sig, gam, shl)
-            iBeg = np.searchsorted(xdata, pos - fmin)
-            iFin = np.searchsorted(xdata, pos + fmin)
-            if not iBeg + iFin:  # peak below low limit
-                iPeak += 1
-                continue
-            elif not iBeg - iFin:  # peak above high limit
-                break
-            dMdpk = np.zeros(shape=(6, len(xdata)))
-            dMdipk = gsas.getdFCJVoigt3(pos, sig, gam, shl, xdata[iBeg:iFin]) 
-            for i in range(1, 5):
-                dMdpk[i][iBeg:iFin] += 100.*cw[iBeg:iFin] * intens * dMdipk[i]
-            dMdpk[0][iBeg:iFin] += 100.*cw[iBeg:iFin] * dMdipk[0]
-            dervDict = {'int':dMdpk[0], 'pos':dMdpk[1], 'sig':dMdpk[2], 'gam':dMdpk[3], 'shl':dMdpk[4]}
-            for parmName in ['pos', 'int', 'sig', 'gam']:
-                try:
-                    idx = varyList.index(parmName + str(iPeak))
-                    dMdv[idx] = dervDict[parmName]
-                except ValueError:
-                    pass
-            if 'U' in varyList:
-                dMdv[varyList.index('U')] += dsdU * dervDict['sig']
-            if 'V' in varyList:
-                dMdv[varyList.index('V')] += dsdV * dervDict['sig']
-            if 'W' in varyList:
-                dMdv[varyList.index('W')] += dsdW * dervDict['sig']
-            if 'X' in varyList:
-                dMdv[varyList.index('X')] += dgdX * dervDict['gam']
-            if 'Y' in varyList:
-                dMdv[varyList.index('Y')] += dgdY * dervDict['gam']
-            if 'SH/L' in varyList:
-                dMdv[varyList.index('SH/L')] += dervDict['shl']  # problem here
-            if 'I(L2)/I(L1)' in varyList:
-                dMdv[varyList.index('I(L2)/I(L1)')] += dervDict['L1/L2']
-            iPeak += 1
-        except KeyError:  # no more peaks to process
+    if layout.Ka2:
+        Lam1 = v[index['Lam1']]
+        lamRatio = 360*(v[index['Lam2']]-Lam1)/(np.pi*Lam1)
+        kRatio = v[index['I(L2)/I(L1)']]
+    for iPos,iInt,iSig,iGam,sigVaried,gamVaried in layout.peaks:
+        pos = v[iPos]
+        theta = (pos-Zero)/2.0
+        intens = v[iInt]
+        if sigVaried:
+            sig = v[iSig]
+        else:
+            sig = U*tand(theta)**2+V*tand(theta)+W
+        sig = max(sig,0.001)          #avoid neg sigma
+        if gamVaried:
+            gam = v[iGam]
+        else:
+            gam = X/cosd(theta)+Y*tand(theta)
+        gam = max(gam,0.001)             #avoid neg gamma
+        Wd,fmin,fmax = gsas.getWidthsCW(pos,sig,gam,shl)
+        iBeg = np.searchsorted(xdata,pos-fmin)
+        iFin = np.searchsorted(xdata,pos+fmin)
+        if not iBeg+iFin:       #peak below low limit
+            continue
+        elif not iBeg-iFin:     #peak above high limit
             break
-    return dMdv     
+        yc[iBeg:iFin] += intens*gsas.getFCJVoigt3(pos,sig,gam,shl,xdata[iBeg:iFin])
+        if layout.Ka2:
+            pos2 = pos+lamRatio*tand(pos/2.0)       # + 360/pi * Dlam/lam * tan(th)
+            iBeg = np.searchsorted(xdata,pos2-fmin)
+            iFin = np.searchsorted(xdata,pos2+fmin)
+            if iBeg-iFin:
+                yc[iBeg:iFin] += intens*kRatio*gsas.getFCJVoigt3(pos2,sig,gam,shl,xdata[iBeg:iFin])
+    return yb+yc
+
+
+def getPeakProfileDervValues(layout,p):
+    """
+    Returns the derivatives of getPeakProfileValues() by the layout's varyList as a
+    sparse matrix with a row for each point of xdata and a column for each parameter.
+    Each peak only contributes the window of xdata that it covers, so the matrix holds
+    about as many values as the peaks are wide rather than len(varyList)*len(xdata).
+    """
+    xdata = layout.xdata
+    cw = layout.cw
+    rows = layout.rows
+    segments = []       # (first point, column, values) of the nonzero derivatives
+    for iBak in range(layout.nBak):
+        if rows[iBak] >= 0:
+            segments.append((0, rows[iBak], layout.background_basis[iBak]))
+    v = p.tolist()
+    index = layout.index
+    U,V,W,X,Y,Zero = [v[index[name]] for name in ['U','V','W','X','Y','Zero']]
+    rowU,rowV,rowW,rowX,rowY = [rows[index[name]] for name in ['U','V','W','X','Y']]
+    rowShl = rows[index['SH/L']] if 'SH/L' in index else -1
+   # shl = max(v[index['SH/L']], 0.002)
+    shl=0.002
+    for iPos,iInt,iSig,iGam,sigVaried,gamVaried in layout.peaks:
+        pos = v[iPos]
+        theta = (pos - Zero) / 2.0
+        intens = v[iInt]
+        tanth = tand(theta)
+        costh = cosd(theta)
+        if sigVaried:
+            sig = v[iSig]
+        else:
+            sig = U * tanth ** 2 + V * tanth + W
+        sig = max(sig, 0.001)  # avoid neg sigma
+        if gamVaried:
+            gam = v[iGam]
+        else:
+            gam = X / costh + Y * tanth
+        gam = max(gam, 0.001)  # avoid neg gamma
+        Wd, fmin, fmax = gsas.getWidthsCW(pos, sig, gam, shl)
+        iBeg = np.searchsorted(xdata, pos - fmin)
+        iFin = np.searchsorted(xdata, pos + fmin)
+        if not iBeg + iFin:  # peak below low limit
+            continue
+        elif not iBeg - iFin:  # peak above high limit
+            break
+        dMdipk = gsas.getdFCJVoigt3(pos, sig, gam, shl, xdata[iBeg:iFin])
+        scale = 100.*cw[iBeg:iFin]
+        dMdint = scale * dMdipk[0]
+        dMdpos, dMdsig, dMdgam, dMdshl = [scale * intens * dMdipk[i] for i in range(1, 5)]
+        for i, dMdpk in [(iPos, dMdpos), (iInt, dMdint), (iSig, dMdsig), (iGam, dMdgam)]:
+            if i >= 0 and rows[i] >= 0:
+                segments.append((iBeg, rows[i], dMdpk))
+        if not sigVaried:
+            for row, dsdp in [(rowU, tanth ** 2), (rowV, tanth), (rowW, 1.0)]:
+                if row >= 0:
+                    segments.append((iBeg, row, dsdp * dMdsig))
+        if not gamVaried:
+            for row, dgdp in [(rowX, 1.0 / costh), (rowY, tanth)]:
+                if row >= 0:
+                    segments.append((iBeg, row, dgdp * dMdgam))
+        if rowShl >= 0:
+            segments.append((iBeg, rowShl, dMdshl))  # problem here
+    return segmentsToMatrix(segments, (len(xdata), len(layout.vary)))
+
+
+def segmentsToMatrix(segments, shape):
+    """
+    Returns a sparse matrix of the given shape from a list of (first row, column, values)
+    segments of its columns. Overlapping segments of a column are summed.
+    """
+    if not segments:
+        return sp.csr_matrix(shape)
+    lengths = np.array([len(values) for _, _, values in segments])
+    data = np.concatenate([values for _, _, values in segments])
+    offsets = np.arange(len(data)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rows = np.repeat([start for start, _, _ in segments], lengths) + offsets
+    cols = np.repeat([col for _, col, _ in segments], lengths)
+    return sp.coo_matrix((data, (rows, cols)), shape=shape).tocsr()
 
 def Dict2Values(parmdict, varylist):
     '''Use before call to leastsq to setup list of values for the parameters 
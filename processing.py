@@ -1,17 +1,21 @@
 from os import path
-from copy import deepcopy
+from copy import copy, deepcopy
 import re
 from functools import cmp_to_key
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from numpy import array, linspace, meshgrid, exp
 
-import scipy.ndimage as sn
 import scipy.optimize as so
 import scipy.interpolate as interpolate
-import matplotlib.pyplot as plt
 
 from xye import XYEDataset
+from dataset_storage import stacked_view
+from dataset_collection import packed_stack
+from baseline import window_baseline
+from stage_cache import array_key, stage_key, default_cache as default_stage_cache
 
 __doc__ = \
 """
@@ -56,24 +60,253 @@ Step 4.
 "Merge data" or "Splice data".
 To combine the overlapping data, the data points are combined and sorted in order of increasing angle. An interpolation
 spline is then fitted to the data and the data is resampled every 0.00375deg.
+Alternatively "Weighted merge" bins the points of both datasets directly onto the 0.00375deg grid, combining the points in
+each bin by their inverse-variance weighted mean.
 
 Step 5.
 The data is output as an .xye file along with a .parab file.
 A GUI checkbox option enables the .parab file contents to be prepended to the .xye file.
 """
 
+# Choices for which detector positions are paired up and merged
+MERGE_POSITIONS = ['all', 'p1+p2', 'p3+p4', 'p12+p34']
+
+# Ways of finding the offsets between positions: peak fitting or cross-correlation
+ALIGNMENT_METHODS = ['fit', 'xcorr']
+
+DEFAULT_REGRID_INTERVAL = 0.00375
+
+
+def get_position(filename):
+    """
+    Returns the detector position number in a filename, e.g. 12 for foo_p12_0001.xye,
+    or None if it has none.
+    """
+    m = re.search('_[pP]([0-9]+)_', filename)
+    try:
+        return int(m.group(1))
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_partner(position_index):
+    # return index of partner; i.e., 2=>1, 1=>2, 3=>4, 4=>3, 12=>34, 34=>12
+    if position_index in [1, 2, 3, 4]:
+        partner = ((position_index - 1) ^ 1) + 1
+    elif position_index == 12:
+        partner = 34
+    elif position_index == 34:
+        partner = 12
+    else:
+        raise ValueError('unparsable position')
+    return partner
+
+
+def partner_filename(filename):
+    """
+    Returns the filename of the dataset measured at the partner position.
+    """
+    def repl(m):
+        return m.group(1) + str(get_partner(int(m.group(2)))) + m.group(3)
+    return re.sub(r"(_[pP])(\d+)(_)", repl, filename)
+
+
+def find_dataset_pairs(filenames, merge_positions):
+    """
+    Returns a set of (filebase, partner filebase) pairs of the files among <filenames>
+    whose partner is also present, for the positions selected by <merge_positions>
+    (one of MERGE_POSITIONS). The odd or lower position comes first in each pair.
+    """
+    matching_re = {'all':    ''            ,
+                   'p1+p2':  '_[pP][12]_'     ,
+                   'p3+p4':  '_[pP][34]_'     ,
+                   'p12+p34':'_[pP](?:12|34)_',
+                  }
+    basenames = [path.basename(f) for f in filenames]
+    filtered_paths = [f for f in basenames if re.search(matching_re[merge_positions], f) is not None]
+    basename_set = set(basenames)
+    dataset_pairs = set()
+    for filebase in filtered_paths:
+        # base filename for the first position.
+        position_index = get_position(filebase)
+        if position_index is None:
+            continue
+        other_filebase = partner_filename(filebase)
+        if other_filebase in basename_set:
+            if position_index != 12 and (position_index & 1) == 0:
+                dataset_pairs.add((other_filebase, filebase))
+            else:
+                dataset_pairs.add((filebase, other_filebase))
+    return dataset_pairs
+
+
+# Fewer pairs than this are processed without starting a process pool
+MIN_PARALLEL_PAIRS = 4
+
+# Metadata belonging to the GUI rather than the data
+UI_METADATA = ['ui', 'ui_w']
+
+
+def strip_dataset(dataset, with_data=True):
+    """
+    Returns a shallow copy of the dataset without its GUI metadata, and without its data
+    (an empty array) if with_data is False, for sending to another process.
+    """
+    metadata = dict((k, v) for k, v in dataset.metadata.iteritems() if k not in UI_METADATA)
+    data = dataset.data if with_data else np.empty((0, 3))
+    return XYEDataset(data, dataset.name, dataset.source, metadata)
+
+
+_pair_processor = None
+_pair_merge_positions = None
+
+def _init_pair_worker(processor, merge_positions):
+    global _pair_processor, _pair_merge_positions
+    _pair_processor = processor
+    _pair_merge_positions = merge_positions
+
+
+def _process_pair_worker(dataset_pair):
+    """
+    Process pool worker for DatasetProcessor.process_all(). Returns the new datasets.
+    """
+    return _pair_processor._process_pair(dataset_pair, _pair_merge_positions)
+
+
 class DatasetProcessor(object):
     def __init__(self, normalise=True, correction=0.0, align_positions=True,
                  merge_by_splice=True, merge_by_merge=True, regrid=False,
-                 normalisation_reference=True, datasets=True):
+                 normalisation_reference=True, datasets=True,
+                 regrid_interval=DEFAULT_REGRID_INTERVAL, use_cache=True,
+                 merge_by_binning=False):
         self.normalise = normalise
         self.correction = correction
         self.align_positions = align_positions
         self.merge_by_splice = merge_by_splice
         self.merge_by_merge = merge_by_merge
+        self.merge_by_binning = merge_by_binning
         self.regrid = regrid
         self.normalisation_reference = normalisation_reference
         self.datasets = datasets
+        self.regrid_interval = regrid_interval
+        # Stage results shared between runs, see stage_cache.py
+        self.cache = default_stage_cache() if use_cache else None
+
+
+    def process(self, merge_positions, dataset_pairs=None, workers=1, previous=None):
+        """
+        Processes self.datasets as selected by <merge_positions>, one of MERGE_POSITIONS:
+        'p12+p34' splices the p12 and p34 pairs, 'all' normalises and/or regrids every
+        dataset, and otherwise each pair of positions is processed by
+        process_dataset_pair().
+        <dataset_pairs> is a list of (dataset, partner dataset) tuples; if None the
+        pairs are found from the dataset names. Pairs are processed by process_all()
+        using <workers> processes, reusing the up-to-date datasets in <previous>.
+        Returns a list of the new datasets.
+        """
+        processed_datasets = []
+        if merge_positions == 'all':
+            normalised_datasets = self.normalise_all(self.datasets)
+            datasets = [ n if n is not None else d
+                         for d, n in zip(self.datasets, normalised_datasets) ]
+            regridded_datasets = self.regrid_all(datasets, workers)
+            for normalised, regridded in zip(normalised_datasets, regridded_datasets):
+                processed_datasets.extend(d for d in [normalised, regridded] if d is not None)
+            return processed_datasets
+
+        if dataset_pairs is None:
+            datasets_dict = dict([ (d.name, d) for d in self.datasets ])
+            dataset_pairs = [ (datasets_dict[file1], datasets_dict[file2]) for file1, file2 in
+                              sorted(find_dataset_pairs(datasets_dict.keys(), merge_positions)) ]
+        return self.process_all(dataset_pairs, workers, merge_positions, previous)
+
+
+    def pair_signature(self, dataset_pair, merge_positions='p1+p2'):
+        """
+        Returns a key identifying what processing the pair of datasets as process() would
+        for <merge_positions> gives: a hash of their data, names, normalisation, peak fits
+        and the processing options. The datasets made from the pair keep it in their
+        'processing_signature' metadata, so they are up to date if it still matches.
+        """
+        names, factors = self._normalisation_params(dataset_pair)
+        peak_fits = tuple(d.metadata.get('peak_fit') for d in dataset_pair) \
+                        if self.align_positions else ()
+        options = (merge_positions, self.normalise, self.correction, self.align_positions,
+                   self.merge_by_splice, self.merge_by_merge, self.merge_by_binning,
+                   self.regrid, self.regrid_interval)
+        return stage_key(array_key(*[ d.data for d in dataset_pair ]), 'pair',
+                         (tuple(names), factors, peak_fits, options))
+
+
+    def _process_pair(self, dataset_pair, merge_positions):
+        if merge_positions == 'p12+p34':
+            return self.splice_overlapping_datasets(dataset_pair)
+        return self.process_dataset_pair(dataset_pair)
+
+
+    def process_all(self, dataset_pairs, workers=None, merge_positions='p1+p2',
+                    previous=None):
+        """
+        Processes each (dataset, partner dataset) pair as process() would for
+        <merge_positions>, using a pool of <workers> processes (one per CPU by default)
+        when there are enough pairs to make it worthwhile.
+        <previous> is a list of datasets from an earlier run. Those made from a pair
+        whose pair_signature() hasn't changed since are returned again in place of
+        processing it, so only new or modified pairs are processed.
+        Only the arrays and metadata needed for processing are sent to the workers; the
+        'ui' and 'ui_w' metadata are left behind, so the new datasets never have them,
+        whether or not a pool was used.
+        Returns a list of the processed datasets, in the order of dataset_pairs.
+        """
+        up_to_date = {}
+        for dataset in previous or []:
+            signature = dataset.metadata.get('processing_signature')
+            if signature is not None:
+                up_to_date.setdefault(signature, []).append(dataset)
+        signatures = [ self.pair_signature(pair, merge_positions) for pair in dataset_pairs ]
+        sources = [ [ d.name for d in pair ] for pair in dataset_pairs ]
+        dataset_pairs = [ tuple(map(strip_dataset, pair)) for pair in dataset_pairs ]
+        results = [None]*len(dataset_pairs)
+        # Pairs processed before only need their changed stages rerun, which is
+        # quicker here using the cache than in a worker without it
+        todo = []
+        for i, pair in enumerate(dataset_pairs):
+            if signatures[i] in up_to_date:
+                results[i] = up_to_date[signatures[i]]
+            elif merge_positions != 'p12+p34' and self._is_cached(pair):
+                results[i] = self._process_pair(pair, merge_positions)
+            else:
+                todo.append(i)
+        if workers is None:
+            workers = cpu_count()
+        workers = min(workers, len(todo))
+        if workers <= 1 or len(todo) < MIN_PARALLEL_PAIRS:
+            for i in todo:
+                results[i] = self._process_pair(dataset_pairs[i], merge_positions)
+        else:
+            # The reference datasets used for normalisation are only needed for their
+            # names and metadata, so the workers get a copy of the processor without data.
+            # Nor do they cache stage outputs: sending them all back to be cached here
+            # would cost about as much as the parallel processing saves. Pairs that
+            # don't change are reused from <previous> instead.
+            processor = copy(self)
+            processor.datasets = [ strip_dataset(d, with_data=False) for d in self.datasets ]
+            processor.cache = None
+            pool = Pool(workers, _init_pair_worker, (processor, merge_positions))
+            try:
+                chunksize = max(1, len(todo)/(workers*4))
+                outputs = pool.map(_process_pair_worker, [ dataset_pairs[i] for i in todo ],
+                                   chunksize)
+            finally:
+                pool.close()
+                pool.join()
+            for i, datasets in zip(todo, outputs):
+                results[i] = datasets
+        for signature, names, datasets in zip(signatures, sources, results):
+            for dataset in datasets:
+                dataset.metadata['processing_signature'] = signature
+                dataset.metadata['processed_from'] = names
+        return [ dataset for datasets in results for dataset in datasets ]
 
 
     def process_dataset(self, dataset):
@@ -84,65 +317,146 @@ class DatasetProcessor(object):
 
 
     def process_dataset_pair(self, dataset_pair):
-        dataset_pair = map(lambda d: d.copy(), dataset_pair)
+        """
+        Runs a pair of datasets through the stages normalise -> clean_gaps ->
+        zero-correct/align -> merge/splice -> regrid, returning a list of the merged,
+        spliced and regridded datasets. Each stage's output is taken from self.cache if
+        it holds the result of the same stage with the same input and parameters.
+        """
         dataset1, dataset2 = dataset_pair
+        names, factors = self._normalisation_params(dataset_pair)
+        key = array_key(dataset1.data, dataset2.data)
+        data = (dataset1.data, dataset2.data)
 
         # normalise
         if self.normalise:
-            dataset1 = self.normalise_me(dataset1)
-            dataset2 = self.normalise_me(dataset2)
+            key, data = self._stage('normalise', factors, key, data,
+                                    lambda d1, d2: tuple(normalise_data([d1, d2], factors)))
 
         # trim data from gap edges prior to merging
-        dataset1.data = clean_gaps(dataset1.data)
-        dataset2.data = clean_gaps(dataset2.data)
+        key, data = self._stage('clean_gaps', (), key, data,
+                                lambda d1, d2: (clean_gaps(d1), clean_gaps(d2)))
 
         # zero correct i.e. shift x values
-        if self.correction != 0.0:
-            dataset1.data[:,0] += self.correction
-            dataset2.data[:,0] += self.correction
-
+        x_offset = 0.0
         if self.align_positions:
             if 'peak_fit' in dataset1.metadata and \
                'peak_fit' in dataset2.metadata:
                 x_offset = dataset1.metadata['peak_fit'] - \
                             dataset2.metadata['peak_fit']
-                dataset2.data[:,0] += x_offset
+        if self.correction != 0.0 or x_offset != 0.0:
+            key, data = self._stage('align', (self.correction, x_offset), key, data,
+                                    lambda d1, d2: (shift_x(d1, self.correction),
+                                                    shift_x(d2, self.correction + x_offset)))
 
         # merge and/or splice
-        if self.merge_by_splice and self.merge_by_merge:
-            spliced_datasets = self._merge_datasets(dataset1, dataset2, 'splice')
-            merged_datasets = self._merge_datasets(dataset1, dataset2, 'merge')
-            merged_datasets = merged_datasets + spliced_datasets
+        merge_methods = []
+        if self.merge_by_merge and self.merge_by_splice:
+            merge_methods = ['merge', 'splice']
         elif self.merge_by_splice:
-            merged_datasets = self._merge_datasets(dataset1, dataset2, 'splice')
+            merge_methods = ['splice']
         elif self.merge_by_merge:
-            merged_datasets = self._merge_datasets(dataset1, dataset2, 'merge')
-        else:
-            merged_datasets = []
+            merge_methods = ['merge']
+        if self.merge_by_binning:
+            # already on the regrid interval's grid, so it isn't regridded below
+            merge_methods.append('bin')
+        merged = []
+        for merge_method in merge_methods:
+            params = (self.regrid_interval,) if merge_method == 'bin' else ()
+            merged.append(self._stage(merge_method, params, key, data,
+                lambda d1, d2: (combine_pair(d1, d2, merge_method, self.regrid_interval),)))
+
+        merged_datasets = []
+        for merge_method, (_, (merged_data,)) in zip(merge_methods, merged):
+            merged_datasets.append(self._merged_dataset(dataset1, names[0], merged_data.copy(),
+                                                        MERGE_LABELS[merge_method]))
 
         # regrid
         if self.regrid:
-            regridded_datasets = []
-            for dataset in merged_datasets:
-                regridded_datasets.append(self.regrid_me(dataset))
-            merged_datasets.extend(regridded_datasets)
+            for merge_method, (merged_key, merged_data), dataset in \
+                    zip(merge_methods, merged, merged_datasets[:]):
+                if merge_method == 'bin':
+                    continue
+                _, (regridded_data,) = self._stage('regrid', (self.regrid_interval,), merged_key,
+                    merged_data, lambda d: (regrid_data(d, interval=self.regrid_interval),))
+                merged_datasets.append(XYEDataset(regridded_data.copy(),
+                                                  insert_descriptor(dataset.name, 'g'),
+                                                  dataset.source, deepcopy(dataset.metadata)))
         return merged_datasets
 
 
+    def _normalisation_params(self, dataset_pair):
+        """
+        Returns the names the pair of datasets will have after normalisation, and a
+        tuple of their normalisation factors. Datasets without a reference are left
+        unnormalised.
+        """
+        names = [ d.name for d in dataset_pair ]
+        factors = [1.0]*len(dataset_pair)
+        if self.normalise:
+            for i, dataset in enumerate(dataset_pair):
+                try:
+                    factors[i] = normalisation_factor(self._normalisation_reference(dataset), dataset)
+                    names[i] = insert_descriptor(names[i], 'n')
+                except:
+                    pass
+        return names, tuple(factors)
+
+
+    def _is_cached(self, dataset_pair):
+        """
+        Returns True if self.cache holds the gap-cleaned data of the pair, i.e. if the
+        pair was processed before with the same data and normalisation.
+        """
+        if self.cache is None:
+            return False
+        key = array_key(*[ d.data for d in dataset_pair ])
+        if self.normalise:
+            key = stage_key(key, 'normalise', self._normalisation_params(dataset_pair)[1])
+        return stage_key(key, 'clean_gaps', ()) in self.cache
+
+
+    def _stage(self, stage, params, input_key, inputs, function):
+        """
+        Returns (key, outputs) for a pipeline stage: the cache key of the stage's output
+        and the output tuple of arrays, calling function(*inputs) if it isn't cached.
+        """
+        key = stage_key(input_key, stage, params)
+        outputs = self.cache.get(key) if self.cache is not None else None
+        if outputs is None:
+            outputs = function(*inputs)
+            if self.cache is not None:
+                self.cache.put(key, outputs)
+        return key, outputs
+
+
+    def _normalisation_reference(self, dataset):
+        """
+        Returns the dataset that <dataset> is normalised to. Raises KeyError if there isn't one.
+        """
+        if self.normalisation_reference in ['p1', 'p2', 'p3', 'p4']:
+            # Normalise to selected position
+            selected_filebase = re.sub('_p[1-4]*_',
+                                       '_{}_'.format(self.normalisation_reference),
+                                       dataset.name)
+        else:
+            # Normalise to selected file
+            selected_filebase = self.normalisation_reference
+        find_by_name = getattr(self.datasets, 'find_by_name', None)
+        if find_by_name is not None:
+            nr_dataset = find_by_name(selected_filebase)
+        else:
+            nr_dataset = dict([(d.name, d) for d in self.datasets]).get(selected_filebase)
+        if nr_dataset is None:
+            raise KeyError(selected_filebase)
+        return nr_dataset
+
+
     def normalise_me(self, dataset):
         if self.normalise:
             dataset1 = dataset.copy()
             try:
-                datasets_dict = dict([(d.name, d) for d in self.datasets])
-                if self.normalisation_reference in ['p1', 'p2', 'p3', 'p4']:
-                    # Normalise to selected position
-                    selected_filebase = re.sub('_p[1-4]*_',
-                                               '_{}_'.format(self.normalisation_reference),
-                                               dataset1.name)
-                    nr_dataset = datasets_dict[selected_filebase]
-                else:
-                    # Normalise to selected file
-                    nr_dataset = datasets_dict[self.normalisation_reference]
+                nr_dataset = self._normalisation_reference(dataset1)
                 dataset1.data = normalise_dataset([nr_dataset, dataset1])
                 dataset1.name = insert_descriptor(dataset1.name, 'n')
                 return dataset1
@@ -151,25 +465,84 @@ class DatasetProcessor(object):
         return None
 
 
+    def normalise_all(self, datasets):
+        """
+        Equivalent to calling normalise_me() on each dataset, but datasets on a shared
+        grid are normalised with a single array operation.
+        Returns a list with a normalised dataset, or None, for each input dataset.
+        """
+        normalised = [None]*len(datasets)
+        if not self.normalise:
+            return normalised
+        indexes = []
+        factors = []
+        names = []
+        for i, dataset in enumerate(datasets):
+            try:
+                nr_dataset = self._normalisation_reference(dataset)
+                factor = normalisation_factor(nr_dataset, dataset)
+                name = insert_descriptor(dataset.name, 'n')
+            except:
+                continue
+            indexes.append(i)
+            factors.append(factor)
+            names.append(name)
+        data = normalise_data([ datasets[i].data for i in indexes ], factors)
+        for i, d, name in zip(indexes, data, names):
+            dataset1 = datasets[i].copy()
+            dataset1.data = d
+            dataset1.name = name
+            normalised[i] = dataset1
+        return normalised
+
+
     def regrid_me(self, dataset):
         if self.regrid:
             dataset1 = dataset.copy()
-            dataset1.data = regrid_data(dataset1.data)
+            dataset1.data = regrid_data(dataset1.data, interval=self.regrid_interval)
             dataset1.name = insert_descriptor(dataset1.name, 'g')
             return dataset1
         return None
 
 
+    def regrid_all(self, datasets, workers=1):
+        """
+        Equivalent to calling regrid_me() on each dataset, but datasets covering the
+        same x range are regridded together by regrid_arrays().
+        """
+        if not self.regrid:
+            return [None]*len(datasets)
+        regridded = [None]*len(datasets)
+        ranges = {}
+        for i, dataset in enumerate(datasets):
+            x = ascending_data(dataset.data)[:,0]
+            ranges.setdefault((x[0], x[-1]), []).append(i)
+        for (start, end), indexes in ranges.iteritems():
+            xs = regular_grid(start, end, self.regrid_interval)
+            y, e = regrid_arrays([ datasets[i].data for i in indexes ], xs, workers)
+            for i, y_row, e_row in zip(indexes, y, e):
+                dataset1 = datasets[i].copy()
+                data = np.c_[xs, y_row, e_row]
+                if datasets[i].data[0,0] > datasets[i].data[-1,0]:
+                    data = data[::-1]
+                dataset1.data = data
+                dataset1.name = insert_descriptor(dataset1.name, 'g')
+                regridded[i] = dataset1
+        return regridded
+
+
     def _merge_datasets(self, dataset1, dataset2, merge_method):
-        if merge_method == 'merge':
-            merged_data = combine_by_merge(dataset1.data, dataset2.data)
-            merge_label = 'm'
-        elif merge_method == 'splice':
-            merged_data = combine_by_splice(dataset1.data, dataset2.data)
-            merge_label = 's'
-        else:
+        if merge_method not in MERGE_LABELS:
             raise ValueError('Merge method not understood')
+        merged_data = combine_pair(dataset1.data, dataset2.data, merge_method)
+        return [self._merged_dataset(dataset1, dataset1.name, merged_data,
+                                     MERGE_LABELS[merge_method])]
 
+
+    def _merged_dataset(self, dataset1, name, merged_data, merge_label):
+        """
+        Returns a new dataset for the data merged from dataset1, named <name>, and its partner.
+        """
         # Create a new dataset to store the merged data in.
         current_directory = path.abspath(dataset1.source)
        
@@ -177,7 +550,7 @@ class DatasetProcessor(object):
             newnames={'12':'1234','1':'12','3':'34'}
             return m.group(1)+newnames[m.group(2)]+m.group(3)
        
-        merged_data_filebase = re.sub(r"(_[pP])(\d+)(_)", getmatch, dataset1.name)
+        merged_data_filebase = re.sub(r"(_[pP])(\d+)(_)", getmatch, name)
         #dataset1.name.replace('_p12_', '_p1234_')\
         #                               .replace('_p1_', '_p12_')\
         #                               .replace('_p3_', '_p34_')
@@ -186,7 +559,7 @@ class DatasetProcessor(object):
         merged_dataset = XYEDataset(merged_data, merged_data_filebase,
                                           merged_data_filename,
                                           deepcopy(dataset1.metadata))
-        return [merged_dataset]
+        return merged_dataset
 
 
     def splice_overlapping_datasets(self, datasets):
@@ -213,7 +586,7 @@ def insert_descriptor(filename, insertion):
     foo_[nnnn].xye, foo_[nnnn].xy, foo_[descriptor]_[nnnn].xy, or foo_[descriptor]_[nnnn].xye where
     [nnnn] is a 4-digit sequence id, and
     [descriptor] is a code string that describes the processing that has been performed, where the code
-    may only contain characters from the ordered list ['n','s','m','g','b','t'] which, if included, will be
+    may only contain characters from the ordered list ['n','s','m','w','g','b','t'] which, if included, will be
     in the order shown.
     The insertion string may be a character or character combination from the list, which is inserted
     into the descriptor.
@@ -225,11 +598,11 @@ def insert_descriptor(filename, insertion):
         # filename of form foo.ext - return foo_[descriptor].ext
         fname, ext = parts[0].split('.')
         return '{}_{}.{}'.format(fname, insertion, ext)
-    regex = r'^(n?s?m?g?b?t?)$'
+    regex = r'^(n?s?m?w?g?b?t?)$'
     match = re.match(regex, parts[-2])      # check if 2nd last group is a descriptor     
     if match is not None:
         # descriptor found, so insert the new insertion at the appropriate location
-        order = ['n','s','m','g','b','t']       # sort order for characters in descriptor group
+        order = ['n','s','m','w','g','b','t']   # sort order for characters in descriptor group
         # tuple(match_string) -> match_string -> match_string+insertion_string -> sorted string based on order
         descriptor = match.groups()[0]
         if insertion != descriptor:
@@ -243,6 +616,18 @@ def insert_descriptor(filename, insertion):
         return '_'.join(parts[:-1] + [insertion] + parts[-1:])
 
 
+def get_descriptor(filename):
+    """
+    Returns the processing descriptor of a filename of the form described in
+    insert_descriptor(), e.g. 'nsg' for foo_nsg_0001.xye, or '' if it has none.
+    """
+    parts = filename.split('_')
+    if len(parts) == 1:
+        return ''
+    match = re.match(r'^(n?s?m?w?g?b?t?)$', parts[-2])
+    return match.groups()[0] if match is not None else ''
+
+
 def cubic_interpolate(x, y, z, x_size, y_size):
     """
     This 2D interpolation routine is used by the 2D surface plot to generate values between actual plot series data values.
@@ -272,13 +657,22 @@ def bin_data(data, num_bins):
     return x, y, max_y
 
 
-def stack_datasets(datasets):
+def stack_datasets(datasets, active_only=True):
     """ This is called by the plotting routines so we only collect those data series that
     are set to active in the dataset editor
     """
-    shapes = [ len(dataset.data) for dataset in datasets if dataset.metadata['ui'].active]
+    active_data = [ dataset.data for dataset in datasets
+                    if not active_only or dataset.metadata['ui'].active ]
+    # Datasets held in memory-mapped storage or packed by a DatasetCollection
+    # may be stackable without a copy
+    data = stacked_view(active_data)
+    if data is None:
+        data = packed_stack(active_data)
+    if data is not None:
+        return data
+    shapes = [ len(d) for d in active_data ]
     min_x_len = np.min(shapes)
-    data = np.asarray([ dataset.data[:min_x_len] for dataset in datasets if dataset.metadata['ui'].active ])
+    data = np.asarray([ d[:min_x_len] for d in active_data ])
 
 #    stack = np.vstack([data])
     return data
@@ -289,26 +683,11 @@ def interpolate_datasets(datasets, points):
     Regrid data onto a regular grid of n=points x-values.
     """
     x = datasets[:,:,0]
-    y = datasets[:,:,1]
-    flipped = False
-    if x[0,0] > x[0,-1]:
-        # x's are in descending order, spline interplotaion assumes ascending order,
-        # so flip all data along x and unflip it after interpolating
-        x = x[:,::-1]
-        y = y[:,::-1]
-        flipped = True
-
+    flipped = x[0,0] > x[0,-1]
     x_min = x.min(axis=1).max()
     x_max = x.max(axis=1).min()
     x_index = np.linspace(x_min, x_max, points)
-    y_data = None
-    for x_row, y_row in zip(x, y):
-        tck = interpolate.splrep(x_row, y_row, s=0, k=1)
-        y_new = interpolate.splev(x_index, tck, der=0)
-        if y_data is None:
-            y_data = array([y_new])
-        else:
-            y_data = np.vstack([y_data , y_new])
+    y_data, _ = regrid_arrays(datasets, x_index)
     if flipped:
         x_index = x_index[::-1]
         y_data = y_data[:,::-1]
@@ -341,6 +720,27 @@ def clean_gaps(data, gap_threshold=0.1, shave_number=5):
     return np.delete(data, deletion_indices, axis=0)
 
 
+MERGE_LABELS = {'merge': 'm', 'splice': 's', 'bin': 'w'}
+
+def combine_pair(d1, d2, merge_method, interval=DEFAULT_REGRID_INTERVAL):
+    if merge_method == 'merge':
+        return combine_by_merge(d1, d2)
+    elif merge_method == 'splice':
+        return combine_by_splice(d1, d2)
+    elif merge_method == 'bin':
+        return combine_by_binning(d1, d2, interval)
+    raise ValueError('Merge method not understood')
+
+
+def shift_x(data, offset):
+    """
+    Returns a copy of the data with offset added to the x values.
+    """
+    data = data.copy()
+    data[:,0] += offset
+    return data
+
+
 def combine_by_merge(d1, d2):
     """
     d1 and d2 are Nx3 arrays of xye data.
@@ -361,22 +761,89 @@ def combine_by_merge(d1, d2):
     return new_data[x_uniq]
 
 
+def combine_by_binning(d1, d2, interval=DEFAULT_REGRID_INTERVAL, start=None):
+    """
+    d1 and d2 are Nx3 arrays of xye data.
+    Merge the datasets onto a regular grid of x values spaced by interval, starting at
+    start or else at the lowest x value of either dataset. Each point falls in the bin of
+    its nearest grid value, and the points in each bin are combined by their mean
+    weighted by 1/e**2, with uncertainty 1/sqrt(sum(1/e**2)). Points with e <= 0 carry no
+    weight unless the bin has no others, when their plain mean is taken with e = 0.
+    Bins without any points, e.g. where the detector gaps of both datasets overlap, are
+    left out. Assumes that the 'gaps' in both have been cleaned by clean_gaps().
+    This is a single pass over the data, with no sorting.
+    """
+    combined = np.concatenate([d1[:,:3], d2[:,:3]]).astype(np.double)
+    x, y, e = combined.T
+    if start is None:
+        start = x.min()
+    bins = np.rint((x - start) / interval).astype(np.intp)
+    # discard points below a given start
+    valid = bins >= 0
+    if not valid.all():
+        bins, x, y, e = bins[valid], x[valid], y[valid], e[valid]
+    nbins = bins.max() + 1 if len(bins) else 0
+    weighted = e > 0
+    weights = np.zeros_like(e)
+    weights[weighted] = 1.0 / e[weighted]**2
+    sum_weights = np.bincount(bins, weights, nbins)
+    sum_weighted_y = np.bincount(bins, weights*y, nbins)
+    counts = np.bincount(bins, minlength=nbins)
+    occupied = counts > 0
+    new_data = np.empty((occupied.sum(), 3))
+    new_data[:,0] = start + interval*np.flatnonzero(occupied)
+    sum_weights = sum_weights[occupied]
+    have_weights = sum_weights > 0
+    new_y = new_data[:,1]
+    new_e = new_data[:,2]
+    new_y[have_weights] = sum_weighted_y[occupied][have_weights] / sum_weights[have_weights]
+    new_e[have_weights] = 1.0 / np.sqrt(sum_weights[have_weights])
+    if not have_weights.all():
+        # bins with only zero-error points
+        plain_mean = np.bincount(bins, y, nbins)[occupied] / counts[occupied]
+        new_y[~have_weights] = plain_mean[~have_weights]
+        new_e[~have_weights] = 0.0
+    return new_data
+
+
+def merge_sorted(a, b):
+    """
+    a and b are Nx3 arrays of xye data, each sorted by x.
+    Returns the rows of both in x-sorted order, with the rows of a before any rows of
+    b with the same x value, without re-sorting.
+    """
+    merged = np.empty((len(a) + len(b), a.shape[1]), dtype=np.result_type(a, b))
+    a_positions = np.arange(len(a)) + np.searchsorted(b[:,0], a[:,0], side='left')
+    b_positions = np.arange(len(b)) + np.searchsorted(a[:,0], b[:,0], side='right')
+    merged[a_positions] = a
+    merged[b_positions] = b
+    return merged
+
+
 def combine_by_splice(d1, d2, gap_threshold=0.1):
     """
     d1 and d2 are Nx3 arrays of xye data.
     Replace the 'gaps' in d1 by valid data in the corresponding parts of d2.
-    Assumes that the 'gaps' in d1 have been cleaned by a call to clean_gaps().
+    Assumes that the 'gaps' in d1 have been cleaned by a call to clean_gaps() and that
+    d1 is sorted by x, as read from the detector.
+    If any points have exactly duplicated x values only the first is kept.
     """
     # Identify the gaps in d1
     gap_indices = np.where(np.diff(d1[:,0]) > gap_threshold)[0]
-    # get the x or 2theta value ranges for the samples at the edges of the gaps in d1
-    x_edges = np.c_[d1[:,0][gap_indices], d1[:,0][gap_indices + 1]]
-    # for each identified gap in d1, insert that segment from d2
-    d1 = d1[:]
-    for lower, upper in x_edges:
-        new_segment = d2[(d2[:,0] > lower) & (d2[:,0] < upper)]
-        d1 = combine_by_merge(d1, new_segment)
-    return d1
+    if len(gap_indices) == 0:
+        return d1[:]
+    if np.any(np.diff(d2[:,0]) < 0):
+        d2 = d2[d2[:,0].argsort(kind='mergesort')]
+    # The d2 samples strictly inside each gap in d1 are the rows lo:hi of d2
+    lo = np.searchsorted(d2[:,0], d1[gap_indices,0], side='right')
+    hi = np.searchsorted(d2[:,0], d1[gap_indices+1,0], side='left')
+    counts = np.maximum(hi - lo, 0)
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    segment_indices = np.repeat(lo - starts, counts) + np.arange(counts.sum())
+    new_data = merge_sorted(d1, d2[segment_indices])
+    # Remove duplicate x values that interfere with interpolation
+    x_uniq = np.r_[True, np.diff(new_data[:,0]) > 0]
+    return new_data[x_uniq]
 
 
 def splice_overlapping_data(d1, d2):
@@ -442,13 +909,121 @@ def regrid_data(data, start=None, end=None, interval=0.00375):
     return new_data
 
 
+def regular_grid(start, end, interval):
+    """
+    Returns the x values from start to end (inclusive, allowing for rounding) spaced by
+    interval, as used by regrid_data().
+    """
+    return np.arange(start, end+interval/100.0, interval)
+
+
+def ascending_data(data):
+    """
+    Returns the Nx3 data, or a reversed view of it if its x values descend.
+    """
+    if len(data) > 1 and data[0,0] > data[-1,0]:
+        return data[::-1]
+    return data
+
+
+def _interp_indices(x, xs):
+    """
+    Returns (lo, hi, t) such that np.interp(xs, x, y) == y[lo] + (y[hi] - y[lo])*t.
+    """
+    n = len(x)
+    lo = np.clip(np.searchsorted(x, xs, side='right') - 1, 0, max(n - 2, 0))
+    hi = np.minimum(lo + 1, n - 1)
+    dx = x[hi] - x[lo]
+    steps = dx > 0
+    t = np.zeros(len(xs))
+    t[steps] = (xs[steps] - x[lo][steps]) / dx[steps]
+    t[~steps & (xs > x[lo])] = 1.0
+    return lo, hi, np.clip(t, 0.0, 1.0)
+
+
+def shared_x_groups(arrays):
+    """
+    Returns a list of (x, rows) tuples grouping the indices of the arrays with
+    identical (ascending) x values.
+    """
+    groups = {}
+    for i, a in enumerate(arrays):
+        x = ascending_data(a)[:,0]
+        candidates = groups.setdefault((len(x), x[0], x[-1]), [])
+        for group_x, rows in candidates:
+            if group_x is x or np.array_equal(group_x, x):
+                rows.append(i)
+                break
+        else:
+            candidates.append((x, [i]))
+    return [ group for group_list in groups.itervalues() for group in group_list ]
+
+
+def regrid_arrays(arrays, xs, workers=1):
+    """
+    arrays is a list of Nx3 arrays of xye data, which may differ in length, or an
+    MxNx3 stack of them.
+    Linearly interpolates the y and e values of every array at the ascending x values
+    xs, as regrid_data() does for a single array; beyond its ends each array takes its
+    end values. The search for the interpolation indices is done once for each distinct
+    set of x values, so a stack of datasets on a common grid costs little more than
+    interpolating its y and e values. The rows are shared among <workers> threads.
+    Returns (y, e), two MxK arrays where K is len(xs).
+    """
+    xs = np.asarray(xs, dtype=np.double)
+    y = np.empty((len(arrays), len(xs)))
+    e = np.empty_like(y)
+
+    def regrid_rows(job):
+        lo, hi, t, rows = job
+        step = np.empty(len(xs))
+        for i in rows:
+            data = ascending_data(arrays[i])
+            for column, out in [(1, y[i]), (2, e[i])]:
+                values = np.ascontiguousarray(data[:,column], dtype=np.double)
+                # out = values[lo] + (values[hi] - values[lo])*t, without temporaries
+                values.take(lo, out=out)
+                values.take(hi, out=step)
+                step -= out
+                step *= t
+                out += step
+
+    jobs = []
+    for x, rows in shared_x_groups(arrays):
+        lo, hi, t = _interp_indices(np.asarray(x, dtype=np.double), xs)
+        step = max(1, -(-len(rows) // max(workers, 1)))
+        jobs.extend((lo, hi, t, rows[i:i+step]) for i in xrange(0, len(rows), step))
+    if workers <= 1 or len(jobs) <= 1:
+        map(regrid_rows, jobs)
+    else:
+        pool = ThreadPool(min(workers, len(jobs)))
+        try:
+            pool.map(regrid_rows, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return y, e
+
+
+BEAM_INTENSITY_KEY = 'Integrated Ion Chamber Count(counts)'
+
+def normalisation_factor(reference, dataset):
+    """
+    Returns the factor that normalises the y-values of dataset to those of reference,
+    based on the measured beam intensity.
+    """
+    if reference.name == dataset.name:
+        return 1.0
+    return reference.metadata[BEAM_INTENSITY_KEY] / dataset.metadata[BEAM_INTENSITY_KEY]
+
+
 def normalise_dataset(dataset_pair):
     """
     For a pair of datasets, normalise the y-values of the second dataset with respect
     to the first, based on the measured beam intensity.
     """
     dataset1, dataset2 = dataset_pair
-    key = 'Integrated Ion Chamber Count(counts)'
+    key = BEAM_INTENSITY_KEY
     data = dataset2.data.copy()
     if dataset1.name != dataset2.name:
         data[:,1] *= dataset1.metadata[key] / dataset2.metadata[key]            # renormalise y-value
@@ -456,26 +1031,176 @@ def normalise_dataset(dataset_pair):
     return data
 
 
-def get_peak_offsets_for_all_dataseries(range_low, range_high, datasets):
+def normalise_data(arrays, factors):
+    """
+    Scales the y-values of each Nx3 array by the corresponding factor and the
+    uncertainties by its square root, returning new arrays.
+    If the arrays can be stacked without copying (i.e. they are rows of a packed
+    DatasetCollection or of memory-mapped storage), this is done in one operation on a
+    new stacked block and the returned arrays are rows of that block.
+    """
+    if not arrays:
+        return []
+    factors = np.asarray(factors, dtype=float)
+    stack = stacked_view(arrays)
+    if stack is None:
+        stack = packed_stack(arrays)
+    if stack is not None:
+        data = np.array(stack)
+        data[:,:,1] *= factors[:,np.newaxis]
+        data[:,:,2] *= np.sqrt(factors)[:,np.newaxis]
+        return list(data)
+    normalised = []
+    for a, factor in zip(arrays, factors):
+        data = a.copy()
+        data[:,1] *= factor
+        data[:,2] *= np.sqrt(factor)
+        normalised.append(data)
+    return normalised
+
+
+def _parabolic_maxima(rows):
+    """
+    Returns (positions, interior) for the maximum of each row of a 2D array: its
+    sub-sample position from a parabola through the maximum and its neighbours, and
+    whether the maximum lies inside the row rather than at an end.
+    """
+    m, n = rows.shape
+    peaks = rows.argmax(axis=1)
+    interior = (peaks > 0) & (peaks < n - 1)
+    i = np.clip(peaks, 1, n - 2)
+    r = np.arange(m)
+    a, b, c = rows[r, i-1], rows[r, i], rows[r, i+1]
+    curvature = a - 2*b + c
+    shift = np.zeros(m)
+    ok = interior & (curvature < 0)
+    shift[ok] = 0.5*(a[ok] - c[ok]) / curvature[ok]
+    return peaks + np.clip(shift, -0.5, 0.5), interior
+
+
+def cross_correlation_offsets(range_low, range_high, arrays, references):
+    """
+    Estimates the 2theta offset of each xye array in <arrays> from the corresponding
+    array in <references> (or from <references> itself if it is a single array) by
+    cross-correlating their data between range_low and range_high.
+    All the arrays are resampled onto one grid with the reference's sample spacing by
+    regrid_arrays(), windowed, and cross-correlated with a single batch of FFTs; the
+    offset is refined to a fraction of a sample by fitting a parabola to the
+    correlation peak. Offsets are limited to half the width of the range.
+    Returns (offsets, valid), arrays of the offsets and of whether each correlation
+    peak lay within that limit.
+    """
+    single_reference = not isinstance(references, (list, tuple)) and np.ndim(references) == 2
+    first_reference = references if single_reference else references[0]
+    in_range = (first_reference[:,0] >= range_low) & (first_reference[:,0] <= range_high)
+    if in_range.sum() < 3:
+        raise ValueError('Too few samples between {} and {}'.format(range_low, range_high))
+    interval = np.median(np.abs(np.diff(first_reference[in_range,0])))
+    xs = regular_grid(range_low, range_high, interval)
+    k = len(xs)
+    y, _ = regrid_arrays(arrays, xs)
+    r, _ = regrid_arrays([first_reference] if single_reference else references, xs)
+    window = np.hanning(k)
+    y = (y - y.mean(axis=1)[:,np.newaxis]) * window
+    r = (r - r.mean(axis=1)[:,np.newaxis]) * window
+    # zero-padded to 2k so the correlation doesn't wrap around
+    n = 2*k
+    correlation = np.fft.irfft(np.fft.rfft(y, n) * np.conj(np.fft.rfft(r, n)), n)
+    # rearrange into lags -h..h
+    h = k // 2
+    correlation = np.concatenate([correlation[:, n-h:], correlation[:, :h+1]], axis=1)
+    lags, valid = _parabolic_maxima(correlation)
+    return (lags - h)*interval, valid
+
+
+def _peak_positions(range_low, range_high, arrays):
+    """
+    Returns the 2theta of the highest point of each array between range_low and
+    range_high, refined by a parabola through the neighbouring samples.
+    """
+    positions = []
+    for a in arrays:
+        window = a[(a[:,0] >= range_low) & (a[:,0] <= range_high)]
+        if len(window) == 0:
+            positions.append(None)
+            continue
+        position, interior = _parabolic_maxima(window[np.newaxis,:,1])
+        index = int(np.floor(position[0]))
+        fraction = position[0] - index
+        if index + 1 < len(window):
+            positions.append(window[index,0] + fraction*(window[index+1,0] - window[index,0]))
+        else:
+            positions.append(window[index,0])
+    return positions
+
+
+def align_by_cross_correlation(range_low, range_high, datasets, reference=None):
+    """
+    Stores a 'peak_fit' for every dataset as get_peak_offsets_for_all_dataseries()
+    does, but from cross_correlation_offsets() relative to <reference> (by default the
+    first dataset): the position of the reference's highest point in the range plus
+    the dataset's offset from the reference. Differences between 'peak_fit' values are
+    the offsets between the datasets, which is all that alignment uses.
+    Datasets whose offset couldn't be found get a 'peak_fit' of None.
+    """
+    if not datasets:
+        return
+    if reference is None:
+        reference = datasets[0]
+    offsets, valid = cross_correlation_offsets(range_low, range_high,
+                                               [ d.data for d in datasets ], reference.data)
+    centre, = _peak_positions(range_low, range_high, [reference.data])
+    for dataset, offset, ok in zip(datasets, offsets, valid):
+        dataset.add_param('peak_fit', centre + offset if ok else None)
+
+
+def align_pairs_by_cross_correlation(range_low, range_high, dataset_pairs):
+    """
+    The cross-correlation equivalent of calling fit_peaks_for_a_dataset_pair() for
+    every pair: the second dataset of each pair is aligned to the first, with all the
+    pairs correlated in one batch. 'peak_fit' is stored in both datasets of a pair only
+    if its offset was found.
+    Returns a list of True/False for the success of each pair.
+    """
+    if not dataset_pairs:
+        return []
+    firsts = [ pair[0].data for pair in dataset_pairs ]
+    offsets, valid = cross_correlation_offsets(range_low, range_high,
+                                               [ pair[1].data for pair in dataset_pairs ], firsts)
+    centres = _peak_positions(range_low, range_high, firsts)
+    results = []
+    for (dataset, dataset2), offset, ok, centre in zip(dataset_pairs, offsets, valid, centres):
+        ok = bool(ok) and centre is not None
+        if ok:
+            dataset.add_param('peak_fit', centre)
+            dataset2.add_param('peak_fit', centre + offset)
+        results.append(ok)
+    return results
+
+
+def get_peak_offsets_for_all_dataseries(range_low, range_high, datasets, method='fit'):
     """
     Perform peak detection for every dataset within the defined range.
     If successful, the fit result is appended to the XYEDataset item metadata.
     The fit result can be a float or None in the case of a series that could not be fitted.
+    <method> is 'fit' to fit a peak shape to each dataset, or 'xcorr' to find each
+    dataset's offset from the first by align_by_cross_correlation(), which is much faster.
     """
+    if method == 'xcorr':
+        align_by_cross_correlation(range_low, range_high, datasets)
+        return
+    # each fit starts from the previous successful one
+    p0 = None
     for dataset in datasets:
-        x_range = (dataset.x() >= range_low) & (dataset.x() <= range_high)
-        # Get the baseline by using a median filter 3x as long as the selection
-        filter_length = 3*int(len(dataset.x())*(range_high-range_low)/(dataset.x()[-1]-dataset.x()[0]))
-        # restrict filter length to a sane value
-        if filter_length > 10000:               filter_length = 10000
-        if filter_length < 20:                  filter_length = 20
-        if filter_length > len(dataset.x())/2:  filter_length = len(dataset.x())/2
-        y_baseline = sn.filters.median_filter(dataset.y(), size=filter_length, mode='nearest')
-        # get just the data in the range defined by the range_low, range_high parameters
+        # Get the baseline by using a median filter 3x as long as the selection, computed
+        # just for the data in the range defined by the range_low, range_high parameters
+        x_range, y_baseline = window_baseline(dataset.x(), dataset.y(), range_low, range_high)
         data_x, data_y = dataset.data[x_range][:,:2].T
-        data_y_baseline_removed = data_y - y_baseline[x_range]
-        fit_centre, _ = fit_peak_2theta(data_x, data_y_baseline_removed)
-        dataset.add_param('peak_fit', fit_centre)
+        data_y_baseline_removed = data_y - y_baseline
+        fit_centre, p, fit_successful = fit_peak_2theta_lsq(data_x, data_y_baseline_removed, p0)
+        if fit_successful:
+            p0 = p
+        dataset.add_param('peak_fit', fit_centre if fit_successful else None)
 
 
 def fit_peaks_for_a_dataset_pair(range_low, range_high, dataset_pair, normalise_checked):
@@ -490,6 +1215,31 @@ def fit_peaks_for_a_dataset_pair(range_low, range_high, dataset_pair, normalise_
     The fit result can be a float or None in the case of a series that could not be fitted.
     Returns True if the peaks were fitted successfully in both positions, else returns False.
     """
+    return _fit_dataset_pair(range_low, range_high, dataset_pair, normalise_checked)[0]
+
+
+def fit_peaks_for_dataset_pairs(range_low, range_high, dataset_pairs, normalise_checked):
+    """
+    Equivalent to calling fit_peaks_for_a_dataset_pair() for each pair, but each fit
+    starts from the parameters of the previous successful one, which for a series of
+    similar datasets converges in a few iterations.
+    Returns a list of True/False for the success of each pair.
+    """
+    results = []
+    p0 = None
+    for dataset_pair in dataset_pairs:
+        success, p = _fit_dataset_pair(range_low, range_high, dataset_pair, normalise_checked, p0)
+        if success:
+            p0 = p
+        results.append(success)
+    return results
+
+
+def _fit_dataset_pair(range_low, range_high, dataset_pair, normalise_checked, p0=None):
+    """
+    Returns (success, p) for fit_peaks_for_a_dataset_pair(), where p is the peak shape
+    fitted to the first dataset, starting from p0 if given.
+    """
     dataset, dataset2 = dataset_pair
     x_range = (dataset.x() >= range_low) & (dataset.x() <= range_high)
     data_x, data_y = dataset.data[x_range][:,:2].T
@@ -499,18 +1249,12 @@ def fit_peaks_for_a_dataset_pair(range_low, range_high, dataset_pair, normalise_
     enable_filter = False
     if enable_filter:
         # Get the baseline by using a median filter 3x as long as the selection
-        filter_length = 3*int(len(dataset.x())*(range_high-range_low)/(dataset.x()[-1]-dataset.x()[0]))
-        # restrict filter length to a sane value
-        if filter_length > 10000:               filter_length = 10000
-        if filter_length < 20:                  filter_length = 20
-        if filter_length > len(dataset.x())/2:  filter_length = len(dataset.x())/2
-        y_baseline = sn.filters.median_filter(dataset.y(), size=filter_length, mode='nearest')
-        # get just the data in the range defined by the range_low, range_high parameters
-        data_y_baseline_removed = data_y - y_baseline[x_range]
-        fit_centre, fit_parameters = fit_peak_2theta(data_x, data_y_baseline_removed)
-    else:
-        fit_centre, fit_parameters = fit_peak_2theta(data_x, data_y)
-    
+        _, y_baseline = window_baseline(dataset.x(), dataset.y(), range_low, range_high)
+        data_y = data_y - y_baseline
+    fit_centre, fit_parameters, fit_successful = fit_peak_2theta_lsq(data_x, data_y, p0)
+    if not fit_successful:
+        return False, fit_parameters
+
     # If the fit was successful, fit the second dataset.
     # First dataset was fit successfully, fit the other dataset with the peak fitting result.
     x_range = (dataset2.x() >= range_low) & (dataset2.x() <= range_high)
@@ -518,15 +1262,83 @@ def fit_peaks_for_a_dataset_pair(range_low, range_high, dataset_pair, normalise_
 
     # Normalise the second dataset's y values if necessary
     if normalise_checked:
-        key = 'Integrated Ion Chamber Count(counts)'
-        data_y *= dataset.metadata[key] / dataset2.metadata[key]
+        data_y = data_y * (dataset.metadata[BEAM_INTENSITY_KEY] / dataset2.metadata[BEAM_INTENSITY_KEY])
 
     fit2_centre, fit2_successful = fit_modeled_peak_to_data(data_x, data_y, fit_parameters)
     # Store the fit results if both data series were successfully fitted.
     if fit2_successful:
         dataset.add_param('peak_fit', fit_centre)
         dataset2.add_param('peak_fit', fit2_centre)
-    return fit2_successful
+    return fit2_successful, fit_parameters
+
+
+def peak_function(p, x):
+    """
+    The Gaussian+Lorentzian+Constant peak shape fitted by the peak fitting functions.
+    p[0] and p[3] are the amplitudes of the respective components
+    p[1] and p[4] are the centres of the respective functions
+    p[2] and p[5] are the widths of the respective functions
+    p[6] is a flat background
+    """
+    return p[0]*exp(-((x-p[1])/p[2])**2/2.0) + \
+           p[3]*(p[5]**2/((x-p[4])**2 + p[5]**2)) + p[6]
+
+
+def peak_function_jacobian(p, x):
+    """
+    Returns the len(x)x7 array of the derivatives of peak_function() with respect to
+    each of the parameters p.
+    """
+    jacobian = np.empty((len(x), 7))
+    dx = x - p[1]
+    gaussian = exp(-(dx/p[2])**2/2.0)
+    jacobian[:,0] = gaussian
+    jacobian[:,1] = p[0]*gaussian*dx/p[2]**2
+    jacobian[:,2] = p[0]*gaussian*dx**2/p[2]**3
+    dx = x - p[4]
+    denominator = dx**2 + p[5]**2
+    jacobian[:,3] = p[5]**2/denominator
+    jacobian[:,4] = 2*p[3]*p[5]**2*dx/denominator**2
+    jacobian[:,5] = 2*p[3]*p[5]*dx**2/denominator**2
+    jacobian[:,6] = 1.0
+    return jacobian
+
+
+def fit_peak_2theta_lsq(data_x, data_y, p0=None):
+    """
+    Fits the same Gaussian+Lorentzian+Constant, within the same bounds, as
+    fit_peak_2theta(), but by bounded least squares with the analytic derivatives of
+    peak_function(), which needs far fewer function evaluations.
+    <p0> is an optional starting point, e.g. the result of fitting a similar dataset;
+    it is moved inside the bounds if necessary.
+    Returns a tuple (centre, p, success) where centre is the 2theta value of the higher
+    of the gaussian or lorentzian peak and p is the list of all the parameters.
+    """
+    if len(data_x) < 7:
+        return None, p0, False
+    x_peak_candidate_centre = (data_x[0] + data_x[-1])/2.0
+    x_peak_candidate_width = (data_x[-1] - data_x[0])/2.0
+    peak_height = data_y.max() - data_y.min()
+    if peak_height <= 0 or x_peak_candidate_width <= 0:
+        return None, p0, False
+    lower = np.r_[0.0, data_x[0], x_peak_candidate_width/10,
+                  0.0, data_x[0], x_peak_candidate_width/10, min(0.0, data_y.min())]
+    upper = np.r_[1.2*peak_height, data_x[-1], 10*x_peak_candidate_width,
+                  1.2*peak_height, data_x[-1], 6*x_peak_candidate_width, max(data_y.max(), 1e-12)]
+    if p0 is None:
+        p0 = np.r_[peak_height/2.0,
+                   x_peak_candidate_centre,
+                   x_peak_candidate_width,
+                   peak_height/2.0,
+                   x_peak_candidate_centre,
+                   x_peak_candidate_width,
+                   data_y.min()]
+    p0 = np.clip(p0, lower, upper)
+    result = so.least_squares(lambda p: peak_function(p, data_x) - data_y, p0,
+                              jac=lambda p: peak_function_jacobian(p, data_x),
+                              bounds=(lower, upper), method='trf', x_scale='jac')
+    p = result.x
+    return (p[1] if p[0] > p[3] else p[4], p, result.success)
 
 
 def fit_peak_2theta(data_x, data_y, plot=False):
@@ -587,6 +1399,7 @@ def fit_peak_2theta(data_x, data_y, plot=False):
                                 epsilon=(data_x[-1]-data_x[0])/1000, disp=0, maxfun=1000)
 
     if plot:
+        import matplotlib.pyplot as plt
         plt.plot(data_x, foreground_ys)
         x_samples = np.linspace(data_x[0], data_x[-1], 1000)
         plt.plot(x_samples, fit_function(p, x_samples))
@@ -625,16 +1438,25 @@ def fit_modeled_peak_to_data(data_x, data_y, p0, plot=False):
                                 p0[3]*(p0[5]**2/((x-p0[4]-x_offset[0])**2 + p0[5]**2)) + p0[6]
     fit_function_error = lambda p, x, y: (fit_function(p,x) - y)    # 1d Gaussian + Lorentzian fit
 
+    # d(fit_function)/d(x_offset) is the sum of the derivatives with respect to the centres
+    fit_function_derivative = lambda x_offset, x, y: \
+        peak_function_jacobian(np.r_[p0[:1], p0[1]+x_offset[0], p0[2:4],
+                                      p0[4]+x_offset[0], p0[5:7]], x)[:,[1,4]].sum(axis=1)[:,np.newaxis]
+
     x_offset0 = [0.0]
-    x_offset, success = so.leastsq(fit_function_error, x_offset0[:], args=(data_x, foreground_ys))
+    x_offset, success = so.leastsq(fit_function_error, x_offset0[:], args=(data_x, foreground_ys),
+                                   Dfun=fit_function_derivative)
 
-    if plot and success==1:
+    # leastsq returns 1 to 4 for convergence by any of its criteria
+    success = success in (1, 2, 3, 4)
+    if plot and success:
+        import matplotlib.pyplot as plt
         plt.plot(data_x, foreground_ys)
         x_samples = np.linspace(data_x[0], data_x[-1], 1000)
         plt.plot(x_samples, fit_function(x_offset, x_samples))
         plt.show()
 
-    return (p0[1]+x_offset[0] if p0[0] > p0[3] else p0[4]+x_offset[0], success==1)
+    return (p0[1]+x_offset[0] if p0[0] > p0[3] else p0[4]+x_offset[0], success)
 
 
 def rebin_preserving_peaks(a, samples):
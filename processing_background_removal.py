@@ -3,15 +3,30 @@ import scipy.ndimage as sn
 
 from numpy.polynomial.polynomial import polyfit, polyval
 from scipy import interpolate
-from processing import insert_descriptor
+from processing import insert_descriptor, ascending_data, shared_x_groups
 import re
 
 
 __doc__ = \
 """
 Routines to remove background.
+A background is subtracted from many datasets at once by subtract_background_arrays(),
+which evaluates it once for each group of datasets on the same 2theta grid and
+subtracts it from a 2D block of rows of the group at a time. Uncertainties are combined in
+quadrature; a fitted background curve is taken to have none.
 """
 
+# Rows subtracted in one operation; blocks of a few MB stay in cache and are much
+# quicker than one block of the whole group.
+BATCH_ROWS = 32
+
+# Curve types of CurveFitter that estimate the background directly from the data,
+# without a model or a fit; see estimate_backgrounds().
+BACKGROUND_ESTIMATORS = ['SNIP', 'Morphological opening']
+
+# Rows clipped together by snip_background(), which makes many passes over them
+SNIP_ROWS = 8
+
 def subtract_background_from_all_datasets(datasets, background_file, background_manual,fitter):
     processed_datasets = []
     
@@ -22,68 +37,38 @@ def subtract_background_from_all_datasets(datasets, background_file, background_
     
     # If there is a background file uploaded, use that
     if background_file is not None:
-        for d in datasets:
-            if background_file is not d:
-                # does there need to be s
-                dataset=subtract_background_with_file(d,background_file)
-                processed_datasets.append(dataset)
-                update_metadata(dataset)
+        foregrounds = [ d for d in datasets if d is not background_file ]
+        processed_datasets = subtract_background_from_datasets(foregrounds,
+                                                               file_background(background_file))
     # next check if there is a manually fitted background instead
     elif fitter is not None:
-        for d in datasets:
-            if d is not background_manual:
-                dataset=subtract_background_with_fit(d,fitter)
-                processed_datasets.append(dataset)
-                update_metadata(dataset)
+        foregrounds = [ d for d in datasets if d is not background_manual ]
+        processed_datasets = subtract_background_from_datasets(foregrounds,
+                                                               fitted_background(fitter))
     else:
         # first check if there is an individual curve fit attached to this dataset 
         for d in datasets:           
             if hasattr(d,'background') and d.background is not None:
                 dataset = subtract_background(d, d.background)
                 processed_datasets.append(dataset)
-                update_metadata(dataset)
         #Next see if there's a background file uploaded and use that
-              
+    for dataset in processed_datasets:
+        update_metadata(dataset)
     return processed_datasets
 
 def subtract_manual_background_from_all_datasets(datasets, fitter):
-    processed_datasets = []
-    for d in datasets:
-        dataset = subtract_background_with_fit(d, fitter)
-        processed_datasets.append(dataset)
+    processed_datasets = subtract_background_from_datasets(datasets, fitted_background(fitter))
+    for dataset in processed_datasets:
         dataset.name = insert_descriptor(dataset.name, 'b')
         dataset.metadata['ui'].name = dataset.name + ' (processed)'
         dataset.metadata['ui'].color = None
     return processed_datasets
 
-def subtract_background(foreground,background):
-    """
-    use this method for subtracting a background from a foreground where they have the same x datapoints
-    This is used where we fit a curve for an individual dataset
-    """
-    dataset = foreground.copy()
-    data = background.data
-    xs = dataset.data[:,0]
-    ys=np.clip(foreground.data[:,1] - background.data[:,1],0,max(dataset.data[:,1]))
-    dataset.data = np.c_[xs, ys, dataset.data[:,2]]
-    return dataset
-
-def subtract_background_with_fit(foreground,fitter):
-    background_dataset = foreground.copy()  
-    ys=np.clip(background_dataset.data[:,1]-fitter.eval_curve(background_dataset.data[:,0]),0,max(background_dataset.data[:,1]))
-    #ys=np.clip(ys,0,max(ys)) # truncate neg values to 0
-    e_interpolator = lambda xs: np.interp(xs, background_dataset.data[:,0], background_dataset.data[:,2])                         # linear interpolation
-    xs = background_dataset.data[:,0]
-    background_dataset.data = np.c_[xs, ys, background_dataset.data[:,2] + e_interpolator(background_dataset.data[:,0])]
-    return background_dataset
-
-def subtract_background_with_file(foreground, background):
+def file_background(background):
     '''
-    Resample background dataset at the same x-values as the forgeround and subtract it,
-    returning a new XYE dataset sans background.
+    Returns a function of the x-values giving the (y, e) values of a background dataset
+    resampled at them.
     '''
-    dataset = foreground.copy()
-
     data = background.data
     # Looking at the behaviour of the existing IDL code which uses the spline() fitting function with
     # sigma=15 and speaking to Qinfen, linear interpolation will probably work just as well and is extremely fast.
@@ -106,26 +91,157 @@ def subtract_background_with_file(foreground, background):
     # e_interpolator = interpolate.interp1d(data[:,0], data[:,2], kind='cubic')             # OK, as expected, but not as close at the 
     # e_interpolator = interpolate.interp1d(data[:,0], data[:,2], kind='nearest')           # probably unacceptable?
     e_interpolator = lambda xs: np.interp(xs, data[:,0], data[:,2])                         # linear interpolation
+    return lambda xs: (y_interpolator(xs), e_interpolator(xs))
+
+def fitted_background(fitter):
+    '''
+    Returns a function of the x-values giving the (y, e) values of the curve fitted by
+    a CurveFitter, which has no uncertainty.
+    '''
+    return lambda xs: (fitter.eval_curve(xs), 0.0)
+
+def subtract_background_arrays(arrays, background):
+    '''
+    Subtracts background(xs) -> (ys, es) from each Nx3 array, clipping the y-values to
+    between 0 and the array's largest y-value and adding the uncertainties in quadrature.
+    The background is evaluated once for each group of arrays with the same x-values,
+    and subtracted from BATCH_ROWS arrays of the group at a time.
+    Returns a list of new arrays.
+    '''
+    subtracted = [None]*len(arrays)
+    for xs, rows in shared_x_groups(arrays):
+        ys, es = background(xs)
+        for start in xrange(0, len(rows), BATCH_ROWS):
+            batch = rows[start:start + BATCH_ROWS]
+            ascending = [ ascending_data(arrays[i]) for i in batch ]
+            block = np.array(ascending)
+            result = np.empty(block.shape)
+            result[:,:,0] = xs
+            y = result[:,:,1]
+            np.subtract(block[:,:,1], ys, out=y)
+            np.clip(y, 0, block[:,:,1].max(axis=1)[:,np.newaxis], out=y)
+            np.hypot(block[:,:,2], es, out=result[:,:,2])
+            for i, a, data in zip(batch, ascending, result):
+                # put descending data back the way it was
+                subtracted[i] = data if a is arrays[i] else data[::-1]
+    return subtracted
 
+def subtract_background_from_datasets(datasets, background):
+    '''
+    Returns copies of the datasets with background(xs) -> (ys, es) subtracted, see
+    subtract_background_arrays().
+    '''
+    subtracted = []
+    arrays = subtract_background_arrays([ d.data for d in datasets ], background)
+    for d, data in zip(datasets, arrays):
+        dataset = d.copy()
+        dataset.data = data
+        subtracted.append(dataset)
+    return subtracted
+
+def subtract_background(foreground,background):
+    """
+    use this method for subtracting a background from a foreground where they have the same x datapoints
+    This is used where we fit a curve for an individual dataset
+    """
+    dataset = foreground.copy()
+    data = background.data
     xs = dataset.data[:,0]
-    ys=np.clip(dataset.data[:,1] - y_interpolator(xs),0,max(dataset.data[:,1]))
-    dataset.data = np.c_[xs, ys, dataset.data[:,2] + e_interpolator(xs)]
+    ys=np.clip(foreground.data[:,1] - background.data[:,1],0,max(dataset.data[:,1]))
+    dataset.data = np.c_[xs, ys, dataset.data[:,2]]
     return dataset
 
+def subtract_background_with_fit(foreground,fitter):
+    return subtract_background_from_datasets([foreground], fitted_background(fitter))[0]
+
+def subtract_background_with_file(foreground, background):
+    '''
+    Resample background dataset at the same x-values as the forgeround and subtract it,
+    returning a new XYE dataset sans background.
+    '''
+    return subtract_background_from_datasets([foreground], file_background(background))[0]
+
+def snip_background(y, iterations):
+    '''
+    Estimates the background under the peaks of the rows of y (or of a single pattern)
+    by SNIP clipping: over <iterations> passes with a window growing by one sample each
+    time, every sample is replaced by the mean of the samples at either end of the
+    window if that is lower. The clipping is done on the LLS transform of y, so the
+    background follows the base of strong and weak peaks alike.
+    The cost is O(n*iterations) for n samples, in a few array operations per pass on
+    a few rows at a time.
+    '''
+    y = np.asarray(y, dtype=float)
+    v = np.log(np.log(np.sqrt(np.maximum(y, 0) + 1) + 1) + 1)
+    n = y.shape[-1]
+    rows = v.reshape(-1, n)
+    means = np.empty((min(SNIP_ROWS, len(rows)), n))
+    for start in xrange(0, len(rows), SNIP_ROWS):
+        block = rows[start:start + SNIP_ROWS]
+        for p in xrange(1, min(iterations, (n - 1)/2) + 1):
+            mean = means[:len(block), :n-2*p]
+            np.add(block[:, :n-2*p], block[:, 2*p:], out=mean)
+            mean *= 0.5
+            clipped = block[:, p:n-p]
+            np.minimum(clipped, mean, out=clipped)
+    return (np.exp(np.exp(v) - 1) - 1)**2 - 1
+
+def opening_background(y, width):
+    '''
+    Estimates the background under the peaks of the rows of y (or of a single pattern)
+    by a morphological opening with a flat window of <width> samples, i.e. a running
+    minimum followed by a running maximum, which removes every peak narrower than the
+    window. The steps this leaves are smoothed by a running mean, limited to y.
+    Each filter costs O(n) for n samples whatever the width.
+    '''
+    y = np.asarray(y, dtype=float)
+    width = max(1, min(width, y.shape[-1]))
+    background = sn.minimum_filter1d(y, width, axis=-1, mode='nearest')
+    background = sn.maximum_filter1d(background, width, axis=-1, mode='nearest')
+    background = sn.uniform_filter1d(background, width, axis=-1, mode='nearest')
+    return np.minimum(background, y)
+
+def estimate_backgrounds(arrays, curve_type, size):
+    '''
+    Returns the background y-values of each Nx3 array estimated by one of the
+    BACKGROUND_ESTIMATORS, with <size> its number of iterations or window width in
+    samples. Arrays of the same length are estimated together as one 2D block.
+    '''
+    estimator = {'SNIP': snip_background,
+                 'Morphological opening': opening_background}[curve_type]
+    backgrounds = [None]*len(arrays)
+    lengths = {}
+    for i, a in enumerate(arrays):
+        lengths.setdefault(len(a), []).append(i)
+    for rows in lengths.itervalues():
+        block = estimator(np.array([ arrays[i][:,1] for i in rows ]), size)
+        for i, background in zip(rows, block):
+            backgrounds[i] = background
+    return backgrounds
+
 def get_subtracted_datasets(datasets):
     subtracted_datasets=[]
     for d in datasets:
-        if re.search(r'_n?s?m?g?bt?_\d+.xye?',d.name):
+        if re.search(r'_n?s?m?w?g?bt?_\d+.xye?',d.name):
             subtracted_datasets.append(d)
     return subtracted_datasets
 
 
 class CurveFitter:
     def __init__(self, curve_type, deg):
+        """
+        <curve_type> is 'Spline', 'Polynomial' or one of BACKGROUND_ESTIMATORS, for which
+        <deg> is the number of iterations or window width in samples.
+        """
         self.fit_func = {'Spline' : self._fit_spline_to_background,
-                         'Polynomial' : self._fit_poly_to_background}[curve_type]
+                         'Polynomial' : self._fit_poly_to_background,
+                         'SNIP' : self._estimate_background,
+                         'Morphological opening' : self._estimate_background}[curve_type]
         self.eval_func = {'Spline' : self._eval_spline_at_xs,
-                          'Polynomial' : self._eval_poly_at_xs}[curve_type]
+                          'Polynomial' : self._eval_poly_at_xs,
+                          'SNIP' : self._eval_background_at_xs,
+                          'Morphological opening' : self._eval_background_at_xs}[curve_type]
+        self.curve_type = curve_type
         self.deg = deg
         self.min_filter_length = 100 
         self.numpoints=curve_type
@@ -150,7 +266,7 @@ class CurveFitter:
         dataset2 = dataset.copy()
         if min_filter:
             filter_length = dataset.data.shape[0]/self.deg/2
-            dataset2.data[:,1] = \
+            dataset2.writable_data()[:,1] = \
                 sn.filters.minimum_filter(dataset.data[:,1], size=filter_length, mode='nearest')
         self.coefs = self._fit_poly(dataset2)
         return self.coefs
@@ -162,7 +278,7 @@ class CurveFitter:
         dataset2 = dataset.copy()
         if min_filter:
             filter_length = dataset.data.shape[0]/self.deg/2
-            dataset2.data[:,1] = \
+            dataset2.writable_data()[:,1] = \
                 sn.filters.minimum_filter(dataset.data[:,1], size=filter_length, mode='nearest')
         factor = dataset2.data.shape[0]/10
         self.y_interpolator = interpolate.UnivariateSpline(dataset2.data[::factor,0], dataset2.data[::factor,1], s=0)
@@ -171,6 +287,14 @@ class CurveFitter:
     def _eval_spline_at_xs(self, xs):
         return self.y_interpolator(xs)
 
+    def _estimate_background(self, dataset, min_filter=True):
+        data = ascending_data(dataset.data)
+        self.background = np.c_[data[:,0], estimate_backgrounds([data], self.curve_type, self.deg)[0]]
+        return self.background
+
+    def _eval_background_at_xs(self, xs):
+        return np.interp(xs, self.background[:,0], self.background[:,1])
+
                
     def _background_test(self,xdata,order,params):
         background=np.zeros_like(xdata)
@@ -5,3 +5,23 @@ undo_button = 'right'
 tick_font = 'modern 16'
 axis_title_font = 'modern 16'
 
+
+# Binary cache of parsed data files, see xye_cache.py.
+# Setting the PDVIPER_NO_CACHE environment variable also disables the cache.
+xye_cache_enabled = True
+xye_cache_max_size = 512*1024*1024     # bytes
+
+# Keep the data of loaded datasets in a memory-mapped file rather than in RAM,
+# see dataset_storage.py. None puts the file in the system temporary directory.
+memmap_datasets = False
+memmap_directory = None
+
+# Memory for caching the intermediate results of processing, see stage_cache.py.
+# 0 disables the cache.
+stage_cache_max_size = 256*1024*1024      # bytes
+
+# Threads used to regrid the rows of the 2D surface plot, see processing.regrid_arrays().
+regrid_threads = 4
+
+# Memory for the arrays kept only by the undo history, see undo_history.py.
+undo_history_max_size = 256*1024*1024     # bytes
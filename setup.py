@@ -13,7 +13,7 @@ setup(
         "docutils",
 	"numpy",
         "chaco",
-        "scipy",
+        "scipy>=0.17",
 	"enable",
 	"traits ",
 	"traitsui",
@@ -0,0 +1,99 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+import settings
+
+__doc__ = \
+"""
+An in-memory cache of the outputs of the stages of DatasetProcessor's pair pipeline
+(normalise -> clean_gaps -> zero-correct/align -> merge/splice -> regrid).
+Each stage output is keyed by a hash of the key of its input and the stage's
+parameters; the first key is a hash of the input arrays themselves. Changing one
+option therefore changes the keys of that stage and those downstream of it only, so
+pressing Process again after e.g. changing the regrid interval reuses the cached
+outputs of every earlier stage.
+The cache holds at most max_size bytes of arrays, evicting the least recently used
+outputs first. Cached arrays are made read-only, since they may be shared by several
+runs.
+"""
+
+
+def array_key(*arrays):
+    """
+    Returns a key identifying the contents of the arrays.
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str(a.dtype) + str(a.shape))
+        h.update(a.view(np.uint8))
+    return h.hexdigest()
+
+
+def stage_key(input_key, stage, params):
+    """
+    Returns the key of the output of <stage> run with <params> on the input identified by
+    input_key. <params> must have a repr() that identifies it, e.g. a tuple of numbers.
+    """
+    return hashlib.sha1(repr((input_key, stage, params))).hexdigest()
+
+
+class StageCache(object):
+    def __init__(self, max_size=settings.stage_cache_max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()       # key -> tuple of arrays, least recently used first
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the tuple of arrays stored under key, or None.
+        """
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a tuple of arrays under key. The arrays are made read-only, unless they're
+        too big to store.
+        """
+        if key in self._entries:
+            self.get(key)
+            return
+        nbytes = sum(a.nbytes for a in value)
+        if nbytes > self.max_size:
+            return
+        for a in value:
+            a.flags.writeable = False
+        self._entries[key] = value
+        self.size += nbytes
+        while self.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= sum(a.nbytes for a in evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+_default_cache = None
+
+def default_cache():
+    """
+    Returns the stage cache shared by DatasetProcessors, or None if disabled.
+    """
+    global _default_cache
+    if settings.stage_cache_max_size <= 0:
+        return None
+    if _default_cache is None:
+        _default_cache = StageCache()
+    return _default_cache
@@ -0,0 +1,34 @@
+import unittest
+
+import numpy as np
+import scipy.ndimage as sn
+from nose.tools import eq_
+
+from baseline import running_median, window_baseline, baseline_filter_length
+
+
+class RunningMedianTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.y = rng.rand(500)
+        # many tied values
+        self.y_ties = rng.randint(0, 4, 500).astype(float)
+
+    def matches_median_filter_test(self):
+        for y in [self.y, self.y_ties]:
+            for size in [1, 2, 7, 50, 501, 1200]:
+                expected = sn.median_filter(y, size=size, mode='nearest')
+                assert np.array_equal(running_median(y, size), expected)
+                assert np.array_equal(running_median(y, size, 100, 130), expected[100:130])
+                assert np.array_equal(running_median(y, size, 480), expected[480:])
+
+    def empty_range_test(self):
+        eq_(len(running_median(self.y, 5, 10, 10)), 0)
+
+    def window_baseline_test(self):
+        x = np.linspace(10.0, 40.0, len(self.y))
+        x_range, baseline = window_baseline(x, self.y, 20.0, 21.0)
+        size = baseline_filter_length(x, 20.0, 21.0)
+        eq_(size, 48)
+        expected = sn.median_filter(self.y, size=size, mode='nearest')[x_range]
+        assert np.array_equal(baseline, expected)
@@ -0,0 +1,57 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+from nose.tools import eq_, raises
+
+from xye import XYEDataset
+from batch_container import save_batch, load_batch, BatchContainer
+
+
+class UI(object):
+    name = 'not stored'
+
+
+class BatchContainerTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = tempfile.mktemp(suffix='.pdvz')
+        self.datasets = []
+        for i, name in enumerate(['foo_p1_0001.xye', 'foo_p12_ns_0001.xye', 'foo_p12_nsg_0001.xye']):
+            data = np.random.rand(10 + i, 3)
+            metadata = {'Integrated Ion Chamber Count(counts)': 1000.0 + i,
+                        'date': 'Mon Jan 1 2001\n', 'peak_fit': np.float64(24.8),
+                        'ui': UI()}
+            self.datasets.append(XYEDataset(data, name, '/data/' + name, metadata))
+        save_batch(self.filename, self.datasets)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def round_trip_test(self):
+        loaded = load_batch(self.filename)
+        eq_(len(loaded), 3)
+        for original, dataset in zip(self.datasets, loaded):
+            eq_(dataset.name, original.name)
+            eq_(dataset.source, original.source)
+            assert np.array_equal(dataset.data, original.data)
+            eq_(dataset.metadata['date'], 'Mon Jan 1 2001\n')
+            eq_(dataset.metadata['peak_fit'], 24.8)
+            assert 'ui' not in dataset.metadata
+
+    def random_access_test(self):
+        with BatchContainer(self.filename) as container:
+            eq_([ e['descriptor'] for e in container.entries ], ['', 'ns', 'nsg'])
+            dataset = container.load('foo_p12_ns_0001.xye')
+            assert np.array_equal(dataset.data, self.datasets[1].data)
+        # The arrays are ordinary .npy members, readable with numpy.load()
+        eq_(np.load(self.filename)['data_00002'].shape, (12, 3))
+
+    @raises(IOError)
+    def not_a_container_test(self):
+        filename = tempfile.mktemp(suffix='.pdvz')
+        try:
+            with open(filename, 'w') as f:
+                f.write('0.0 1.0 0.1\n')
+            BatchContainer(filename)
+        finally:
+            os.remove(filename)
@@ -0,0 +1,111 @@
+import unittest
+import nose
+import os
+import struct
+import tempfile
+import numpy as np
+from nose.tools import eq_
+
+import data_formats
+
+
+def pack_tags(tag_set, values):
+    """
+    Builds a header from a data_formats tag table, zero-filling the seek offsets.
+    """
+    parts = []
+    for name, num_bytes, seek_offset, unpack_format in tag_set:
+        parts.append('\x00'*seek_offset)
+        if unpack_format == 's':
+            parts.append(struct.pack('<{}s'.format(num_bytes), values.get(name, '')))
+        else:
+            parts.append(struct.pack('<'+unpack_format, values.get(name, 0)))
+    return ''.join(parts)
+
+
+def pad(s, length):
+    return s + '\x00'*(length - len(s))
+
+
+class RawReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.ranges = [(10.0, 0.5, np.arange(5, dtype=np.float32)),
+                       (20.0, 0.25, np.arange(10, 18, dtype=np.float32))]
+        fd, self.filename = tempfile.mkstemp(suffix='.raw')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def check_ranges(self, data, meta):
+        eq_(data.shape, (13, 3))
+        eq_(meta['range_boundaries'], [0, 5, 13])
+        for (start, step, ys), block in zip(self.ranges, data_formats.split_ranges(data, meta)):
+            self.assertTrue(np.allclose(block[:,0], start + step*np.arange(len(ys))))
+            self.assertTrue(np.allclose(block[:,1], ys))
+            self.assertTrue(np.all(block[:,2] == 0))
+
+    def write(self, contents):
+        with open(self.filename, 'wb') as f:
+            f.write(contents)
+
+    def ver1_test(self):
+        contents = ['RAW ']
+        for i, (start, step, ys) in enumerate(self.ranges):
+            following = 1 if i < len(self.ranges) - 1 else 0
+            contents.append(pack_tags(data_formats.block_meta_tags_v1,
+                {'STEPS': len(ys), 'STEP_SIZE': step, 'START_2THETA': start,
+                 'following_range': following}))
+            contents.append(ys.astype('<f4').tostring())
+        self.write(''.join(contents))
+        self.check_ranges(*data_formats.read_raw(self.filename))
+
+    def ver1_repeated_marker_test(self):
+        # Written out field by field rather than from block_meta_tags_v1, with the 'RAW '
+        # marker repeated before the second range
+        contents = ['RAW ']
+        for i, (start, step, ys) in enumerate(self.ranges):
+            if i > 0:
+                contents.append('RAW ')
+            header = struct.pack('<IffI4xffff32sff72xI', len(ys), 1.0, step, 0, start,
+                                 start/2, 0.0, 0.0, 'sample', 1.5406, 1.5444,
+                                 1 if i < len(self.ranges) - 1 else 0)
+            eq_(len(header), 152)
+            contents.append(header)
+            contents.append(ys.astype('<f4').tostring())
+        self.write(''.join(contents))
+        data, meta = data_formats.read_raw(self.filename)
+        self.check_ranges(data, meta)
+        eq_(meta['range_cnt'], 2)
+        eq_(meta['block1']['SAMPLE_NAME'], 'sample')
+        self.assertTrue(np.isclose(meta['block1']['ALPHA2'], 1.5444))
+
+    def ver2_test(self):
+        contents = [pad('RAW2' + pack_tags(data_formats.meta_tags_v2, {'range_cnt': 2}), 256)]
+        for start, step, ys in self.ranges:
+            header = pack_tags(data_formats.block_meta_tags_v2,
+                {'header_len': 48, 'STEPS': len(ys), 'STEP_SIZE': step, 'START_2THETA': start})
+            contents.append(pad(header, 48))
+            contents.append(ys.astype('<f4').tostring())
+        self.write(''.join(contents))
+        self.check_ranges(*data_formats.read_raw(self.filename))
+
+    def ver3_test(self):
+        contents = [pad('RAW1.01' + pack_tags(data_formats.meta_tags_v3, {'range_cnt': 2}), 712)]
+        for i, (start, step, ys) in enumerate(self.ranges):
+            supplementary = 40*i
+            header = pack_tags(data_formats.block_meta_tags_v3,
+                {'header_len': 304, 'STEPS': len(ys), 'STEP_SIZE': step, 'START_2THETA': start,
+                 'supplementary_headers_size': supplementary})
+            contents.append(pad(header, 304 + supplementary))
+            contents.append(ys.astype('<f4').tostring())
+        self.write(''.join(contents))
+        self.check_ranges(*data_formats.read_raw(self.filename))
+
+    def unknown_format_test(self):
+        self.write('NOTRAW')
+        self.assertRaises(IOError, data_formats.read_raw, self.filename)
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,69 @@
+import unittest
+import numpy as np
+from nose.tools import eq_
+
+from xye import XYEDataset
+from dataset_collection import DatasetCollection, packed_stack
+from processing import DatasetProcessor, stack_datasets, BEAM_INTENSITY_KEY
+
+
+class UI(object):
+    def __init__(self, name, active=True):
+        self.name = name
+        self.active = active
+
+
+def make_dataset(name, offset, x=None):
+    if x is None:
+        x = np.arange(50.0)
+    data = np.c_[x, x + offset, np.ones_like(x)]
+    metadata = {'ui': UI(name + ' ui'), BEAM_INTENSITY_KEY: float(offset + 1)}
+    return XYEDataset(data, name, name, metadata)
+
+
+class DatasetCollectionTest(unittest.TestCase):
+    def setUp(self):
+        self.datasets = DatasetCollection([ make_dataset('d_%04d.xye' % i, i) for i in range(4) ])
+
+    def lookup_test(self):
+        eq_(self.datasets.find_by_name('d_0002.xye'), self.datasets[2])
+        eq_(self.datasets.find_by_uiname('d_0003.xye ui'), self.datasets[3])
+        eq_(self.datasets.find_by_name('missing'), None)
+        # Renames and list modifications are picked up
+        self.datasets[1].name = 'renamed'
+        eq_(self.datasets.find_by_name('renamed'), self.datasets[1])
+        self.datasets.remove(self.datasets[0])
+        eq_(self.datasets.find_by_name('d_0000.xye'), None)
+        assert isinstance(self.datasets[:2], DatasetCollection)
+
+    def pack_test(self):
+        block = self.datasets.pack()
+        eq_(block.shape, (4, 50, 3))
+        for i, dataset in enumerate(self.datasets):
+            assert dataset.data.base is block
+            assert np.array_equal(dataset.y(), np.arange(50.0) + i)
+        stack = stack_datasets(self.datasets)
+        assert np.shares_memory(stack, block)
+        self.datasets[1].metadata['ui'].active = False
+        stack = stack_datasets(self.datasets)
+        eq_(stack.shape, (3, 50, 3))
+        assert np.array_equal(stack[1], self.datasets[2].data)
+
+    def ragged_test(self):
+        self.datasets.append(make_dataset('short_0000.xye', 0, np.arange(30.0)))
+        eq_(self.datasets.pack(), None)
+        eq_(packed_stack([ d.data for d in self.datasets ]), None)
+        eq_(self.datasets.stack().shape, (5, 30, 3))
+
+    def normalise_all_test(self):
+        processor = DatasetProcessor(normalise=True, normalisation_reference='d_0000.xye',
+                                     datasets=self.datasets)
+        expected = [ processor.normalise_me(d) for d in self.datasets ]
+        eq_(expected[2].name, 'd_n_0002.xye')
+        self.datasets.pack()
+        normalised = processor.normalise_all(self.datasets)
+        for e, n in zip(expected, normalised):
+            eq_(e.name, n.name)
+            assert np.allclose(e.data, n.data)
+        # The normalised datasets share a new block
+        assert packed_stack([ d.data for d in normalised ]) is not None
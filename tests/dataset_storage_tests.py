@@ -0,0 +1,45 @@
+import unittest
+
+import numpy as np
+from nose.tools import eq_
+
+from xye import XYEDataset
+from dataset_storage import MemmapStorage, stacked_view
+
+
+def make_dataset(name, offset, n=100):
+    data = np.empty((n, 3))
+    data[:, 0] = np.arange(n)
+    data[:, 1] = np.arange(n) + offset
+    data[:, 2] = offset
+    return XYEDataset(data, name, name, {})
+
+
+class MemmapStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemmapStorage(flush_size=2000)
+        self.datasets = [ make_dataset('d%d' % i, i) for i in range(5) ]
+        self.storage.extend(self.datasets)
+        self.storage.finish()
+
+    def tearDown(self):
+        self.storage.close()
+
+    def data_preserved_test(self):
+        for i, dataset in enumerate(self.datasets):
+            assert isinstance(dataset.data, np.memmap)
+            eq_(dataset.data.shape, (100, 3))
+            assert np.array_equal(dataset.x(), np.arange(100))
+            assert np.array_equal(dataset.y(), np.arange(100) + i)
+            assert np.all(dataset.e() == i)
+
+    def stacked_view_test(self):
+        stack = stacked_view([ d.data for d in self.datasets[1:4] ])
+        eq_(stack.shape, (3, 100, 3))
+        assert np.shares_memory(stack, self.storage.array)
+        assert np.array_equal(stack[1], self.datasets[2].data)
+
+    def stacked_view_fallback_test(self):
+        # Non-consecutive datasets and ordinary arrays can't be stacked without a copy
+        eq_(stacked_view([ self.datasets[0].data, self.datasets[2].data ]), None)
+        eq_(stacked_view([ np.zeros((100, 3)) ]), None)
@@ -1,6 +1,10 @@
 import unittest
 import nose
+import os
+import shutil
+import tempfile
 import parab
+from parab_catalogue import ParabCatalogue
 
 
 class ParabTests(unittest.TestCase):
@@ -12,6 +16,73 @@ class ParabTests(unittest.TestCase):
         self.assertEqual(self.params['date'].strip(), 'Thu May 24 21:19:27 EST 2012')
         self.assertEqual(self.params['Integration Time(microseconds)'], 1.2016e+08)
 
+    def load_all_params_test(self):
+        keys, params_list = parab.load_all_params('tests/testdata')
+        self.assertEqual(len(params_list), 1)
+        self.assertEqual(params_list[0][keys.index('Ion Chamber Raw Counts')], 35327)
+
+
+class ParabCatalogueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        source = r'tests/testdata/si640c_low_temp_cal_p1_scan0.000000_adv0_0000.parab'
+        template = open(source).read()
+        for i, (position, counts, temperature) in enumerate([('p1', 30000, 300.5),
+                                                             ('p2', 40000, 250.0),
+                                                             ('p1', 50000, 200.0),
+                                                             ('p1', 20000, 100.0)]):
+            text = template.replace('I_RAW_MON 35327', 'I_RAW_MON {}'.format(counts))
+            text = text.replace('GAS_TEMP 339.99', 'GAS_TEMP {}'.format(temperature))
+            text += 'Wavelength = {}\nsample_holder = capillary {}\n'.format(0.6 + 0.2*i, i % 2)
+            filename = os.path.join(self.directory, 'sample_{}_{:04d}.parab'.format(position, i))
+            with open(filename, 'w') as f:
+                f.write(text)
+        self.catalogue = ParabCatalogue(':memory:')
+
+    def tearDown(self):
+        self.catalogue.close()
+        shutil.rmtree(self.directory)
+
+    def query_test(self):
+        self.assertEqual(self.catalogue.scan(self.directory), (4, 0))
+        paths = self.catalogue.query(position='p1',
+                                     where=[('Ion_Chamber_Raw_Counts', '>', 25000)],
+                                     order_by='Cryo_Temperature_(K)')
+        self.assertEqual([ os.path.basename(p) for p in paths ],
+                         ['sample_p1_0002.parab', 'sample_p1_0000.parab'])
+        params = self.catalogue.params(paths[0])
+        self.assertEqual(params['Ion Chamber Raw Counts'], 50000)
+        self.assertEqual(params['file name root'], 'si640c_low_temp_cal')
+
+    def key_value_lines_test(self):
+        self.catalogue.scan(self.directory)
+        # 'key = value' lines are found by either spelling of the key, and by number
+        paths = self.catalogue.query(where=[('Wavelength', '<', 1.0),
+                                            ('sample_holder', '=', 'capillary 0')])
+        self.assertEqual([ os.path.basename(p) for p in paths ], ['sample_p1_0000.parab'])
+        paths = self.catalogue.query(where=[('sample holder', 'like', 'capillary%')],
+                                     order_by='Wavelength', descending=True)
+        self.assertEqual([ os.path.basename(p) for p in paths ],
+                         ['sample_p1_0003.parab', 'sample_p1_0002.parab',
+                          'sample_p2_0001.parab', 'sample_p1_0000.parab'])
+        params = self.catalogue.params(paths[0])
+        self.assertEqual(params['sample holder'], 'capillary 1')
+        self.assertEqual(params['Wavelength'], '1.2')
+
+    def incremental_scan_test(self):
+        self.catalogue.scan(self.directory)
+        self.assertEqual(self.catalogue.scan(self.directory), (0, 0))
+        filename = os.path.join(self.directory, 'sample_p1_0000.parab')
+        text = open(filename).read().replace('I_RAW_MON 30000', 'I_RAW_MON 60000')
+        with open(filename, 'w') as f:
+            f.write(text)
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime + 10))
+        os.remove(os.path.join(self.directory, 'sample_p2_0001.parab'))
+        self.assertEqual(self.catalogue.scan(self.directory), (1, 1))
+        paths = self.catalogue.query(where=[('Ion Chamber Raw Counts', '>=', 60000)])
+        self.assertEqual(paths, [filename])
+
 
 if __name__ == '__main__':
     nose.main()
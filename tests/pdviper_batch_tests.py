@@ -0,0 +1,53 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from nose.tools import eq_
+
+import pdviper_batch
+from batch_container import load_batch
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.directory, 'in')
+        os.mkdir(self.input_dir)
+        x = np.arange(0.0, 20.0, 0.01)
+        for i in range(3):
+            for position, offset in [('p1', 0.0), ('p2', 0.5)]:
+                data = np.c_[x + offset, np.ones_like(x)*(i + 1), np.ones_like(x)]
+                filename = os.path.join(self.input_dir, 'sample_{}_{:04d}.xye'.format(position, i))
+                np.savetxt(filename, data, fmt='%1.6f')
+        self.output_dir = os.path.join(self.directory, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        os.environ.pop('PDVIPER_NO_CACHE', None)
+
+    def no_gui_imports_test(self):
+        code = ('import sys, pdviper_batch; '
+                'print [m for m in sys.modules if m.split(".")[0] in '
+                '("chaco", "enable", "pyface", "traitsui", "PySide")]')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        eq_(output.strip(), '[]')
+
+    def splice_and_merge_test(self):
+        eq_(pdviper_batch.main([self.input_dir, '--merge', '--no-normalise', '--no-cache',
+                                '-j', '2', '-o', self.output_dir]), 0)
+        eq_(sorted(os.listdir(self.output_dir)),
+            ['sample_p12_m_{:04d}.xye'.format(i) for i in range(3)] +
+            ['sample_p12_s_{:04d}.xye'.format(i) for i in range(3)])
+
+    def container_output_test(self):
+        pattern = os.path.join(self.input_dir, '*_000[01].xye')
+        eq_(pdviper_batch.main([pattern, '--no-normalise', '--no-cache', '--regrid',
+                                '--regrid-interval', '0.05', '-f', 'pdvz',
+                                '-o', self.output_dir]), 0)
+        datasets = load_batch(os.path.join(self.output_dir, 'sample.pdvz'))
+        eq_([ d.name for d in datasets ], ['sample_p12_s_0000.xye', 'sample_p12_sg_0000.xye',
+                                           'sample_p12_s_0001.xye', 'sample_p12_sg_0001.xye'])
+        assert np.allclose(np.diff(datasets[1].x()), 0.05)
@@ -0,0 +1,328 @@
+import sys
+import types
+import unittest
+
+import nose
+import numpy as np
+from nose.tools import eq_
+
+
+def _pseudo_voigt(dx, sig, gam):
+    # unit area per centidegree, as the GSAS-II profile functions
+    s = np.sqrt(sig)/100.
+    g = gam/200.
+    return (0.5*np.exp(-dx**2/(2*s**2))/(np.sqrt(2*np.pi)*s) + 0.5*g/(np.pi*(dx**2 + g**2)))/100.
+
+def _pypsvfcj(n, dx, pos, sig, gam, shl):
+    return _pseudo_voigt(dx, sig, gam)
+
+def _pydpsvfcj(n, dx, pos, sig, gam, shl):
+    h = 1e-7
+    return (_pseudo_voigt(dx, sig, gam),
+            (_pseudo_voigt(dx - h, sig, gam) - _pseudo_voigt(dx + h, sig, gam))/(2*h),
+            (_pseudo_voigt(dx, sig + h, gam) - _pseudo_voigt(dx, sig - h, gam))/(2*h),
+            (_pseudo_voigt(dx, sig, gam + h) - _pseudo_voigt(dx, sig, gam - h))/(2*h),
+            np.zeros_like(dx))
+
+# The peak model's tests use a pseudo-Voigt in place of the compiled GSAS-II bin.pypowder
+# extension, which is only needed to import gsas_routines if it isn't built
+stub_pypowder = types.ModuleType('bin.pypowder')
+stub_pypowder.pypsvfcj = _pypsvfcj
+stub_pypowder.pydpsvfcj = _pydpsvfcj
+try:
+    import bin.pypowder
+except ImportError:
+    sys.modules['bin'] = types.ModuleType('bin')
+    sys.modules['bin'].pypowder = stub_pypowder
+    sys.modules['bin.pypowder'] = stub_pypowder
+
+import gsas_routines
+import peak_fitting
+from xye import XYEDataset
+
+
+class FitBackgroundsTest(unittest.TestCase):
+    def setUp(self):
+        self.fit_background = peak_fitting.fit_background
+        peak_fitting.fit_background = self.stub_fit_background
+        self.params = {'backType':'Chebyschev Polynomial', 'Back:0':1.0, 'Back:1':0.0, 'U':1.0}
+        self.datasets = [ XYEDataset(np.column_stack([np.arange(10.0), np.ones(10)*i, np.ones(10)]),
+                                     'd_p1_{:04d}.xye'.format(i)) for i in range(6) ]
+
+    def tearDown(self):
+        peak_fitting.fit_background = self.fit_background
+
+    @staticmethod
+    def stub_fit_background(dataset, params, stats=None):
+        # Records the starting parameters, fails on datasets named 'bad'
+        stats.update({'start':dict(params), 'success':dataset.name != 'bad', 'Rwp':1.0})
+        if dataset.name == 'bad':
+            return None, params
+        fitted = dict(params)
+        fitted['Back:0'] = params['Back:0'] + 1.0
+        fitted['U'] = params['U'] + 1.0
+        return dataset.data[:, 1], fitted
+
+    def order_test(self):
+        results = peak_fitting.fit_backgrounds(self.datasets, self.params, workers=2)
+        eq_(len(results), 6)
+        for dataset, (background, params, stats) in zip(self.datasets, results):
+            self.assertTrue(np.array_equal(background, dataset.y()))
+            eq_(stats['Rwp'], 1.0)
+        # Two runs of three datasets, each starting from params
+        eq_([ stats['start']['Back:0'] for _, _, stats in results ], [1.0, 2.0, 3.0]*2)
+
+    def warm_start_test(self):
+        self.datasets[2].name = 'bad'
+        results = peak_fitting.fit_backgrounds(self.datasets, self.params, workers=1)
+        starts = [ stats['start'] for _, _, stats in results ]
+        # Only the Back:n parameters carry on, and not from a failed fit
+        eq_([ s['Back:0'] for s in starts ], [1.0, 2.0, 3.0, 3.0, 4.0, 5.0])
+        eq_([ s['U'] for s in starts ], [1.0]*6)
+        eq_([ s['Back:1'] for s in starts ], [0.0]*6)
+        eq_([ b is None for b, _, _ in results ], [False, False, True, False, False, False])
+        eq_([ stats['success'] for _, _, stats in results ], [True, True, False, True, True, True])
+        eq_(results[3][1]['Back:0'], 4.0)
+        eq_(self.params['Back:0'], 1.0)
+
+
+def dict_profile(params, x, varyList):
+    """
+    The peak model with a Chebyschev background as computed by looking up the parameters
+    in the dictionary, for comparison.
+    """
+    y = sum(params['Back:'+str(i)]*(x - x[0])**i for i in range(count_backgrounds(params)))
+    for i in range(count_peaks(params)):
+        pos, intens, sig, gam, _, _, _, _ = dict_peak(params, varyList, i)
+        Wd, fmin, fmax = gsas_routines.getWidthsCW(pos, sig, gam, 0.002)
+        window = (x >= pos - fmin) & (x < pos + fmin)
+        y[window] += intens*gsas_routines.getFCJVoigt3(pos, sig, gam, 0.002, x[window])
+    return y
+
+def dict_derivatives(params, x, varyList):
+    """
+    The derivatives of dict_profile() by the parameters of varyList, a row for each.
+    """
+    cw = np.append(np.diff(x), x[-1] - x[-2])
+    rows = dict((name, np.zeros_like(x)) for name in varyList)
+    for i in range(count_backgrounds(params)):
+        if 'Back:'+str(i) in rows:
+            rows['Back:'+str(i)] += (x - x[0])**i
+    for i in range(count_peaks(params)):
+        pos, intens, sig, gam, tanth, costh, sigVaried, gamVaried = dict_peak(params, varyList, i)
+        Wd, fmin, fmax = gsas_routines.getWidthsCW(pos, sig, gam, 0.002)
+        window = (x >= pos - fmin) & (x < pos + fmin)
+        dF = gsas_routines.getdFCJVoigt3(pos, sig, gam, 0.002, x[window])
+        scale = 100.*cw[window]
+        derivatives = {'pos'+str(i):scale*intens*dF[1], 'int'+str(i):scale*dF[0],
+                       'sig'+str(i):scale*intens*dF[2], 'gam'+str(i):scale*intens*dF[3]}
+        if not sigVaried:
+            derivatives.update({'U':tanth**2*derivatives['sig'+str(i)],
+                                'V':tanth*derivatives['sig'+str(i)], 'W':derivatives['sig'+str(i)]})
+        if not gamVaried:
+            derivatives.update({'X':derivatives['gam'+str(i)]/costh,
+                                'Y':tanth*derivatives['gam'+str(i)]})
+        for name, derivative in derivatives.iteritems():
+            if name in rows:
+                rows[name][window] += derivative
+    return np.array([ rows[name] for name in varyList ])
+
+def dict_peak(params, varyList, i):
+    pos = params['pos'+str(i)]
+    theta = (pos - params['Zero'])/2.0
+    tanth, costh = np.tan(np.radians(theta)), np.cos(np.radians(theta))
+    sigVaried, gamVaried = 'sig'+str(i) in varyList, 'gam'+str(i) in varyList
+    sig = params['sig'+str(i)] if sigVaried else params['U']*tanth**2 + params['V']*tanth + params['W']
+    gam = params['gam'+str(i)] if gamVaried else params['X']/costh + params['Y']*tanth
+    return pos, params['int'+str(i)], max(sig, 0.001), max(gam, 0.001), tanth, costh, \
+           sigVaried, gamVaried
+
+def count_backgrounds(params):
+    return len([ key for key in params if key.startswith('Back:') ])
+
+def count_peaks(params):
+    return len([ key for key in params if key.startswith('pos') ])
+
+
+class StubPowderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pyd = gsas_routines.pyd
+        gsas_routines.pyd = stub_pypowder
+        self.x = np.linspace(10.0, 40.0, 3001)
+        self.params = {'U':1.0, 'V':-1.0, 'W':30.0, 'X':2.0, 'Y':0.5, 'Zero':0.0,
+                       'backType':'Chebyschev Polynomial', 'Back:0':10.0, 'Back:1':0.1, 'Back:2':0.001}
+        for i, pos in enumerate([15.0, 18.0, 18.3, 25.0, 33.0]):
+            self.params.update(peak_fitting.setPeakparms(pos, 100.0*(i + 1), self.params, i))
+        self.varyList = ['Back:0', 'Back:1', 'Back:2'] + \
+                        [ name + str(i) for i in range(5) for name in ['int', 'sig', 'gam'] ]
+
+    def tearDown(self):
+        gsas_routines.pyd = self.pyd
+
+    def derivatives(self, varyList, bakType='Chebyschev Polynomial'):
+        derivatives = peak_fitting.getPeakProfileDerv(self.params, self.x, varyList, bakType)
+        return dict(zip(varyList, derivatives))
+
+
+class ParameterLayoutTest(StubPowderTestCase):
+    def layout_test(self):
+        layout = peak_fitting.ParameterLayout(self.params, self.varyList, 'Chebyschev Polynomial', self.x)
+        eq_(layout.nBak, 3)
+        eq_(len(layout.peaks), 5)
+        p = layout.values(self.params)
+        eq_([ layout.names[i] for i in layout.vary ], self.varyList)
+        eq_(p[layout.index['int3']], self.params['int3'])
+        eq_([ layout.rows[i] for i in layout.vary ], range(len(self.varyList)))
+        eq_(layout.rows[layout.index['pos0']], -1)
+
+    def profile_test(self):
+        for varyList in [self.varyList, ['Back:0', 'Back:1', 'Back:2', 'U', 'V', 'W', 'X', 'Y', 'pos1', 'int1']]:
+            profile = peak_fitting.getPeakProfile(self.params, self.x, varyList, 'Chebyschev Polynomial')
+            self.assertTrue(np.allclose(profile, dict_profile(self.params, self.x, varyList)))
+            derivatives = peak_fitting.getPeakProfileDerv(self.params, self.x, varyList, 'Chebyschev Polynomial')
+            self.assertTrue(np.allclose(derivatives, dict_derivatives(self.params, self.x, varyList)))
+
+    def background_order_test(self):
+        # varyList has the Back:n parameters in the order of their names
+        for i in range(3, 12):
+            self.params['Back:'+str(i)] = 0.0
+        backgrounds = sorted('Back:'+str(i) for i in range(12))
+        derivatives = self.derivatives(backgrounds + ['int0'])
+        for i in range(12):
+            self.assertTrue(np.allclose(derivatives['Back:'+str(i)], (self.x - self.x[0])**i))
+        # and not necessarily all of them
+        varyList = ['Back:0', 'U', 'V', 'int0']
+        derivatives = peak_fitting.getPeakProfileDerv(self.params, self.x, varyList, 'Chebyschev Polynomial')
+        self.assertTrue(np.allclose(derivatives, dict_derivatives(self.params, self.x, varyList)))
+
+    def interpolated_background_test(self):
+        for bakType in ['Linear Interpolation', 'log interpolate']:
+            for nBak in [2, 4]:
+                self.params.update(('Back:'+str(i), 1.0 + i) for i in range(nBak))
+                self.params.pop('Back:'+str(nBak), None)
+                names = [ 'Back:'+str(i) for i in range(nBak) ]
+                derivatives = self.derivatives(names, bakType)
+                # the background is linear in its parameters
+                y = peak_fitting.getBackground('', self.params, bakType, self.x)
+                for name in names:
+                    params = dict(self.params)
+                    params[name] += 1.0
+                    dy = peak_fitting.getBackground('', params, bakType, self.x) - y
+                    self.assertTrue(np.allclose(derivatives[name], dy))
+                self.assertTrue(np.allclose(sum(derivatives.values()), 1.0))
+
+    def ka2_intensity_ratio_test(self):
+        self.params.update({'Lam1':1.5406, 'Lam2':1.5444, 'I(L2)/I(L1)':0.5})
+        varyList = ['I(L2)/I(L1)'] + self.varyList
+        derivatives = self.derivatives(varyList)
+        # all the peaks' derivatives are there
+        reference = dict_derivatives(self.params, self.x, self.varyList)
+        for name, derivative in zip(self.varyList, reference):
+            self.assertTrue(np.allclose(derivatives[name], derivative))
+        self.assertTrue(np.any(derivatives['int4']))
+
+    def varied_width_test(self):
+        # X and Y only affect the peaks whose gamma is computed from them
+        varyList = ['X', 'Y', 'gam0', 'int0', 'int1']
+        derivatives = self.derivatives(varyList)
+        reference = dict_derivatives(self.params, self.x, varyList)
+        self.assertTrue(np.allclose(derivatives['X'], reference[0]))
+        self.assertTrue(np.allclose(derivatives['Y'], reference[1]))
+        derivatives = self.derivatives(['X'] + [ 'gam'+str(i) for i in range(5) ])
+        self.assertFalse(np.any(derivatives['X']))
+
+
+class SparseJacobianTest(StubPowderTestCase):
+    def segments_test(self):
+        segments = [(0, 0, np.ones(4)), (2, 1, np.arange(3.0)), (3, 1, np.ones(2))]
+        matrix = peak_fitting.segmentsToMatrix(segments, (6, 3))
+        # overlapping segments are summed
+        self.assertTrue(np.array_equal(matrix.toarray(),
+                                       [[1, 0, 0], [1, 0, 0], [1, 0, 0], [1, 2, 0], [0, 3, 0], [0, 0, 0]]))
+        eq_(peak_fitting.segmentsToMatrix([], (6, 3)).nnz, 0)
+
+    def derivatives_test(self):
+        varyList = self.varyList + ['U', 'pos2']
+        self.varyList.remove('sig2')
+        layout = peak_fitting.ParameterLayout(self.params, varyList, 'Chebyschev Polynomial', self.x)
+        p = layout.values(self.params)
+        jacobian = peak_fitting.getPeakProfileDervValues(layout, p)
+        eq_(jacobian.shape, (len(self.x), len(varyList)))
+        # only the peaks' windows are stored
+        self.assertTrue(jacobian.nnz < 0.3*len(self.x)*len(varyList))
+        dense = dict_derivatives(self.params, self.x, varyList)
+        self.assertTrue(np.allclose(jacobian.toarray(), dense.T))
+        self.assertTrue(np.array_equal(
+            peak_fitting.getPeakProfileDerv(self.params, self.x, varyList, 'Chebyschev Polynomial'),
+            jacobian.T.toarray()))
+        # and they are those of the profile
+        profile = peak_fitting.getPeakProfileValues(layout, p)
+        for name in varyList:
+            h = 1e-6*max(1.0, abs(self.params[name]))
+            q = p.copy()
+            q[layout.index[name]] += h
+            derivative = (peak_fitting.getPeakProfileValues(layout, q) - profile)/h
+            column = jacobian[:, layout.rows[layout.index[name]]].toarray().ravel()
+            self.assertTrue(np.allclose(column, derivative, atol=0.02*np.abs(derivative).max()), name)
+
+    def weighted_derivatives_test(self):
+        layout = peak_fitting.ParameterLayout(self.params, self.varyList, 'Chebyschev Polynomial', self.x)
+        p = layout.values(self.params)
+        weights = np.linspace(1.0, 2.0, len(self.x))
+        jacobian = peak_fitting.devPeakValues(p[layout.vary], layout, p, None, weights)
+        self.assertTrue(np.allclose(jacobian.toarray(),
+                                    weights[:, None]*peak_fitting.getPeakProfileDervValues(layout, p).toarray()))
+
+
+class FitPeaksTest(StubPowderTestCase):
+    def setUp(self):
+        super(FitPeaksTest, self).setUp()
+        y = peak_fitting.getPeakProfile(self.params, self.x, self.varyList, 'Chebyschev Polynomial')
+        e = np.sqrt(y)
+        y = y + e*np.random.RandomState(0).standard_normal(len(y))
+        self.dataset = XYEDataset(np.column_stack([self.x, y, e]), 'a_p1_0001.xye')
+        self.start = dict(self.params)
+        self.start['Back:0'] = 20.0
+        for i in range(5):
+            self.start['int'+str(i)] *= 1.3
+
+    def fit(self, params, varyList=['int', 'sig', 'gam']):
+        stats = {}
+        peaks = peak_fitting.createPeakRows(params)
+        yb, yc, fitted = peak_fitting.fit_peaks_background(peaks, varyList, self.dataset,
+                                                           None, dict(params), stats)
+        return yc, fitted, stats
+
+    def convergence_test(self):
+        yc, fitted, stats = self.fit(self.start)
+        # to the noise
+        self.assertTrue(0.8 < stats['GOF'] < 1.2)
+        self.assertTrue(np.all(np.isfinite(stats['esds'].values())))
+        for name, esd in stats['esds'].iteritems():
+            self.assertTrue(abs(fitted[name] - self.params[name]) < 3*esd, name)
+        eq_(len(stats['esds']), 18)
+        self.assertTrue(np.allclose(yc[:-1], peak_fitting.getPeakProfile(
+            fitted, self.x[:-1], sorted(stats['esds']), 'Chebyschev Polynomial')))
+
+    def unused_parameter_test(self):
+        # a peak outside the pattern doesn't change the profile, so isn't refined
+        self.start.update(peak_fitting.setPeakparms(60.0, 100.0, self.start, 5))
+        yc, fitted, stats = self.fit(self.start)
+        eq_(len(stats['esds']), 18)
+        self.assertTrue('int5' not in stats['esds'])
+        eq_(fitted['int5'], 100.0)
+        self.assertTrue(0.8 < stats['GOF'] < 1.2)
+
+    def singular_test(self):
+        # the intensities of two peaks of the same shape can't be told apart, but the fit
+        # still finishes
+        self.start.update(peak_fitting.setPeakparms(self.start['pos3'], 100.0, self.start, 5))
+        self.start['int3'] -= 100.0
+        yc, fitted, stats = self.fit(self.start, ['int'])
+        eq_(len(stats['esds']), 9)
+        self.assertTrue(np.any(np.isnan(stats['esds'].values())))
+        self.assertTrue(0.8 < stats['GOF'] < 1.2)
+
+
+if __name__ == '__main__':
+    nose.main()
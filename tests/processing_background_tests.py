@@ -26,8 +26,68 @@ class RescaleTests(unittest.TestCase):
         self.assertTrue(True)
 
 
+class BatchSubtractionTest(unittest.TestCase):
+    def setUp(self):
+        x = np.linspace(10.0, 20.0, 101)
+        self.datasets = [ xye.XYEDataset(np.c_[x, 10.0 + i + np.sin(x), np.ones_like(x)*(i + 1)],
+                                         'a_p1_{:04d}.xye'.format(i), 'a') for i in range(5) ]
+        # on a different grid and descending
+        x2 = np.linspace(10.05, 20.05, 51)[::-1]
+        self.datasets.append(xye.XYEDataset(np.c_[x2, 12.0 + np.sin(x2), np.ones_like(x2)],
+                                            'a_p1_0005.xye', 'a'))
+        xb = np.linspace(9.0, 21.0, 49)
+        self.background = xye.XYEDataset(np.c_[xb, np.ones_like(xb)*5.0, np.ones_like(xb)*2.0])
+
+    def file_background_test(self):
+        subtracted = processing_background_removal.subtract_background_from_datasets(
+            self.datasets, processing_background_removal.file_background(self.background))
+        for d, s in zip(self.datasets, subtracted):
+            self.assertTrue(np.array_equal(s.x(), d.x()))
+            self.assertTrue(np.allclose(s.y(), d.y() - 5.0))
+            # uncertainties add in quadrature
+            self.assertTrue(np.allclose(s.e(), np.sqrt(d.e()**2 + 4.0)))
+            self.assertEqual(s.name, d.name)
+        single = processing_background_removal.subtract_background_with_file(self.datasets[-1],
+                                                                            self.background)
+        self.assertTrue(np.array_equal(single.data, subtracted[-1].data))
+
+    def fitted_background_test(self):
+        class Fitter(object):
+            def eval_curve(self, xs):
+                return xs
+        d = self.datasets[0]
+        s = processing_background_removal.subtract_background_with_fit(d, Fitter())
+        # clipped to between zero and the largest y value
+        expected = np.clip(d.y() - d.x(), 0, d.y().max())
+        self.assertTrue(np.allclose(s.y(), expected))
+        self.assertTrue(np.allclose(s.e(), d.e()))
+
+
+class BackgroundEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.x = np.linspace(10.0, 40.0, 3001)
+        self.background = 50.0 + 20.0*np.exp(-self.x/10.0)
+        peaks = sum(1000.0*np.exp(-(self.x - c)**2/(2*0.05**2)) for c in [15.0, 22.0, 31.0])
+        self.y = self.background + peaks
+
+    def snip_test(self):
+        estimated = processing_background_removal.snip_background(self.y, 40)
+        self.assertTrue(np.allclose(estimated, self.background, atol=0.5))
 
+    def opening_test(self):
+        estimated = processing_background_removal.opening_background(self.y, 40)
+        self.assertTrue(np.all(estimated <= self.y))
+        self.assertTrue(np.allclose(estimated, self.background, atol=0.5))
 
+    def vectorised_test(self):
+        arrays = [ np.c_[self.x, self.y*scale, np.ones_like(self.x)] for scale in [1.0, 2.0] ]
+        arrays.append(arrays[0][::2])
+        for curve_type in processing_background_removal.BACKGROUND_ESTIMATORS:
+            estimated = processing_background_removal.estimate_backgrounds(arrays, curve_type, 40)
+            for a, background in zip(arrays, estimated):
+                fitter = processing_background_removal.CurveFitter(curve_type, 40)
+                fitter.fit_curve(xye.XYEDataset(a))
+                self.assertTrue(np.allclose(fitter.eval_curve(a[:,0]), background))
 
 
 if __name__ == '__main__':
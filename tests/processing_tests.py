@@ -4,6 +4,8 @@ import parab
 import processing
 import xye
 import numpy as np
+from stage_cache import StageCache
+from processing_background_removal import subtract_background_from_datasets, file_background
 
 
 class PeakDetectionTest(unittest.TestCase):
@@ -21,6 +23,81 @@ class PeakDetectionTest(unittest.TestCase):
         self.assertTrue(LOW_2TH < peak_offset < HIGH_2TH)
 
 
+class PeakFunctionTest(unittest.TestCase):
+    def setUp(self):
+        # the fitted widths are bounded below by a tenth of the half-width of the range
+        self.x = np.arange(19.95, 20.25, 0.004)
+        self.p = np.r_[800.0, 20.1, 0.02, 300.0, 20.1, 0.03, 50.0]
+
+    def jacobian_test(self):
+        jacobian = processing.peak_function_jacobian(self.p, self.x)
+        for i in range(7):
+            step = np.zeros(7)
+            step[i] = 1e-7
+            numerical = (processing.peak_function(self.p + step, self.x) -
+                         processing.peak_function(self.p - step, self.x)) / 2e-7
+            self.assertTrue(np.allclose(jacobian[:,i], numerical, rtol=1e-5, atol=1e-3))
+
+    def lsq_fit_test(self):
+        y = processing.peak_function(self.p, self.x)
+        centre, p, success = processing.fit_peak_2theta_lsq(self.x, y)
+        self.assertTrue(success)
+        self.assertAlmostEqual(centre, 20.1, places=4)
+        # warm started from a nearby fit
+        y = processing.peak_function(self.p + np.r_[0, 0.01, 0, 0, 0.01, 0, 0], self.x)
+        centre, p, success = processing.fit_peak_2theta_lsq(self.x, y, p)
+        self.assertTrue(success)
+        self.assertAlmostEqual(centre, 20.11, places=4)
+
+    def dataset_pairs_test(self):
+        pairs = []
+        for i, shift in enumerate([0.0, 0.004, -0.003]):
+            first, second = [ xye.XYEDataset(np.c_[self.x, processing.peak_function(p, self.x),
+                                                   np.ones_like(self.x)],
+                                             'foo_{}_{:04d}.xye'.format(position, i), '', {})
+                              for position, p in [('p1', self.p),
+                                                  ('p2', self.p + np.r_[0, shift, 0, 0, shift, 0, 0])] ]
+            pairs.append((first, second))
+        self.assertEqual(processing.fit_peaks_for_dataset_pairs(19.95, 20.25, pairs, False), [True]*3)
+        for (first, second), shift in zip(pairs, [0.0, 0.004, -0.003]):
+            self.assertAlmostEqual(second.metadata['peak_fit'] - first.metadata['peak_fit'],
+                                   shift, places=5)
+
+
+class CrossCorrelationAlignmentTest(unittest.TestCase):
+    def setUp(self):
+        self.x = np.arange(10.0, 30.0, 0.004)
+        self.shifts = [0.0, 0.0105, -0.0213, 0.0031]
+        self.datasets = [ xye.XYEDataset(np.c_[self.x, self.peak(20.0 + shift), np.ones_like(self.x)],
+                                         'foo_p1_{:04d}.xye'.format(i), '', {})
+                          for i, shift in enumerate(self.shifts) ]
+
+    def peak(self, centre):
+        return 100.0 + 1000.0*np.exp(-((self.x - centre)/0.02)**2/2) + \
+               300.0*np.exp(-((self.x - centre - 0.4)/0.03)**2/2)
+
+    def all_dataseries_test(self):
+        processing.get_peak_offsets_for_all_dataseries(19.7, 20.7, self.datasets, method='xcorr')
+        peak_fits = np.array([ d.metadata['peak_fit'] for d in self.datasets ])
+        self.assertAlmostEqual(peak_fits[0], 20.0, places=3)
+        self.assertTrue(np.allclose(peak_fits - peak_fits[0], self.shifts, atol=0.001))
+
+    def pairs_test(self):
+        pairs = [ (self.datasets[0], d) for d in self.datasets[1:] ]
+        self.assertEqual(processing.align_pairs_by_cross_correlation(19.7, 20.7, pairs),
+                         [True]*3)
+        for (d1, d2), shift in zip(pairs, self.shifts[1:]):
+            self.assertAlmostEqual(d2.metadata['peak_fit'] - d1.metadata['peak_fit'], shift,
+                                   places=3)
+
+    def no_peak_test(self):
+        # nothing to correlate with
+        self.datasets[1].data[:,1] = 100.0
+        offsets, valid = processing.cross_correlation_offsets(
+            19.7, 20.7, [ d.data for d in self.datasets ], self.datasets[0].data)
+        self.assertEqual(list(valid), [True, False, True, True])
+
+
 class MergeTest(unittest.TestCase):
     def setUp(self):
         pass
@@ -48,6 +125,40 @@ class MergeTest(unittest.TestCase):
         self.assertTrue(np.allclose(merged[:,2],
                              np.r_[0., 1., 1.5, 2.5, 3.5, 4., 5., 5.5, 7., 8.]))
 
+    def splice_many_gaps_test(self):
+        x1data = np.arange(0, 50, 0.5)
+        x1data = x1data[(x1data % 10) < 8]      # gaps at 8-10, 18-20, ...
+        x2data = np.arange(0.25, 60, 0.5)
+        data1 = np.c_[x1data,x1data,x1data]
+        data2 = np.c_[x2data,-x2data,x2data]
+        merged = processing.combine_by_splice(data1, data2, gap_threshold=1.0)
+        inside = ((x2data % 10) > 7.5) & (x2data < x1data[-1])
+        expected = processing.combine_by_merge(data1, data2[inside])
+        self.assertTrue(np.array_equal(merged, expected))
+        # d2 needn't be sorted
+        merged = processing.combine_by_splice(data1, data2[::-1], gap_threshold=1.0)
+        self.assertTrue(np.array_equal(merged, expected))
+
+    def binned_merge_test(self):
+        data1 = np.c_[[0.0, 1.0, 2.0], [10.0, 20.0, 30.0], [1.0, 1.0, 2.0]]
+        data2 = np.c_[[1.02, 2.0, 4.0], [40.0, 60.0, 5.0], [1.0, 1.0, 1.0]]
+        merged = processing.combine_by_binning(data1, data2, interval=0.5)
+        self.assertTrue(np.allclose(merged[:,0], [0.0, 1.0, 2.0, 4.0]))
+        # inverse-variance weighted means, e.g. (30/4 + 60)/(1/4 + 1) at 2.0
+        self.assertTrue(np.allclose(merged[:,1], [10.0, 30.0, 54.0, 5.0]))
+        self.assertTrue(np.allclose(merged[:,2], [1.0, np.sqrt(0.5), np.sqrt(0.8), 1.0]))
+
+    def binned_merge_zero_errors_test(self):
+        data1 = np.c_[[0.0, 1.0], [10.0, 20.0], [0.0, 0.0]]
+        data2 = np.c_[[1.0], [40.0], [2.0]]
+        merged = processing.combine_by_binning(data1, data2, interval=1.0)
+        self.assertTrue(np.allclose(merged, [[0.0, 10.0, 0.0], [1.0, 40.0, 2.0]]))
+
+    def binned_merge_descriptor_test(self):
+        self.assertEqual(processing.insert_descriptor('foo_ns_0000.xye', 'w'), 'foo_nsw_0000.xye')
+        self.assertEqual(processing.insert_descriptor('foo_nw_0000.xye', 'b'), 'foo_nwb_0000.xye')
+        self.assertEqual(processing.get_descriptor('foo_nwb_0000.xye'), 'nwb')
+
     def merge_overlapping_ranges_test(self):
         x1data = np.r_[0:3]                     # [0, 1, 2]
         x2data = np.r_[1:4] + 0.5               # [1.5, 2.5, 3.5]
@@ -146,5 +257,137 @@ class FilenameDescriptorTest(unittest.TestCase):
             self.assertEqual(processing.insert_descriptor(name, v[0]), v[1])
 
 
+class RegridArraysTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        x = np.sort(rng.uniform(0, 10, 200))
+        self.stack = np.dstack([np.tile(x, (5, 1)), rng.rand(5, 200), rng.rand(5, 200)])
+        self.ragged = [ np.c_[x[:150] + 0.3, rng.rand(150), rng.rand(150)],
+                        self.stack[0][::-1],
+                        np.c_[[2.0, 4.0], [1.0, 3.0], [0.0, 1.0]] ]
+        self.xs = processing.regular_grid(-1.0, 11.0, 0.01)
+
+    def check(self, arrays, y, e):
+        for a, y_row, e_row in zip(arrays, y, e):
+            expected = processing.regrid_data(a, start=self.xs[0], end=self.xs[-1], interval=0.01)
+            if a[0,0] > a[-1,0]:
+                # regrid_data() returns descending data in descending order
+                expected = expected[::-1]
+            self.assertTrue(np.allclose(expected[:,1], y_row))
+            self.assertTrue(np.allclose(expected[:,2], e_row))
+
+    def shared_grid_test(self):
+        y, e = processing.regrid_arrays(self.stack, self.xs)
+        self.assertEqual(y.shape, (5, len(self.xs)))
+        self.check(self.stack, y, e)
+
+    def ragged_threaded_test(self):
+        arrays = list(self.stack) + self.ragged
+        y, e = processing.regrid_arrays(arrays, self.xs, workers=3)
+        self.check(arrays, y, e)
+
+    def regrid_all_test(self):
+        datasets = [ xye.XYEDataset(a, 'foo_p1_{:04d}.xye'.format(i), '', {})
+                     for i, a in enumerate(list(self.stack) + self.ragged) ]
+        processor = processing.DatasetProcessor(regrid=True, regrid_interval=0.05)
+        for d, regridded in zip(datasets, processor.regrid_all(datasets)):
+            expected = processor.regrid_me(d)
+            self.assertEqual(regridded.name, expected.name)
+            self.assertTrue(np.allclose(regridded.data, expected.data))
+
+
+class ProcessAllTest(unittest.TestCase):
+    def setUp(self):
+        x = np.arange(0.0, 20.0, 0.01)
+        self.datasets = []
+        for i in range(6):
+            for position, offset in [('p1', 0.0), ('p2', 0.5)]:
+                data = np.c_[x + offset, np.ones_like(x)*(i + 1), np.ones_like(x)]
+                metadata = {'Integrated Ion Chamber Count(counts)': 1000.0*(i + 1),
+                            'ui': object()}
+                name = 'sample_{}_{:04d}.xye'.format(position, i)
+                self.datasets.append(xye.XYEDataset(data, name, name, metadata))
+        self.pairs = zip(self.datasets[::2], self.datasets[1::2])
+        self.processor = processing.DatasetProcessor(normalise=True, merge_by_merge=True,
+                                                     normalisation_reference='p1',
+                                                     datasets=self.datasets,
+                                                     use_cache=False)
+
+    def parallel_matches_serial_test(self):
+        serial = self.processor.process_all(self.pairs, workers=1)
+        parallel = self.processor.process_all(self.pairs, workers=3)
+        self.assertEqual([ d.name for d in serial ], [ d.name for d in parallel ])
+        self.assertEqual(parallel[0].name, 'sample_p12_nm_0000.xye')
+        for d1, d2 in zip(serial, parallel):
+            self.assertTrue(np.array_equal(d1.data, d2.data))
+            self.assertTrue('ui' not in d2.metadata)
+        # Every pair is normalised to its own p1 position
+        self.assertTrue(np.allclose(parallel[-1].y(), 6.0))
+
+    def binned_merge_pair_test(self):
+        self.processor.merge_by_merge = False
+        self.processor.merge_by_binning = True
+        self.processor.regrid = True
+        self.processor.regrid_interval = 0.01
+        processed = self.processor.process_all(self.pairs[:1], workers=1)
+        self.assertEqual([ d.name for d in processed ],
+                         ['sample_p12_ns_0000.xye', 'sample_p12_nw_0000.xye',
+                          'sample_p12_nsg_0000.xye'])
+        binned = processed[1]
+        self.assertTrue(np.allclose(np.diff(binned.x()), 0.01))
+        self.assertTrue(np.allclose(binned.x()[[0, -1]], [0.0, 20.49]))
+        self.assertTrue(np.allclose(binned.y(), 1.0))
+
+    def cached_rerun_test(self):
+        self.processor.regrid = True
+        self.processor.cache = StageCache()
+        # Pairs processed by the pool aren't cached...
+        self.processor.process_all(self.pairs, workers=3)
+        self.assertEqual(len(self.processor.cache), 0)
+        # ...but those processed here are
+        self.processor.process_all(self.pairs, workers=1)
+        entries = len(self.processor.cache)
+        self.assertTrue(all(self.processor._is_cached(pair) for pair in self.pairs))
+        # Only the regrid stages of the merged and spliced data are rerun
+        self.processor.regrid_interval = 0.02
+        rerun = self.processor.process_all(self.pairs, workers=3)
+        self.assertEqual(len(self.processor.cache), entries + 2*len(self.pairs))
+        self.processor.cache = None
+        uncached = self.processor.process_all(self.pairs, workers=1)
+        self.assertEqual(rerun[2].name, 'sample_p12_nmg_0000.xye')
+        self.assertEqual([ d.name for d in uncached ], [ d.name for d in rerun ])
+        for d1, d2 in zip(uncached, rerun):
+            self.assertTrue(np.array_equal(d1.data, d2.data))
+        self.assertTrue(np.allclose(np.diff(rerun[2].x()), 0.02))
+
+    def incremental_rerun_test(self):
+        processed = self.processor.process_all(self.pairs[:4], workers=1)
+        self.assertEqual(processed[0].metadata['processed_from'],
+                         ['sample_p1_0000.xye', 'sample_p2_0000.xye'])
+        # A modified pair and two new pairs are processed, the rest are reused as they are
+        modified = self.pairs[1][0].copy()
+        modified.data = modified.data*2.0
+        pairs = [self.pairs[0], (modified, self.pairs[1][1])] + self.pairs[2:]
+        rerun = self.processor.process_all(pairs, workers=1, previous=processed)
+        self.assertEqual(len(rerun), 2*len(pairs))
+        reused = [ any(d is p for p in processed) for d in rerun ]
+        self.assertEqual(reused, [True]*2 + [False]*2 + [True]*4 + [False]*4)
+        fresh = self.processor.process_all(pairs, workers=1)
+        self.assertEqual([ d.name for d in fresh ], [ d.name for d in rerun ])
+        for d1, d2 in zip(fresh, rerun):
+            self.assertTrue(np.array_equal(d1.data, d2.data))
+        # Datasets derived from processed ones, e.g. by background subtraction, aren't
+        # returned as processed
+        background = xye.XYEDataset(processed[0].data*0.5, 'bkg.xye', 'bkg', {})
+        derived = subtract_background_from_datasets(processed[:2], file_background(background))
+        reused = self.processor.process_all(pairs[:1], workers=1, previous=processed + derived)
+        self.assertEqual(len(reused), 2)
+        self.assertTrue(all(d is p for d, p in zip(reused, processed)))
+        # Changing an option invalidates everything
+        self.processor.regrid = True
+        regridded = self.processor.process_all(pairs, workers=1, previous=rerun)
+        self.assertFalse(any(d is p for d in regridded for p in rerun))
+
+
 if __name__ == '__main__':
     nose.main()
@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+from nose.tools import eq_
+
+from stage_cache import StageCache, array_key, stage_key
+
+
+class StageCacheTest(unittest.TestCase):
+    def setUp(self):
+        # room for three 100 point Nx3 arrays
+        self.cache = StageCache(max_size=3*100*3*8)
+
+    def put(self, key):
+        value = (np.zeros((100, 3)),)
+        self.cache.put(key, value)
+        return value
+
+    def keys_test(self):
+        a = np.arange(30.0).reshape(10, 3)
+        eq_(array_key(a), array_key(a.copy()))
+        assert array_key(a) != array_key(a[::-1])
+        assert array_key(a) != array_key(a.astype(np.float32))
+        k = array_key(a)
+        assert stage_key(k, 'regrid', (0.01,)) != stage_key(k, 'regrid', (0.02,))
+        assert stage_key(k, 'merge', ()) != stage_key(k, 'splice', ())
+
+    def put_get_test(self):
+        value = self.put('a')
+        assert self.cache.get('a') is value
+        assert not value[0].flags.writeable
+        assert self.cache.get('b') is None
+
+    def lru_eviction_test(self):
+        for key in 'abc':
+            self.put(key)
+        self.cache.get('a')
+        self.put('d')
+        eq_(len(self.cache), 3)
+        assert 'b' not in self.cache
+        assert 'a' in self.cache
+        eq_(self.cache.size, self.cache.max_size)
+
+    def oversized_test(self):
+        value = (np.zeros((1000, 3)),)
+        self.cache.put('big', value)
+        eq_(len(self.cache), 0)
+        # the caller's arrays are left as they were
+        assert value[0].flags.writeable
@@ -0,0 +1,69 @@
+import unittest
+
+import numpy as np
+from nose.tools import eq_
+
+from xye import XYEDataset
+from undo_history import UndoHistory
+
+
+class UndoHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.history = UndoHistory(max_size=10*1000*3*8)
+        self.datasets = [ XYEDataset(np.ones((1000, 3))*i, 'd{}_p1_0001.xye'.format(i))
+                          for i in range(3) ]
+        self.processed = []
+        self.push()
+
+    def push(self):
+        self.history.push(self.datasets, self.processed, set())
+
+    def undo_redo_test(self):
+        assert not self.history.can_undo()
+        self.processed = [ d.copy() for d in self.datasets ]
+        self.push()
+        self.datasets[0].writable_data()[:, 1] = 5.0
+        self.datasets[0].name = 'renamed'
+        self.push()
+        snapshot = self.history.undo()
+        eq_(len(snapshot.processed_datasets), 3)
+        eq_(self.datasets[0].name, 'd0_p1_0001.xye')
+        eq_(self.datasets[0].data[0, 1], 0.0)
+        eq_(len(self.history.undo().processed_datasets), 0)
+        eq_(self.history.undo(), None)
+        self.history.redo()
+        self.history.redo()
+        eq_(self.datasets[0].name, 'renamed')
+        eq_(self.datasets[0].data[0, 1], 5.0)
+        assert not self.history.can_redo()
+
+    def push_discards_redo_test(self):
+        self.datasets.append(XYEDataset(np.zeros((10, 3)), 'new'))
+        self.push()
+        self.history.undo()
+        self.push()
+        assert not self.history.can_redo()
+        eq_(len(self.history), 2)
+
+    def structural_sharing_test(self):
+        # Unchanged data costs nothing however many states share it
+        for i in range(20):
+            self.processed = self.processed + [ self.datasets[0].copy() ]
+            self.push()
+        eq_(len(self.history), 21)
+        eq_(self.history.size(), 0)
+        # Only modified data is held by the history
+        self.datasets[1].writable_data()[:, 1] = 1.0
+        self.push()
+        eq_(self.history.size(), 1000*3*8)
+
+    def memory_budget_test(self):
+        for i in range(20):
+            self.datasets[0].writable_data()[0, 1] = i
+            self.push()
+        assert self.history.size() <= self.history.max_size
+        eq_(len(self.history), 11)
+        for i in range(10):
+            self.history.undo()
+        assert not self.history.can_undo()
+        eq_(self.datasets[0].data[0, 1], 9.0)
@@ -1,16 +1,29 @@
 import unittest
 import nose
+import os
+import shutil
+import tempfile
 from os.path import join
 from nose.tools import eq_
 from StringIO import StringIO
 import numpy as np
 
 from xye import XYEDataset
+from xye_cache import XYECache
 
 
 class DatasetLoadingTest(unittest.TestCase):
     def setUp(self):
         self.basedir = join('tests', 'testdata')
+        # keep the test files out of the user's cache, in the loading workers too
+        self.no_cache = os.environ.get('PDVIPER_NO_CACHE')
+        os.environ['PDVIPER_NO_CACHE'] = '1'
+
+    def tearDown(self):
+        if self.no_cache is None:
+            del os.environ['PDVIPER_NO_CACHE']
+        else:
+            os.environ['PDVIPER_NO_CACHE'] = self.no_cache
 
     def simple_xye_load_test(self):
         filename = join(self.basedir, 'test1.xye')
@@ -49,6 +62,75 @@ class DatasetLoadingTest(unittest.TestCase):
         copied_dataset = dataset.copy()
         self.assertTrue(np.allclose(dataset.data, copied_dataset.data))
 
+    def xye_load_many_test(self):
+        filenames = [join(self.basedir, 'test1.xye'),
+                     join(self.basedir, 'missing.xye'),
+                     join(self.basedir, 'si640c_low_temp_cal_p1_scan0.000000_adv0_0000.xye')] * 3
+        datasets = XYEDataset.from_files(filenames, workers=2)
+        eq_([d.name for d in datasets],
+            ['test1.xye', 'si640c_low_temp_cal_p1_scan0.000000_adv0_0000.xye'] * 3)
+
+    def xye_load_many_cancel_test(self):
+        filenames = [join(self.basedir, 'test1.xye')] * 10
+        datasets = XYEDataset.from_files(filenames, workers=2, callback=lambda n: n < 4)
+        eq_(len(datasets), 4)
+
+
+class XYECacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = XYECache(join(self.tempdir, 'cache'), max_size=10*1024*1024)
+        self.filename = join(self.tempdir, 'test1.xye')
+        shutil.copy(join('tests', 'testdata', 'test1.xye'), self.filename)
+        self.data = np.arange(9.0).reshape(3,3)
+        self.metadata = {'Ion Chamber Raw Counts': 35327}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def cache_hit_test(self):
+        self.cache.save([self.filename], self.data, self.metadata)
+        data, metadata = self.cache.load([self.filename])
+        self.assertTrue(np.allclose(data, self.data))
+        eq_(metadata, self.metadata)
+
+    def cache_miss_on_change_test(self):
+        self.cache.save([self.filename], self.data, self.metadata)
+        with open(self.filename, 'a') as f:
+            f.write('      4.40000      40000.0      400.400\n')
+        eq_(self.cache.load([self.filename]), None)
+
+    def cache_eviction_test(self):
+        self.cache.max_size = 1
+        self.cache.save([self.filename], self.data, self.metadata)
+        eq_(self.cache.load([self.filename]), None)
+
+
+class DatasetCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.dataset = XYEDataset(np.arange(30.0).reshape(10, 3), 'a_p1_0001.xye', 'a',
+                                  {'Integrated Ion Chamber Count(counts)': 1000.0})
+
+    def copy_shares_data_test(self):
+        copied = self.dataset.copy()
+        self.assertTrue(np.may_share_memory(copied.data, self.dataset.data))
+        self.assertTrue(copied.metadata is not self.dataset.metadata)
+        eq_(copied.metadata, self.dataset.metadata)
+        # Shared data is read-only...
+        self.assertRaises(ValueError, copied.data.__setitem__, (0, 1), -1.0)
+        self.assertRaises(ValueError, self.dataset.data.__setitem__, (0, 1), -1.0)
+
+    def copy_on_write_test(self):
+        copied = self.dataset.copy()
+        # ...and only copied when modified
+        copied.writable_data()[:, 1] = -1.0
+        self.assertFalse(np.may_share_memory(copied.data, self.dataset.data))
+        eq_(self.dataset.data[0, 1], 1.0)
+        self.dataset.writable_data()[0, 1] = 2.0
+        eq_(copied.data[0, 1], -1.0)
+        data = self.dataset.data
+        self.dataset.writable_data()[0, 1] = 3.0
+        self.assertTrue(self.dataset.data is data)
 
 
 if __name__ == '__main__':
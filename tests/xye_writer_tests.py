@@ -0,0 +1,51 @@
+import unittest
+import os
+import tempfile
+import shutil
+from StringIO import StringIO
+import numpy as np
+from nose.tools import eq_
+
+from xye import XYEDataset
+import xye_writer
+
+
+class XYEWriterTest(unittest.TestCase):
+    def setUp(self):
+        x = np.linspace(5.0, 85.0, 1001)
+        self.data = np.c_[x, np.random.rand(1001)*1e4, np.random.rand(1001)]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def format_rows_test(self):
+        expected = StringIO()
+        np.savetxt(expected, self.data, fmt='%1.6f')
+        eq_(xye_writer.format_rows(self.data), expected.getvalue())
+
+    def save_to_file_object_test(self):
+        f = StringIO()
+        XYEDataset(self.data).save(f)
+        f.seek(0)
+        assert np.allclose(np.loadtxt(f), self.data, atol=1e-6)
+
+    def fxye_header_test(self):
+        filename = os.path.join(self.directory, 'test_0001.fxye')
+        XYEDataset(self.data).save_fxye(filename)
+        with open(filename) as f:
+            lines = f.readlines()
+        eq_(lines[0], 'Automatically generated file test_0001 from PDViPeR\n')
+        eq_(lines[1].split(), ['BANK', '1', '1001', '1001', 'CONS', '500.000000',
+                               '8.000000', '0', '0', 'FXYE'])
+        data = np.loadtxt(filename, skiprows=2)
+        assert np.allclose(data[:,0], self.data[:,0]*100, atol=1e-6)
+        assert np.allclose(data[:,1:], self.data[:,1:], atol=1e-6)
+
+    def save_datasets_test(self):
+        datasets = [ XYEDataset(self.data + i, name='d{}.xye'.format(i)) for i in range(6) ]
+        filenames = [ os.path.join(self.directory, d.name) for d in datasets ]
+        written = xye_writer.save_datasets(zip(datasets, filenames), workers=3)
+        eq_(written, filenames)
+        for i, filename in enumerate(filenames):
+            assert np.allclose(np.loadtxt(filename), self.data + i, atol=1e-6)
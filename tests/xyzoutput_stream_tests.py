@@ -0,0 +1,47 @@
+import unittest
+import tempfile
+import os
+import numpy as np
+from nose.tools import eq_
+
+import xye
+from xyzoutput import XYZGenerator, write_to_file
+
+
+class UI(object):
+    def __init__(self, active=True):
+        self.active = active
+
+
+class XYZStreamTest(unittest.TestCase):
+    def setUp(self):
+        data1 = np.c_[[1,4,7],[2,5,8],[3,6,9]]
+        data2 = np.c_[[10,13,16,19],[11,14,18,20],[12,15,17,21]]
+        data3 = np.c_[[22,25],[23,26],[24,27]]
+        self.datasets = [ xye.XYEDataset(data=d, metadata={'ui': UI()}) for d in [data1, data2, data3] ]
+        self.datasets[1].metadata['ui'].active = False
+        self.expected = np.array([[1,1,2],[4,1,5],[7,1,8],[22,2,23],[25,2,26]], dtype=float)
+        self.filename = tempfile.mktemp(suffix='.xyz')
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def unequal_lengths_test(self):
+        # Rows are labelled by position among the active datasets
+        xyzresult = XYZGenerator().process_data(self.datasets)
+        assert np.array_equal(xyzresult, self.expected)
+
+    def chunked_write_test(self):
+        chunks = XYZGenerator().iter_chunks(self.datasets, chunk_rows=2)
+        write_to_file(self.filename, chunks)
+        written = np.loadtxt(self.filename, skiprows=1)
+        assert np.array_equal(written, self.expected)
+
+    def savetxt_format_test(self):
+        write_to_file(self.filename, self.expected)
+        with open(self.filename) as f:
+            lines = f.readlines()
+        eq_(lines[0], "2Theta(X)\tDataset(Y)\tIntensity(Z)\n")
+        eq_(lines[1], '1.00000\t1.0\t   2.00000\n')
+        eq_(len(lines), 6)
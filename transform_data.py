@@ -1,5 +1,4 @@
 import re
-from copy import deepcopy
 from processing import insert_descriptor
 
 
@@ -8,18 +7,20 @@ def apply_transform(datasets,x,y,x_multiplier,y_multiplier):
     for d in datasets:
         name=re.search("(transformed)",d.metadata['ui'].name) 
         if name is None:
-            newd=deepcopy(d)
-            newd.data[:,0]=newd.data[:,0]*x_multiplier+x
-            newd.data[:,1]=newd.data[:,1]*y_multiplier+y 
-            newd.data[:,2]=newd.data[:,2]*y_multiplier+y
+            newd=d.copy()
+            data=newd.writable_data()
+            data[:,0]=data[:,0]*x_multiplier+x
+            data[:,1]=data[:,1]*y_multiplier+y 
+            data[:,2]=data[:,2]*y_multiplier+y
             newd.name = insert_descriptor(newd.name, 't')
             newd.metadata['ui'].name = newd.name + ' (transformed)'
             transformed_datasets.append(newd)
         else:
             newd=d
-            newd.data[:,0]=newd.data[:,0]*x_multiplier+x
-            newd.data[:,1]=newd.data[:,1]*y_multiplier+y 
-            newd.data[:,2]=newd.data[:,2]*y_multiplier+y
+            data=newd.writable_data()
+            data[:,0]=data[:,0]*x_multiplier+x
+            data[:,1]=data[:,1]*y_multiplier+y 
+            data[:,2]=data[:,2]*y_multiplier+y
             transformed_datasets.append(newd)
     return transformed_datasets    
 
@@ -51,7 +51,8 @@ def get_save_as_csv_filename():
 xye_wildcard = 'XYE (*.xye)|*.xye|' \
            'XY (*.xy)|*.xy|' \
            'DAT (*.dat)|*.dat|'\
-           'RAW (Bruker V3) (*.raw)|*.raw|'\
+           'RAW (Bruker) (*.raw)|*.raw|'\
+           'PDViPeR batch (*.pdvz)|*.pdvz|'\
            'All files (*.*)|*.*'
 
 def get_file_list_from_dialog():
@@ -97,7 +98,7 @@ def startfile(filename):
         subprocess.Popen(['xdg-open', filename])
 
 class SaveProcessedDirSelector(HasTraits):
-    file_type=Enum('xye','fxye')('xye')
+    file_type=Enum('xye','fxye','pdvz')('xye')
     path = Directory()
 
     def __init__(self, default_dir):
@@ -108,6 +109,7 @@ class SaveProcessedDirSelector(HasTraits):
         Item(name='file_type', editor=EnumEditor(values={
                     'xye'   : '1: XYE',
                     'fxye'   : '2: GSAS fxye',
+                    'pdvz'   : '3: PDViPeR batch (single file)',
                     }, cols=1),style='simple'),
         Item(name='path', label='Directory', style='simple')),
         title='Select file type and directory',
@@ -0,0 +1,122 @@
+import settings
+
+__doc__ = \
+"""
+A multi-level undo/redo history of the datasets of a session.
+A snapshot keeps the lists of loaded and processed datasets and the data array and name
+of each of them. The arrays aren't copied: XYEDataset.share_data() makes them read-only,
+so an operation that later modifies a dataset in place copies its data first (see
+XYEDataset.writable_data()) and the snapshot keeps the old array. Snapshots therefore
+share every array that hasn't changed between them, and the memory held by the
+history is only that of the arrays that have since been replaced or modified.
+The history holds at most max_size bytes of such arrays, forgetting the oldest
+snapshots first.
+"""
+
+
+def _memory(a):
+    """
+    Returns the array owning the memory of a, which may be a view.
+    """
+    while a.base is not None and hasattr(a.base, 'nbytes'):
+        a = a.base
+    return a
+
+
+class Snapshot(object):
+    def __init__(self, datasets, processed_datasets, dataset_pairs):
+        self.datasets = list(datasets)
+        self.processed_datasets = list(processed_datasets)
+        self.dataset_pairs = set(dataset_pairs)
+        self.states = [ (d, d.share_data(), d.name)
+                        for d in self.datasets + self.processed_datasets ]
+
+    def restore(self):
+        """
+        Puts back the data and names of the datasets as they were when the snapshot was
+        taken.
+        """
+        for dataset, data, name in self.states:
+            dataset.data = data
+            dataset.name = name
+
+    def arrays(self):
+        """
+        Returns a dictionary of the memory-owning arrays behind the snapshot's data, by id.
+        """
+        arrays = {}
+        for _, data, _ in self.states:
+            a = _memory(data)
+            arrays[id(a)] = a
+        return arrays
+
+
+class UndoHistory(object):
+    def __init__(self, max_size=settings.undo_history_max_size):
+        self.max_size = max_size
+        self._snapshots = []
+        self._position = -1          # index of the snapshot of the current state
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def can_undo(self):
+        return self._position > 0
+
+    def can_redo(self):
+        return self._position < len(self._snapshots) - 1
+
+    def clear(self):
+        self._snapshots = []
+        self._position = -1
+
+    def push(self, datasets, processed_datasets, dataset_pairs):
+        """
+        Records the current state, discarding any states that could have been redone.
+        """
+        del self._snapshots[self._position + 1:]
+        self._snapshots.append(Snapshot(datasets, processed_datasets, dataset_pairs))
+        self._position = len(self._snapshots) - 1
+        self._limit_size()
+
+    def undo(self):
+        """
+        Restores the previous state and returns its Snapshot, or None if there isn't one.
+        """
+        if not self.can_undo():
+            return None
+        self._position -= 1
+        return self._restore()
+
+    def redo(self):
+        """
+        Restores the state undone last and returns its Snapshot, or None if there isn't
+        one.
+        """
+        if not self.can_redo():
+            return None
+        self._position += 1
+        return self._restore()
+
+    def _restore(self):
+        snapshot = self._snapshots[self._position]
+        snapshot.restore()
+        return snapshot
+
+    def size(self):
+        """
+        Returns the number of bytes held by the history, i.e. in arrays of other states
+        that the current state doesn't use.
+        """
+        if not self._snapshots:
+            return 0
+        current = self._snapshots[self._position].arrays()
+        held = {}
+        for snapshot in self._snapshots:
+            held.update(snapshot.arrays())
+        return sum(a.nbytes for key, a in held.iteritems() if key not in current)
+
+    def _limit_size(self):
+        while self._position > 0 and self.size() > self.max_size:
+            del self._snapshots[0]
+            self._position -= 1
@@ -1,13 +1,16 @@
 import logger
 from os.path import basename, split, splitext
-from numpy import loadtxt, savetxt, asfarray
+from numpy import loadtxt, asfarray
 import numpy as np
 from csv import reader
 from pandas import read_csv
 
 from parab import load_params
 from copy import deepcopy
+from multiprocessing import Pool, cpu_count
 from data_formats import read_raw
+from xye_cache import default_cache
+from xye_writer import write_xye, write_fxye
 
 class XYEDataset(object):
     @classmethod
@@ -57,19 +60,91 @@ class XYEDataset(object):
 
 
     @classmethod
-    def from_file(cls, filename, positions=2):
-        if splitext(filename)[1]=='.raw':
-            data,metadata = cls._load_bruker_raw_data(filename)
+    def from_file(cls, filename, positions=2, use_cache=True):
+        """
+        Loads a dataset from an .xye, .xy or Bruker .raw file.
+        Unless use_cache is False, the parsed data and metadata are read from and
+        written to the on-disk cache (see xye_cache.py).
+        """
+        cache = default_cache() if use_cache else None
+        source_filenames = cls._source_filenames(filename)
+        cached = cache.load(source_filenames) if cache is not None else None
+        if cached is not None:
+            data, metadata = cached
         else:
-            data = cls._load_xye_data(filename)
-            metadata = cls.load_metadata(filename)
+            if splitext(filename)[1]=='.raw':
+                data,metadata = cls._load_bruker_raw_data(filename)
+            else:
+                data = cls._load_xye_data(filename)
+                metadata = cls.load_metadata(filename)
+            if cache is not None:
+                cache.save(source_filenames, data, metadata)
         return cls(data, name=basename(filename), source=filename,
                    metadata=metadata)
 
+    @classmethod
+    def iter_from_files(cls, filenames, workers=None):
+        """
+        Generator yielding the datasets loaded from filenames, in the same order.
+        The files are parsed concurrently by a pool of <workers> processes, one per CPU
+        by default. Files that can't be read yield None.
+        Closing the generator before it is exhausted, e.g. by breaking out of a loop
+        over it, cancels the remaining loads.
+        """
+        filenames = list(filenames)
+        if workers is None:
+            workers = cpu_count()
+        workers = min(workers, len(filenames))
+        if workers <= 1:
+            for filename in filenames:
+                yield _load_dataset(filename)
+            return
+        # Small chunks keep the results streaming back steadily for progress reporting
+        chunksize = max(1, len(filenames)/(workers*8))
+        pool = Pool(workers)
+        try:
+            for dataset in pool.imap(_load_dataset, filenames, chunksize):
+                yield dataset
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @classmethod
+    def from_files(cls, filenames, workers=None, callback=None):
+        """
+        Loads datasets from filenames in parallel, see iter_from_files().
+        Returns a list of the datasets in the same order as filenames, skipping files
+        that can't be read.
+        If given, callback(n) is called after each of the n files has been loaded;
+        returning False from it cancels loading and returns the datasets loaded so far.
+        """
+        datasets = []
+        results = cls.iter_from_files(filenames, workers)
+        for i, dataset in enumerate(results):
+            if dataset is not None:
+                datasets.append(dataset)
+            if callback is not None and callback(i + 1) is False:
+                results.close()
+                break
+        return datasets
+
+    @classmethod
+    def _source_filenames(cls, filename):
+        """
+        Returns the list of files the dataset loaded from filename depends on.
+        """
+        if splitext(filename)[1]=='.raw':
+            return [filename]
+        return [filename, cls._parab_filename(filename)]
+
     @staticmethod
-    def load_metadata(filename):
+    def _parab_filename(filename):
         base_filename = filename.rsplit('.', 1)[0]
-        parab_filename = base_filename + '.parab'
+        return base_filename + '.parab'
+
+    @classmethod
+    def load_metadata(cls, filename):
+        parab_filename = cls._parab_filename(filename)
         try:
             params = load_params(parab_filename)
         except IOError:
@@ -95,18 +170,57 @@ class XYEDataset(object):
         self.metadata[name] = value
 
     def save(self, filename):
-        open(filename,'w')
-        savetxt(filename, self.data, fmt='%1.6f')
+        """
+        Saves the dataset as an .xye file. filename may also be an open file-like object.
+        """
+        write_xye(filename, self.data)
    #     logger.logger.info('Saved {}'.format(filename))
-        
-    def save_fxye(self,filename):
-        f=open(filename,'w')
-        newx=self.data[:,0]*100
-        newdata=np.column_stack((newx,self.data[:,1],self.data[:,2]))
-        f.writelines(['Automatically generated file {} from PDViPeR \n'.format(splitext(basename(filename))[0]),
-                     'BANK\t1\t{0}\t{1}\tCONS\t{2}\t{3} 0 0 FXYE \n'.format(len(newx),len(self.data[:,1]),newx[0],newx[1]-newx[0])])
-        savetxt(filename, newdata, fmt='%1.6f')
 
-    def copy(self):
-        return deepcopy(self)
+    def save_fxye(self, filename):
+        """
+        Saves the dataset as a GSAS FXYE file with 2theta in centidegrees.
+        """
+        write_fxye(filename, self.data)
+
+    def share_data(self):
+        """
+        Makes the data read-only and returns it, so that it can be kept, e.g. by a copy
+        of the dataset or an undo history, without copying it. Modify the data in place
+        through writable_data(), which copies it first if it is shared.
+        """
+        if self.data.flags.writeable:
+            self.data = self.data.view()
+            self.data.flags.writeable = False
+        return self.data
+
+    def writable_data(self):
+        """
+        Returns the data for modifying in place, copying it first if it is shared.
+        """
+        if not self.data.flags.writeable:
+            self.data = self.data.copy()
+        return self.data
 
+    def copy(self):
+        """
+        Returns a deep copy of the dataset, except that the data is shared until either
+        dataset modifies it, see share_data().
+        The copy isn't the output of DatasetProcessor.process_all(), so it doesn't get the
+        'processing_signature' and 'processed_from' metadata that would let a later run
+        return it as such.
+        """
+        data = self.share_data()
+        dataset = deepcopy(self, {id(data): data})
+        dataset.metadata.pop('processing_signature', None)
+        dataset.metadata.pop('processed_from', None)
+        return dataset
+
+
+def _load_dataset(filename):
+    """
+    Process pool worker for XYEDataset.iter_from_files().
+    """
+    try:
+        return XYEDataset.from_file(filename)
+    except IOError:
+        return None
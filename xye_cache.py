@@ -0,0 +1,162 @@
+import os
+import hashlib
+import cPickle as pickle
+
+import numpy as np
+
+import logger
+import settings
+
+__doc__ = \
+"""
+A transparent on-disk cache of parsed data files.
+Parsing .xye text files (and their .parab partners) dominates the time taken to open a
+large number of datasets. The first time a file is loaded, the parsed Nx3 array and
+metadata dictionary are written to a compact binary cache entry. Subsequent loads read
+the entry instead, provided the size and modification time of every source file still
+match those recorded in the entry.
+Each entry is a pickled header (the source file signature and the metadata) followed by
+the array in .npy format, so a stale entry is detected without reading its data.
+The total size of the cache is bounded; the least recently used entries are evicted first.
+"""
+
+CACHE_DIRECTORY = os.path.join(logger.LOG_DIRECTORY, 'cache')
+ENTRY_EXTENSION = '.npc'
+
+
+def file_signature(filenames):
+    """
+    Returns a tuple of (size, mtime) pairs identifying the current state of the
+    given files. Missing files are represented by None.
+    """
+    signature = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+            signature.append((st.st_size, st.st_mtime))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class XYECache(object):
+    def __init__(self, directory=CACHE_DIRECTORY, max_size=settings.xye_cache_max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None           # estimated total size of the entries, in bytes
+
+    def _entry_filename(self, filename):
+        key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+    def load(self, filenames):
+        """
+        <filenames> is a list of the source files the entry depends on; the first one
+        is the data file itself.
+        Returns a (data, metadata) tuple, or None if there is no valid entry.
+        """
+        entry_filename = self._entry_filename(filenames[0])
+        try:
+            with open(entry_filename, 'rb') as f:
+                signature, metadata = pickle.load(f)
+                if signature != file_signature(filenames):
+                    return None
+                data = np.load(f)
+        except Exception:
+            # A missing, stale or corrupt entry is just a cache miss
+            return None
+        try:
+            # Touch the entry so the eviction policy sees it as recently used
+            os.utime(entry_filename, None)
+        except OSError:
+            pass
+        return data, metadata
+
+    def save(self, filenames, data, metadata):
+        """
+        Writes a cache entry for the data and metadata parsed from <filenames>.
+        Failure to write the entry (e.g. a read-only home directory) is not an error.
+        """
+        entry_filename = self._entry_filename(filenames[0])
+        temp_filename = '{}.{}.tmp'.format(entry_filename, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(temp_filename, 'wb') as f:
+                pickle.dump((file_signature(filenames), metadata), f,
+                            pickle.HIGHEST_PROTOCOL)
+                np.save(f, np.ascontiguousarray(data))
+            if os.path.exists(entry_filename):
+                # os.rename() doesn't replace existing files on Windows
+                os.remove(entry_filename)
+            os.rename(temp_filename, entry_filename)
+        except (IOError, OSError, pickle.PicklingError):
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+            return
+        if self._size is not None:
+            self._size += os.path.getsize(entry_filename)
+        self._evict()
+
+    def _entries(self):
+        """
+        Returns a list of (mtime, size, filename) tuples for all cache entries,
+        oldest first.
+        """
+        entries = []
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for fn in filenames:
+            if not fn.endswith(ENTRY_EXTENSION):
+                continue
+            fn = os.path.join(self.directory, fn)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+        return sorted(entries)
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_size.
+        The directory is only rescanned once the running size estimate overflows.
+        """
+        if self._size is not None and self._size <= self.max_size:
+            return
+        entries = self._entries()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, fn in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(fn)
+                self._size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for _, _, fn in self._entries():
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+        self._size = 0
+
+
+_default_cache = None
+
+def default_cache():
+    """
+    Returns the shared XYECache instance, or None if caching is disabled.
+    """
+    global _default_cache
+    if not settings.xye_cache_enabled or os.getenv('PDVIPER_NO_CACHE'):
+        return None
+    if _default_cache is None:
+        _default_cache = XYECache()
+    return _default_cache
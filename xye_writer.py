@@ -0,0 +1,122 @@
+from os.path import basename, splitext
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+__doc__ = \
+"""
+Fast writers for XYE and GSAS FXYE files.
+numpy.savetxt() formats each row with a separate Python-level string operation. Here a
+whole block of rows is formatted with a single % operation on a repeated row format,
+giving byte-for-byte the same text several times faster. Large arrays are formatted in
+blocks so the text of a whole file is never held in memory at once.
+save_datasets() writes many datasets concurrently using a pool of threads.
+"""
+
+XYE_FORMAT = '%1.6f'
+BLOCK_ROWS = 65536
+
+
+def format_rows(data, fmt=XYE_FORMAT, delimiter=' ', newline='\n'):
+    """
+    Returns the text of the 2D array <data> as np.savetxt(fmt=fmt) would write it.
+    As for savetxt, fmt is either a single format for every column or, if it contains
+    more than one %, the format of a whole row.
+    """
+    if len(data) == 0:
+        return ''
+    if fmt.count('%') == 1:
+        row_format = delimiter.join([fmt]*data.shape[1]) + newline
+    else:
+        row_format = fmt + newline
+    return (row_format*len(data)) % tuple(np.ravel(data).tolist())
+
+
+def write_rows(f, data, fmt=XYE_FORMAT, delimiter=' ', newline='\n'):
+    """
+    Writes the 2D array <data> to the open file f, BLOCK_ROWS rows at a time.
+    """
+    for i in xrange(0, len(data), BLOCK_ROWS):
+        f.write(format_rows(data[i:i+BLOCK_ROWS], fmt, delimiter, newline))
+
+
+def _open(filename):
+    """
+    Returns (file, close) where file is <filename> opened for writing, or filename
+    itself if it is already a file-like object, in which case close is False.
+    """
+    if hasattr(filename, 'write'):
+        return filename, False
+    return open(filename, 'w'), True
+
+
+def write_xye(filename, data):
+    """
+    Writes the x, y, e columns of <data> to filename, which may be a path or an open
+    file-like object.
+    """
+    f, close = _open(filename)
+    try:
+        write_rows(f, data[:, :3])
+    finally:
+        if close:
+            f.close()
+
+
+def fxye_header(title, x):
+    """
+    Returns the two header lines of a GSAS FXYE file: the title, limited to the 80
+    characters GSAS reads, and the BANK line. <x> is the 2theta values in centidegrees.
+    """
+    npoints = len(x)
+    start = x[0] if npoints > 0 else 0.0
+    step = x[1] - x[0] if npoints > 1 else 0.0
+    title = 'Automatically generated file {} from PDViPeR'.format(title)[:80]
+    bank = 'BANK 1 {0} {0} CONS {1:f} {2:f} 0 0 FXYE'.format(npoints, start, step)
+    return title + '\n' + bank + '\n'
+
+
+def write_fxye(filename, data):
+    """
+    Writes <data> to a GSAS FXYE file, with the 2theta values converted from degrees to
+    centidegrees. filename may be a path or an open file-like object.
+    """
+    newdata = np.column_stack((data[:,0]*100, data[:,1], data[:,2]))
+    if hasattr(filename, 'write'):
+        title = splitext(basename(getattr(filename, 'name', '')))[0]
+    else:
+        title = splitext(basename(filename))[0]
+    f, close = _open(filename)
+    try:
+        f.write(fxye_header(title, newdata[:,0]))
+        write_rows(f, newdata)
+    finally:
+        if close:
+            f.close()
+
+
+def _save_job(job):
+    dataset, filename, fxye = job
+    if fxye:
+        dataset.save_fxye(filename)
+    else:
+        dataset.save(filename)
+    return filename
+
+
+def save_datasets(datasets_and_filenames, fxye=False, workers=4):
+    """
+    Saves each (dataset, filename) pair in the list, as FXYE files if fxye is True
+    and otherwise as XYE files, using a pool of <workers> threads so that formatting
+    one file overlaps writing others to disk.
+    Returns the list of filenames written.
+    """
+    jobs = [ (dataset, filename, fxye) for dataset, filename in datasets_and_filenames ]
+    if workers <= 1 or len(jobs) <= 1:
+        return map(_save_job, jobs)
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        return pool.map(_save_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
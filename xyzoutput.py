@@ -1,29 +1,78 @@
 import numpy as np
 from processing import stack_datasets
+from xye_writer import format_rows
 
-def write_to_file(filename,xyzdata):
+__doc__ = \
+"""
+Export of the active datasets as X, Y, Z columns: 2theta, the dataset's position in the
+export (1, 2, ...) and the intensity.
+The columns are built with array operations and written in chunks, so a large export
+never holds more than one chunk of formatted text in memory.
+"""
+
+XYZ_HEADER = "2Theta(X)\tDataset(Y)\tIntensity(Z)\n"
+XYZ_ROW_FORMAT = '%4.5f\t%2.1f\t%10.5f'
+CHUNK_ROWS = 65536
+
+
+def write_chunks(outfile, chunks, row_format=XYZ_ROW_FORMAT):
+    """
+    Writes each row of the 2D arrays in <chunks> to the open file using row_format.
+    The output is identical to np.savetxt(), see xye_writer.format_rows().
+    """
+    for chunk in chunks:
+        outfile.write(format_rows(chunk, row_format))
+
+
+def write_to_file(filename, xyzdata):
+    """
+    <xyzdata> is either an Mx3 array from XYZGenerator.process_data() or an iterable of
+    such arrays, e.g. from XYZGenerator.iter_chunks().
+    """
+    if isinstance(xyzdata, np.ndarray):
+        chunks = [ xyzdata[i:i+CHUNK_ROWS] for i in xrange(0, len(xyzdata), CHUNK_ROWS) ]
+    else:
+        chunks = xyzdata
     with file(filename, 'w') as outfile:
-        outfile.write("2Theta(X)\tDataset(Y)\tIntensity(Z)\n")
-        np.savetxt(outfile,xyzdata,fmt='%4.5f\t%2.1f\t%10.5f',delimiter='\t',newline='\n')
+        outfile.write(XYZ_HEADER)
+        write_chunks(outfile, chunks)
 
 
 
 
 class XYZGenerator():
 
+    def iter_chunks(self, datasets, chunk_rows=CHUNK_ROWS):
+        """
+        Yields the XYZ rows for the active datasets as Mx3 arrays of at most
+        chunk_rows rows. Datasets may have different lengths; each row is labelled
+        with the position of its own dataset among the active datasets.
+        The same buffer is reused for each chunk, so consume each before the next.
+        """
+        data = [ dataset.data for dataset in datasets if dataset.metadata['ui'].active ]
+        chunk = np.empty((chunk_rows, 3))
+        filled = 0
+        for y, d in enumerate(data, 1):
+            start = 0
+            while start < len(d):
+                n = min(len(d) - start, chunk_rows - filled)
+                chunk[filled:filled+n, 0] = d[start:start+n, 0]
+                chunk[filled:filled+n, 1] = y
+                chunk[filled:filled+n, 2] = d[start:start+n, 1]
+                filled += n
+                start += n
+                if filled == chunk_rows:
+                    yield chunk
+                    filled = 0
+        if filled:
+            yield chunk[:filled]
 
     def process_data(self, datasets):
-        data=[ dataset.data[:len(dataset.data)] for dataset in datasets if dataset.metadata['ui'].active ]
-        stack = np.vstack(data)
-
-        xs = stack[:,0]
-        zs=stack[:,1]
-        
-        ys=np.concatenate([ np.array([i]*data[i-1].shape[0]) for i in range(1, len(datasets) + 1) ])
-               
-        xyzdata=np.zeros((len(xs.flat),3),float)
-        for i in range(len(xs)):
-            xyzdata[i]=np.array([xs[i],ys[i],zs[i]])
-       
-        return xyzdata
-    
+        data=[ dataset.data for dataset in datasets if dataset.metadata['ui'].active ]
+        if not data:
+            return np.zeros((0,3))
+        lengths = [ len(d) for d in data ]
+        xs = np.concatenate([ d[:,0] for d in data ])
+        ys = np.repeat(np.arange(1, len(data) + 1, dtype=float), lengths)
+        zs = np.concatenate([ d[:,1] for d in data ])
+        return np.column_stack((xs, ys, zs))